@@ -11,7 +11,7 @@ import json
 import pandas as pd
 import seaborn as sns
 from collections import defaultdict
-from gtfs.haversine import haversine
+from gtfs.util import haversines
 import matplotlib.pyplot as plt
 
 try:
@@ -23,13 +23,16 @@ except IndexError:
 with open(sim_output_path, 'r') as f:
     data = json.load(f)
 
+# compute all trip distances at once
+trips = data['agent_trips']
+dists = haversines(
+    [stop_start for _, stop_start, _, _, _, _ in trips],
+    [stop_end for _, _, stop_end, _, _, _ in trips]) # km
+
 # Time in seconds
 agent_travel_times = defaultdict(int)
 agent_travel_dists = defaultdict(int)
-for agent_id, stop_start, stop_end, stop_type, stop_deptime, time in data['agent_trips']:
-    x_s, y_s = stop_start
-    x_e, y_e = stop_end
-    dist = haversine(x_s, y_s, x_e, y_e) # km
+for (agent_id, stop_start, stop_end, stop_type, stop_deptime, time), dist in zip(trips, dists.tolist()):
     elapsed = (time - stop_deptime)/60 # minutes
     agent_travel_times[agent_id] += elapsed
     agent_travel_dists[agent_id] += dist
@@ -0,0 +1,155 @@
+"""
+benchmarks for transit routing,
+e.g. `python bench.py data/gtfs/gtfs_bhtransit.zip 22/2/2017`,
+comparing the routing engines (see `gtfs.router.TransitRouter`)
+"""
+
+import click
+import config
+import numpy as np
+from time import time
+from gtfs import Transit, util
+from gtfs.router import NoTransitRouteFound
+from dateutil import parser
+
+
+def random_queries(transit, n, dep_window, seed=0, near=None):
+    """random start/end coords (near stops)
+    and departure times. if `near` is set, ends
+    are within that many degrees of their starts"""
+    rand = np.random.RandomState(seed)
+    coords = transit.stop_coords
+    jitter = 0.002
+    starts = coords[rand.randint(len(coords), size=n)] + rand.uniform(-jitter, jitter, (n, 2))
+    if near is None:
+        ends = coords[rand.randint(len(coords), size=n)] + rand.uniform(-jitter, jitter, (n, 2))
+    else:
+        ends = starts + rand.uniform(-near, near, (n, 2))
+    dep_times = rand.uniform(*dep_window, size=n)
+    return starts, ends, dep_times
+
+
+def report(name, n, elapsed):
+    print('{:<24} {:>8} queries {:>10.3f}s {:>10.3f}ms/query'.format(name, n, elapsed, 1000*elapsed/n))
+
+
+def long_distance(starts, ends, quantile=0.75):
+    """mask of the queries whose straight-line
+    distance is in the top quantile"""
+    dists = util.haversines(starts, ends)
+    return dists >= np.quantile(dists, quantile)
+
+
+def check_candidates(transit, dt, engine, starts, ends, dep_times):
+    """check that routing from all candidate stops is never
+    worse than from just the two closest (i.e. with no walking radius),
+    comparing the routing engine's arrivals at the end stops.
+    returns the number of queries where it is"""
+    times, same_stops = [], []
+    for max_access_walk in (config.TRANSIT_ACCESS_WALK_MAX, 0):
+        router = transit.router_for_day(dt, engine=engine, max_access_walk=max_access_walk)
+        cands = router._candidate_stops(starts, ends, 2)
+        times.append(router._query_batch(cands[0], cands[1], dep_times)[0])
+        same_stops.append(cands[2])
+
+    # trips walking directly aren't routed
+    routed = ~(same_stops[0] | same_stops[1]) & np.isfinite(times[1])
+    worse = (times[0][routed] > times[1][routed] + 1e-6).sum()
+    print('{:<24} {:>8} queries {:>10} worse than the closest stops'.format(
+        '{} candidates'.format(engine), routed.sum(), worse))
+    return worse
+
+
+def check_trees(router, starts, ends, dep_times):
+    """check that routing from the cached trees (see `TransitRouter.route_from_trees`)
+    arrives when routing directly does, comparing the routing engine's
+    arrivals at the end stops. returns the number of queries where it doesn't"""
+    (start_stops, start_walks, start_offsets), (end_stops, end_walks, end_offsets), same_stops, _ = \
+        router._candidate_stops(starts, ends, 2)
+    times = router._query_batch(
+        (start_stops, start_walks, start_offsets), (end_stops, end_walks, end_offsets), dep_times)[0]
+
+    s = time()
+    differ = 0
+    for i in np.flatnonzero(~same_stops).tolist():
+        tree_time, _ = router._query_trees(
+            start_stops[start_offsets[i]:start_offsets[i+1]],
+            start_walks[start_offsets[i]:start_offsets[i+1]],
+            end_stops[end_offsets[i]:end_offsets[i+1]],
+            end_walks[end_offsets[i]:end_offsets[i+1]],
+            dep_times[i])
+        if not np.isclose(tree_time - dep_times[i], times[i], rtol=0, atol=1e-6):
+            differ += 1
+    report('{} trees'.format(router.engine), (~same_stops).sum(), time() - s)
+    print('{:<24} {:>8} queries {:>10} differ from routing directly'.format(
+        '{} trees'.format(router.engine), (~same_stops).sum(), differ))
+    return differ
+
+
+def check_by_arrival(router, starts, ends, arr_times):
+    """check that the latest departures found routing by arrival
+    (see `TransitRouter.route_by_arrival`) are tight, i.e. that departing
+    a second later misses the arrival time, comparing the routing engine's
+    arrivals at the end stops. returns the number of queries where it doesn't"""
+    cands = router._candidate_stops(starts, ends, 2)
+    dep_times, _, _, _ = router.csa.route_by_arrival_batch(*cands[0], *cands[1], arr_times, router.active_trips)
+
+    # trips walking directly aren't routed,
+    # and those without a route depart at their arrival time
+    routed = ~cands[2] & np.isfinite(dep_times)
+    later = np.where(routed, dep_times + 1, arr_times)
+    times = router._query_batch(cands[0], cands[1], later)[0]
+    early = (later[routed] + times[routed] <= arr_times[routed] + 1e-6).sum()
+    print('{:<24} {:>8} queries {:>10} arrive in time departing later'.format(
+        '{} by arrival'.format(router.engine), routed.sum(), early))
+    return early
+
+
+@click.command()
+@click.argument('gtfs_path')
+@click.argument('date')
+@click.option('-n', '--queries', default=1000, help='Number of queries')
+@click.option('--start', default=7, help='Start of departure window (hour)')
+@click.option('--end', default=9, help='End of departure window (hour)')
+@click.option('--max-transfers', default=config.TRANSIT_MAX_TRANSFERS, help='Max transfers (raptor)')
+def run(gtfs_path, date, queries, start, end, max_transfers):
+    transit = Transit(gtfs_path)
+    dt = parser.parse(date, dayfirst=True)
+    routers = {
+        engine: transit.router_for_day(dt, engine=engine, max_transfers=max_transfers)
+        for engine in ['csa', 'raptor']}
+    starts, ends, dep_times = random_queries(transit, queries, (start*3600, end*3600))
+    far = long_distance(starts, ends)
+
+    # short trips, whose start and end candidate stops overlap
+    near = random_queries(transit, queries, (start*3600, end*3600), near=0.012)
+
+    for engine, router in routers.items():
+        # warm up
+        router.route_batch(starts[:10], ends[:10], dep_times[:10])
+
+        s = time()
+        for start_coord, end_coord, dep_time in zip(starts, ends, dep_times):
+            try:
+                router.route(start_coord, end_coord, dep_time)
+            except NoTransitRouteFound:
+                pass
+        report('{} route'.format(engine), queries, time() - s)
+
+        s = time()
+        router.route_batch(starts, ends, dep_times)
+        report('{} route_batch'.format(engine), queries, time() - s)
+
+        s = time()
+        router.route_batch(starts[far], ends[far], dep_times[far])
+        report('{} route_batch (far)'.format(engine), far.sum(), time() - s)
+
+        check_candidates(transit, dt, engine, starts, ends, dep_times)
+        check_candidates(transit, dt, engine, *near)
+
+    check_trees(routers['csa'], starts, ends, dep_times)
+    check_by_arrival(routers['csa'], starts, ends, dep_times)
+
+
+if __name__ == '__main__':
+    run()
@@ -63,6 +63,59 @@ GEOHASH_PRECISION = 6
 
 OUTPUT_PATH = '/tmp/seal_transit'
 
+# parse GTFS tables this many rows at a time,
+# to limit memory usage for large feeds.
+# `None` parses each table in one go
+GTFS_CHUNK_SIZE = None
+
+# where preprocessed public transit data is cached
+TRANSIT_CACHE_PATH = 'data/transit'
+
+# one-to-all transit trees are cached per start stop
+# and departure time bucket of this many seconds,
+# keeping at most this many trees
+TRANSIT_TREE_BUCKET = 5*60
+TRANSIT_TREE_CACHE_SIZE = 500
+
+# transit journeys can be cached (and shared by trips between
+# the same zones) per departure time bucket of this many seconds,
+# keeping at most this many journeys. 0 disables the cache
+TRANSIT_JOURNEY_BUCKET = 5*60
+TRANSIT_JOURNEY_CACHE_SIZE = 0
+
+# transit skims only include trips
+# taking at most this many seconds
+TRANSIT_SKIM_MAX_TIME = 2*60*60
+
+# candidate stops for getting on/off public transit are
+# those within this many seconds' walk, at most this many
+TRANSIT_ACCESS_WALK_MAX = 10*60
+TRANSIT_MAX_CANDIDATE_STOPS = 8
+
+# public transit routing engine, 'csa' or 'raptor',
+# and the most transfers a raptor route may take
+TRANSIT_ENGINE = 'csa'
+TRANSIT_MAX_TRANSFERS = 5
+
+# road routing engine, 'astar' or 'cch' (customizable
+# contraction hierarchy), and for 'cch', how often its
+# weights are refreshed from the live edge travel times,
+# in simulated minutes
+ROAD_ENGINE = 'cch'
+ROAD_CUSTOMIZE_INTERVAL = 5
+
+# landmarks for 'astar' road routing lower bounds
+ROAD_LANDMARKS = 16
+
+# car routes' paths can be cached (and shared by trips between
+# the same start and end edges) per departure time bucket of this
+# many seconds, keeping at most this many paths. 0 disables the cache
+ROAD_ROUTE_BUCKET = 15*60
+ROAD_ROUTE_CACHE_SIZE = 100000
+
+# processes to plan car routes across, None for all cores
+ROAD_PLANNING_PROCESSES = None
+
 WAGE_TO_CAR_OWNERSHIP_QUANTILES = {
     0.0: 0.1174,
     0.1: 0.1429,
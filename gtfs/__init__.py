@@ -3,9 +3,11 @@ import config
 import logging
 import numpy as np
 from . import util
-from tqdm import tqdm
+from .cache import ArtifactStore
 from .calendar import Calendar
-from scipy.spatial import KDTree
+from scipy.spatial import cKDTree
+from .csa import CSA
+from .raptor import Raptor
 from .router import TransitRouter
 
 logger = logging.getLogger(__name__)
@@ -24,28 +26,81 @@ class RouteType(enum.Enum):
 
 
 class Transit:
-    def __init__(self, gtfs_path):
+    # what's saved to/loaded from the artifact store
+    CACHED_OBJECTS = ['calendar', 'trips', 'stops', 'route_types',
+                      'trip_idx', 'stop_idx', 'timetable', 'frequencies']
+    CACHED_ARRAYS = ['connections', 'connection_arr_order', 'hops', 'run_starts',
+                     'trip_run_offsets', 'footpaths', 'footpath_offsets',
+                     'pattern_stops', 'pattern_stop_offsets', 'pattern_runs', 'pattern_run_offsets']
+
+    def __init__(self, gtfs_path, cache=True):
         """
         `closest_indirect_transfers` determines the number of closest stops for which
         indirect (walking) transfers are generated for. if you encounter a lot of
         "no path" errors, you may want to increase this number as it will be more likely
         to link separate routes. but note that it exponentially increases the processing time
         and can drastically increase memory usage.
+
+        if `cache=True`, preprocessed data is saved to/loaded from
+        `config.TRANSIT_CACHE_PATH`, keyed by the GTFS file and config.
         """
-        gtfs = util.load_gtfs(gtfs_path)
-        self.calendar = Calendar(gtfs)
-        self._process_gtfs(gtfs)
-        self._kdtree = self._index_stops(self.stops)
-        self.footpaths = self._compute_footpaths(gtfs, config.CLOSEST_INDIRECT_TRANSFERS)
-        self.connections = self._compute_connections(gtfs)
+        self._csa = None
+        self._raptor = None
+        store = ArtifactStore.for_feed(gtfs_path) if cache else None
+        if store is not None and store.exists():
+            logger.info('Loading cached transit data from {}...'.format(store.path))
+            self._load(store)
+        else:
+            gtfs = util.load_gtfs(gtfs_path, chunksize=config.GTFS_CHUNK_SIZE)
+            self.calendar = Calendar(gtfs)
+            self._process_gtfs(gtfs)
+            self._index_stops()
+            self.footpaths, self.footpath_offsets = self._compute_footpaths(config.CLOSEST_INDIRECT_TRANSFERS)
+            self.connections = self._compute_connections()
+            self._compute_patterns()
+            self._index_stop_patterns()
+            self.trip_starts = self._group_trip_starts()
+            if store is not None:
+                logger.info('Caching transit data to {}...'.format(store.path))
+                self._save(store)
         logger.info('Done')
 
-    def _index_stops(self, stops):
-        """prep kdtree for stop nearest neighbor querying;
-        only consider stops that are in trips"""
+    def _save(self, store):
+        with store:
+            for name in self.CACHED_OBJECTS:
+                store.save_object(name, getattr(self, name))
+            for name in self.CACHED_ARRAYS:
+                store.save_array(name, getattr(self, name))
+
+    def _load(self, store):
+        for name in self.CACHED_OBJECTS:
+            setattr(self, name, store.load_object(name))
+        for name in self.CACHED_ARRAYS:
+            setattr(self, name, store.load_array(name))
+        self.trip_starts = self._group_trip_starts()
+        self._index_timetable()
+        self._index_stops()
+        self._index_stop_patterns()
+
+    def _index_stops(self):
+        """prep kdtree for stop nearest neighbor querying.
+        stops are indexed by their UTM positions, so that
+        distances are in meters"""
         logger.info('Spatial-indexing stops...')
-        stop_coords = stops[['stop_lat', 'stop_lon']].values
-        return KDTree(stop_coords)
+
+        # stop lat, lons, indexed by stop iid
+        self.stop_coords = self.stops[['stop_lat', 'stop_lon']].values
+        lat, lon = self.stop_coords.mean(axis=0)
+        self._proj = util.utm_proj(lat, lon)
+        self.stop_xy = self.to_xy(self.stop_coords)
+        self._kdtree = cKDTree(self.stop_xy)
+
+    def to_xy(self, coords):
+        """project an array of lat, lons
+        to UTM x, ys (in meters)"""
+        coords = np.asarray(coords, dtype=np.float64)
+        x, y = self._proj(coords[..., 1], coords[..., 0])
+        return np.stack([x, y], axis=-1)
 
     def _process_gtfs(self, gtfs):
         logger.info('Processing GTFS data...')
@@ -53,21 +108,20 @@ class Transit:
         self.trips = gtfs['trips'].set_index('trip_id')
         self.stops = gtfs['stops'].set_index('stop_id')
 
-        # TODO TESTING for faster lookups
-        self.stops_list = self.stops.to_dict('records')
-
         self.route_types = {r.route_id: RouteType(r.route_type) for r in gtfs['routes'].itertuples()}
 
         self.trip_idx = util.IntIndex(gtfs['trips']['trip_id'].unique())
         self.stop_idx = util.IntIndex(gtfs['stops']['stop_id'].unique())
 
-        timetable = gtfs['stop_times']
-        changes = timetable.apply(
-            lambda row: (
-                util.gtfs_time_to_secs(row.arrival_time),
-                util.gtfs_time_to_secs(row.departure_time)),
-            axis=1)
-        timetable['arr_sec'], timetable['dep_sec'] = zip(*changes)
+        # for resolving/executing trips
+        self.timetable = gtfs['stop_times']
+        self.frequencies = gtfs['frequencies']
+        self._index_timetable()
+
+    def _index_timetable(self):
+        """derived lookups that are cheap to rebuild
+        and so aren't cached"""
+        timetable = self.timetable
 
         # map trip_id->[stops]
         # sort by stop sequence so we know each trip group
@@ -82,99 +136,276 @@ class Transit:
         # find trips departing from stop x after 10:00:00
         self.stops_trips_sched = timetable.set_index(['stop_id', 'dep_sec']).sort_index(level='dep_sec')
 
-        # for resolving/executing trips
-        self.timetable = timetable
-
         # for determining overall trip start/end times
-        self.freqs = gtfs['frequencies'].groupby('trip_id')
-
-    def _compute_connections(self, gtfs):
+        self.freqs = self.frequencies.groupby('trip_id')
+
+    def _compute_connections(self):
+        """compute the compact connection representation:
+        - `hops`: each trip's consecutive stop pairs, stored once,
+          with times as offsets from the trip's start
+        - `run_starts`: the start time of each vehicle (run) of each trip,
+          grouped by trip, i.e. trip iid `i`'s runs are
+          `run_starts[trip_run_offsets[i]:trip_run_offsets[i+1]]`
+        - `connections`: `(hop, run)` pairs sorted by departure time,
+          i.e. the merged order of every run over every hop of its trip.
+          the actual stops/times are generated from these when scanning
+        - `connection_arr_order`: connection indices sorted by arrival time,
+          for scanning backwards from an arrival time"""
         logger.info('Processing trip frequencies into connections...')
-        connections = []
-        trip_starts = {}
-        freqs = gtfs['frequencies'].groupby('trip_id')
-        for trip_id, spans in tqdm(freqs):
-            cons, starts = self._connections_for_trip(trip_id, spans)
-            connections.extend(cons)
-            trip_starts[trip_id] = starts
-        self.trip_starts = trip_starts
+        timetable = self.timetable
+        freqs = self.frequencies
+
+        # compute start time of each vehicle,
+        # i.e. expand each span into `arange(start, end, headway)`
+        span_trips = self.trip_idx.iids(freqs['trip_id'].values)
+        span_start = freqs['start_sec'].values.astype(np.int64)
+        span_end = freqs['end_sec'].values.astype(np.int64)
+        headway = freqs['headway_secs'].values.astype(np.int64)
+        n_starts = np.maximum(np.ceil((span_end - span_start)/headway), 0).astype(np.int64)
+        span_idx = np.repeat(np.arange(len(freqs)), n_starts)
+        nth = np.arange(n_starts.sum()) - np.repeat(np.cumsum(n_starts) - n_starts, n_starts)
+        starts = span_start[span_idx] + nth * headway[span_idx]
+
+        # group vehicle starts by trip,
+        # keeping spans in their original order
+        order = np.argsort(span_trips[span_idx], kind='mergesort')
+        run_trips = span_trips[span_idx][order]
+        self.run_starts = starts[order].astype(np.int32)
+        n_trips = len(self.trip_idx.id)
+        trip_n_runs = np.bincount(run_trips, minlength=n_trips)
+        self.trip_run_offsets = np.zeros(n_trips+1, dtype=np.uint32)
+        self.trip_run_offsets[1:] = np.cumsum(trip_n_runs)
+        trip_first_run = self.trip_run_offsets[:-1].astype(np.int64)
+
+        # pair consecutive stops of each trip into hops,
+        # sorted by stop sequence
+        tt = timetable.sort_values(['trip_id', 'stop_sequence'], kind='mergesort')
+        trips = self.trip_idx.iids(tt['trip_id'].values)
+        stops = self.stop_idx.iids(tt['stop_id'].values)
+        arr = tt['arr_sec'].values.astype(np.int64)
+        dep = tt['dep_sec'].values.astype(np.int64)
+        is_hop = (trips[1:] == trips[:-1]) & (trips[:-1] >= 0)
+        is_hop &= trip_n_runs[trips[:-1]] > 0
+        hop_dep = np.flatnonzero(is_hop)
+        hop_arr = hop_dep + 1
+        hop_trips = trips[hop_dep]
+
+        # in the Belo Horizonte data, stop arrival/departure times were offset
+        # by the first trip's departure time.
+        # we want it to be relative to t=0 instead
+        first_start = self.run_starts[trip_first_run[hop_trips]]
+        hops = np.empty(len(hop_dep), dtype=util.HOP_DTYPE)
+        hops['trip_id'] = hop_trips
+        hops['dep_stop'] = stops[hop_dep]
+        hops['arr_stop'] = stops[hop_arr]
+        hops['dep_offset'] = dep[hop_dep] - first_start
+        hops['arr_offset'] = arr[hop_arr] - first_start
+        self.hops = hops
+
+        # one connection per hop per vehicle start
+        n_runs = trip_n_runs[hop_trips]
+        hop_idx = np.repeat(np.arange(len(hops), dtype=np.uint32), n_runs)
+        nth = np.arange(n_runs.sum()) - np.repeat(np.cumsum(n_runs) - n_runs, n_runs)
+        runs = (trip_first_run[hop_trips][hop_idx] + nth).astype(np.uint32)
+        dep_times = hops['dep_offset'][hop_idx] + self.run_starts[runs]
 
         # must be sorted by departure time, ascending, for CSA
-        return sorted(connections, key=lambda c: c['dep_time'])
-
-    def _connections_for_trip(self, trip_id, spans):
-        trip_stops = list(self.trip_stops.get_group(trip_id).itertuples())
-        starts, connections = [], []
-
-        # compute start time of each vehicle
-        for span in spans.itertuples():
-            start = util.gtfs_time_to_secs(span.start_time)
-            end = util.gtfs_time_to_secs(span.end_time)
-            starts.extend(np.arange(start, end, span.headway_secs))
-
-        # assuming they are sorted by stop sequence already
-        trip_stops = list(trip_stops)
-        for dep_stop, arr_stop in zip(trip_stops, trip_stops[1:]):
-            dep = dep_stop.dep_sec
-            arr = arr_stop.arr_sec
-
-            # in the Belo Horizonte data, stop arrival/departure times were offset
-            # by the first trip's departure time.
-            # we want it to be relative to t=0 instead
-            arr -= starts[0]
-            dep -= starts[0]
-
-            for start in starts:
-                connections.append({
-                    'arr_time': arr+start,
-                    'dep_time': dep+start,
-                    'arr_stop': self.stop_idx.idx[arr_stop.stop_id],
-                    'dep_stop': self.stop_idx.idx[dep_stop.stop_id],
-                    'trip_id': self.trip_idx.idx[trip_id]
-                })
-        return connections, starts
-
-    def _compute_footpaths(self, gtfs, closest):
+        order = np.argsort(dep_times, kind='mergesort')
+        connections = np.empty(len(order), dtype=util.CONNECTION_DTYPE)
+        connections['hop'] = hop_idx[order]
+        connections['run'] = runs[order]
+
+        arr_times = hops['arr_offset'][hop_idx] + self.run_starts[runs]
+        self.connection_arr_order = np.argsort(arr_times[order], kind='mergesort').astype(np.uint32)
+        return connections
+
+    def _compute_patterns(self):
+        """group trips into route patterns for RAPTOR, i.e. trips
+        that visit the same stops with the same (relative) timings,
+        so that their runs never overtake each other. in CSR form:
+        - `pattern_stops[pattern_stop_offsets[i]:pattern_stop_offsets[i+1]]`:
+          pattern `i`'s stops, in order (see `gtfs.util.PATTERN_STOP_DTYPE`)
+        - `pattern_runs[pattern_run_offsets[i]:pattern_run_offsets[i+1]]`:
+          pattern `i`'s runs (indices into `run_starts`), by start time"""
+        logger.info('Grouping trips into route patterns...')
+        hops = self.hops
+
+        # hops are grouped by trip, in stop order
+        bounds = np.flatnonzero(np.diff(hops['trip_id'])) + 1
+        starts = np.concatenate([[0], bounds]).tolist()
+        ends = np.concatenate([bounds, [len(hops)]]).tolist() if len(hops) else []
+
+        patterns = {}
+        pattern_stops, pattern_trips = [], []
+        for start, end in zip(starts, ends):
+            trip_hops = hops[start:end]
+            stops = np.empty(end - start + 1, dtype=util.PATTERN_STOP_DTYPE)
+            stops['stop'][:-1] = trip_hops['dep_stop']
+            stops['stop'][-1] = trip_hops['arr_stop'][-1]
+
+            # no arrival at the first stop,
+            # nor departure from the last
+            stops['arr_offset'][1:] = trip_hops['arr_offset']
+            stops['arr_offset'][0] = trip_hops['dep_offset'][0]
+            stops['dep_offset'][:-1] = trip_hops['dep_offset']
+            stops['dep_offset'][-1] = trip_hops['arr_offset'][-1]
+
+            key = stops.tobytes()
+            if key not in patterns:
+                patterns[key] = len(pattern_stops)
+                pattern_stops.append(stops)
+                pattern_trips.append([])
+            pattern_trips[patterns[key]].append(int(trip_hops['trip_id'][0]))
+
+        n_patterns = len(pattern_stops)
+        self.pattern_stop_offsets = np.zeros(n_patterns+1, dtype=np.uint32)
+        self.pattern_stop_offsets[1:] = np.cumsum([len(stops) for stops in pattern_stops])
+        self.pattern_stops = np.concatenate(pattern_stops) if pattern_stops \
+            else np.empty(0, dtype=util.PATTERN_STOP_DTYPE)
+
+        # merge the runs of each pattern's trips, by start time
+        pattern_runs = []
+        for trips in pattern_trips:
+            runs = np.concatenate([
+                np.arange(self.trip_run_offsets[t], self.trip_run_offsets[t+1])
+                for t in trips])
+            pattern_runs.append(runs[np.argsort(self.run_starts[runs], kind='mergesort')])
+        self.pattern_run_offsets = np.zeros(n_patterns+1, dtype=np.uint32)
+        self.pattern_run_offsets[1:] = np.cumsum([len(runs) for runs in pattern_runs])
+        self.pattern_runs = np.concatenate(pattern_runs).astype(np.uint32) if pattern_runs \
+            else np.empty(0, dtype=np.uint32)
+
+    def _index_stop_patterns(self):
+        """a signature for each stop of the route patterns it's on,
+        so stops served by the same patterns can be compared.
+        this is a hash of the set of patterns; stops
+        that aren't on any pattern get a unique signature"""
+        n_stops = len(self.stop_xy)
+        n_patterns = len(self.pattern_stop_offsets) - 1
+        rand = np.random.RandomState(0)
+        pattern_hashes = rand.randint(1, 2**63, size=n_patterns, dtype=np.int64).astype(np.uint64)
+        stop_hashes = rand.randint(1, 2**63, size=n_stops, dtype=np.int64).astype(np.uint64)
+
+        patterns = np.repeat(
+            np.arange(n_patterns, dtype=np.int64),
+            np.diff(self.pattern_stop_offsets.astype(np.int64)))
+        pairs = np.unique(self.pattern_stops['stop'].astype(np.int64) * n_patterns + patterns)
+        signatures = np.zeros(n_stops, dtype=np.uint64)
+        np.add.at(signatures, pairs // n_patterns, pattern_hashes[pairs % n_patterns])
+        self.stop_signatures = np.where(signatures == 0, stop_hashes, signatures)
+
+    def _group_trip_starts(self):
+        """map trip_id->[vehicle start times]"""
+        return {
+            self.trip_idx.id[t]: self.run_starts[start:end]
+            for t, (start, end) in enumerate(zip(
+                self.trip_run_offsets[:-1].tolist(),
+                self.trip_run_offsets[1:].tolist()))
+            if end > start}
+
+    def _compute_footpaths(self, closest):
+        """compute footpaths between each stop and its `closest` neighbors,
+        in one pass over all stops. returned in CSR form,
+        i.e. `footpaths[footpath_offsets[i]:footpath_offsets[i+1]]`
+        are the footpaths departing from stop iid `i`"""
         logger.info('Computing footpaths ({} closest)...'.format(closest))
-        footpaths = {}
-        for stop in tqdm(gtfs['stops'].itertuples(), total=len(gtfs['stops'])):
-            coord = stop.stop_lat, stop.stop_lon
-
-            # get closest stops to this one
-            neighbors = self.closest_stops(coord, n=closest+1)
-
-            # skip the first, it's the stop itself
-            neighbors = neighbors[1:]
-
-            # filter out long transfers
-            neighbors = [n for n in neighbors if n[1] <= config.FOOTPATH_DELTA_MAX]
-
-            footpaths[self.stop_idx.idx[stop.stop_id]] = [{
-                'dep_stop': self.stop_idx.idx[stop.stop_id],
-                'arr_stop': self.stop_idx.idx[stop_id],
-                'time': transfer_time
-            } for stop_id, transfer_time in neighbors]
-        return footpaths
+        n_stops = len(self.stop_xy)
+
+        # no point looking further than the longest walk we'd accept
+        max_dist = util.walking_distance(
+            config.FOOTPATH_DELTA_MAX,
+            config.FOOTPATH_DELTA_BASE, config.FOOTPATH_SPEED_KMH)
+
+        # one extra neighbor, since the
+        # stop itself will be among its neighbors
+        k = min(closest+1, n_stops)
+        dists, idxs = self._kdtree.query(self.stop_xy, k=k, distance_upper_bound=max_dist)
+        dists, idxs = dists.reshape(n_stops, k), idxs.reshape(n_stops, k)
+        dep_stops = np.repeat(np.arange(n_stops)[:,None], k, axis=1)
+
+        # drop the stop itself and missing neighbors,
+        # and keep at most `closest` per stop
+        valid = (idxs != dep_stops) & (idxs < n_stops)
+        valid &= np.cumsum(valid, axis=1) <= closest
+
+        footpaths = np.empty(valid.sum(), dtype=util.FOOTPATH_DTYPE)
+        footpaths['dep_stop'] = dep_stops[valid]
+        footpaths['arr_stop'] = idxs[valid]
+        footpaths['time'] = util.walking_times(
+            self.stop_coords[footpaths['dep_stop']],
+            self.stop_coords[footpaths['arr_stop']],
+            config.FOOTPATH_DELTA_BASE, config.FOOTPATH_SPEED_KMH)
+
+        # filter out long transfers
+        footpaths = footpaths[footpaths['time'] <= config.FOOTPATH_DELTA_MAX]
+        offsets = np.zeros(n_stops+1, dtype=np.uint32)
+        offsets[1:] = np.cumsum(np.bincount(footpaths['dep_stop'], minlength=n_stops))
+        return footpaths, offsets
 
     def closest_stops(self, coord, n=5):
         """closest n stop ids for given coord, paired
         with estimated walking time"""
-        # TODO we should probably use UTM positions instead of lat lons
-        # for more accurate distances
-        dists, idxs = self._kdtree.query(coord, k=n)
-
-        # convert indices to stops
-        stops = self.stops.iloc[idxs]
+        dists, idxs = self._kdtree.query(self.to_xy(coord), k=min(n, len(self.stop_xy)))
+        idxs = np.atleast_1d(idxs)
 
         # compute estimated walking times
-        times = [
-            (stop.Index, util.walking_time(
-                coord, (stop.stop_lat, stop.stop_lon),
-                config.FOOTPATH_DELTA_BASE, config.FOOTPATH_SPEED_KMH))
-            for stop in stops.itertuples()]
+        times = util.walking_times(
+            coord, self.stop_coords[idxs],
+            config.FOOTPATH_DELTA_BASE, config.FOOTPATH_SPEED_KMH)
 
         # pair as `(stop_id, time)`
-        return times
+        return [(self.stop_idx.id[i], t) for i, t in zip(idxs.tolist(), times.tolist())]
+
+    def closest_stops_many(self, coords, n=5):
+        """closest n stop iids for each of the given coords,
+        as `(iids, times)` arrays of shape `(len(coords), n)`,
+        where `times` are the estimated walking times"""
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        n = min(n, len(self.stop_xy))
+        _, idxs = self._kdtree.query(self.to_xy(coords), k=n)
+        idxs = idxs.reshape(len(coords), n)
+        times = util.walking_times(
+            np.repeat(coords, n, axis=0), self.stop_coords[idxs.ravel()],
+            config.FOOTPATH_DELTA_BASE, config.FOOTPATH_SPEED_KMH)
+        return idxs, times.reshape(idxs.shape)
+
+    def candidate_stops(self, coords, max_walk=config.TRANSIT_ACCESS_WALK_MAX,
+                        min_stops=1, max_stops=config.TRANSIT_MAX_CANDIDATE_STOPS):
+        """candidate stops to walk to/from for each of the given coords:
+        those within `max_walk` seconds (but at least the `min_stops`
+        closest, and at most the `max_stops` closest), skipping stops
+        served by the same route patterns as a closer candidate.
+        returned in CSR form, as `(iids, times, offsets)`,
+        i.e. coord `i`'s candidates are at `offsets[i]:offsets[i+1]`,
+        closest first, where `times` are the estimated walking times"""
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        n_stops = len(self.stop_xy)
+        k = min(max(min_stops, max_stops), n_stops)
+        max_dist = util.walking_distance(
+            max_walk, config.FOOTPATH_DELTA_BASE, config.FOOTPATH_SPEED_KMH)
+        dists, idxs = self._kdtree.query(self.to_xy(coords), k=k)
+        dists, idxs = dists.reshape(len(coords), k), idxs.reshape(len(coords), k)
+
+        # within walking distance, or among the closest
+        valid = dists <= max_dist
+        valid[:, :min_stops] = True
+
+        # of the candidates on the same patterns,
+        # only keep the closest (first) one
+        rows, cols = np.nonzero(valid)
+        sigs = self.stop_signatures[idxs[rows, cols]]
+        order = np.lexsort((cols, sigs, rows))
+        dominated = np.zeros(len(rows), dtype=bool)
+        dominated[order[1:]] = (rows[order[1:]] == rows[order[:-1]]) & (sigs[order[1:]] == sigs[order[:-1]])
+        rows, cols = rows[~dominated], cols[~dominated]
+
+        iids = idxs[rows, cols].astype(np.uint32)
+        times = util.walking_times(
+            coords[rows], self.stop_coords[iids],
+            config.FOOTPATH_DELTA_BASE, config.FOOTPATH_SPEED_KMH)
+        offsets = np.zeros(len(coords)+1, dtype=np.uint32)
+        offsets[1:] = np.cumsum(np.bincount(rows, minlength=len(coords)))
+        return iids, times, offsets
 
     def trip_type(self, trip_id):
         """return what type of route a trip
@@ -182,7 +413,32 @@ class Transit:
         route_id = self.trips.loc[trip_id]['route_id']
         return self.route_types[route_id]
 
-    def router_for_day(self, dt):
+    @property
+    def csa(self):
+        """connection scan over all connections,
+        shared by the routers for each day"""
+        if self._csa is None:
+            self._csa = CSA(
+                self.connections, self.connection_arr_order, self.hops, self.run_starts,
+                self.footpaths, self.footpath_offsets,
+                config.BASE_TRANSFER_TIME, len(self.stops))
+        return self._csa
+
+    @property
+    def raptor(self):
+        """round-based routing over the route patterns,
+        shared by the routers for each day"""
+        if self._raptor is None:
+            self._raptor = Raptor(
+                self.pattern_stops, self.pattern_stop_offsets,
+                self.pattern_runs, self.pattern_run_offsets,
+                self.run_starts, self.trip_run_offsets,
+                self.footpaths, self.footpath_offsets,
+                config.BASE_TRANSFER_TIME, len(self.stops))
+        return self._raptor
+
+    def router_for_day(self, dt, **kwargs):
         """get a public transit router
-        for the specified day"""
-        return TransitRouter(self, dt)
+        for the specified day (see `TransitRouter`
+        for options)"""
+        return TransitRouter(self, dt, **kwargs)
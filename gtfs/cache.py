@@ -0,0 +1,96 @@
+"""
+on-disk store for preprocessed transit artifacts,
+so that we don't have to rebuild them from the GTFS zip on every run.
+
+- arrays are saved as `.npy` files and loaded memory-mapped (read-only),
+  so separate runs/worker processes share the same pages
+- everything else (dataframes, calendar) is pickled
+
+artifacts are keyed by a hash of the GTFS zip and the
+config values that affect preprocessing.
+"""
+
+import os
+import json
+import config
+import pickle
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# bump when the layout of the stored artifacts changes
+VERSION = 7
+
+# config values that the preprocessed data depends on
+CONFIG_KEYS = [
+    'FOOTPATH_DELTA_BASE',
+    'FOOTPATH_SPEED_KMH',
+    'FOOTPATH_DELTA_MAX',
+    'CLOSEST_INDIRECT_TRANSFERS',
+]
+
+
+def cache_key(gtfs_path, chunk_size=2**20):
+    """hash the GTFS zip contents
+    and relevant config values"""
+    h = hashlib.sha1()
+    with open(gtfs_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    params = {k: getattr(config, k) for k in CONFIG_KEYS}
+    params['version'] = VERSION
+    h.update(json.dumps(params, sort_keys=True).encode('utf8'))
+    return h.hexdigest()
+
+
+class ArtifactStore:
+    """a directory of artifacts for a single key"""
+    def __init__(self, path):
+        self.path = path
+        self._tmp_path = None
+
+    @classmethod
+    def for_feed(cls, gtfs_path, root=config.TRANSIT_CACHE_PATH):
+        return cls(os.path.join(root, cache_key(gtfs_path)))
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def __enter__(self):
+        """write artifacts into a temporary directory,
+        which is moved into place only once everything is written,
+        so readers never see a partial store"""
+        self._tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        os.makedirs(self._tmp_path)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        tmp_path, self._tmp_path = self._tmp_path, None
+        if exc_type is not None:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        try:
+            os.rename(tmp_path, self.path)
+        except OSError:
+            # another process already saved this store
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _file(self, name, ext):
+        return os.path.join(self._tmp_path or self.path, '{}.{}'.format(name, ext))
+
+    def save_array(self, name, arr):
+        np.save(self._file(name, 'npy'), np.ascontiguousarray(arr))
+
+    def load_array(self, name):
+        return np.load(self._file(name, 'npy'), mmap_mode='r')
+
+    def save_object(self, name, obj):
+        with open(self._file(name, 'pkl'), 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_object(self, name):
+        with open(self._file(name, 'pkl'), 'rb') as f:
+            return pickle.load(f)
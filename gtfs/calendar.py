@@ -1,6 +1,7 @@
 import enum
+import numpy as np
 import pandas as pd
-from collections import defaultdict
+from . import util
 
 
 class ServiceChange(enum.Enum):
@@ -21,74 +22,121 @@ class Weekday(enum.Enum):
 
 class Calendar:
     def __init__(self, gtfs):
-        """parse calendar data for service days/changes/exceptions"""
+        """parse calendar data for service days/changes/exceptions
+        into a compiled index:
+        - a weekday x service mask
+        - service changes as (date, service, change) arrays
+        - trip iid -> service iid, and service iid -> trip iids (CSR)
+        - a date x service mask covering the feed's date range
+        so that which trips run on a set of dates (or which dates a trip runs on)
+        are vectorized lookups"""
+        calendar = gtfs['calendar']
+        service_changes = gtfs['calendar_dates']
+        trips = gtfs['trips']
+
+        self.trip_idx = util.IntIndex(trips['trip_id'].unique())
+        self.service_idx = util.IntIndex(pd.unique(np.concatenate([
+            calendar['service_id'].values,
+            service_changes['service_id'].values,
+            trips['service_id'].values])))
+        n_services = len(self.service_idx.id)
+
         # associate services with their operating weekdays
         # NOTE this data provies start and end dates for services
         # but for our simulation we are treating this timetable as ongoing
-        calendar = gtfs['calendar']
-        day_services = {day: [] for day in Weekday}
-        service_days = defaultdict(set)
-        for i, row in calendar.iterrows():
-            service_id = row.service_id
-            for day, services in day_services.items():
-                if row[day.name.lower()] == 1:
-                    services.append(service_id)
-                    service_days[service_id].add(day)
-        self.day_services = day_services
-        self.service_days = dict(service_days)
-
-        # parse 'date' column as date objects
-        # then group by date, so we can quickly query
-        # service changes for a given date
-        service_changes = gtfs['calendar_dates']
-        service_changes['date'] = pd.to_datetime(service_changes.date, format='%Y%m%d').dt.date
-        self.service_changes = service_changes.groupby('date')
+        self.weekday_services = np.zeros((len(Weekday), n_services), dtype=bool)
+        services = self.service_idx.iids(calendar['service_id'].values)
+        for day in Weekday:
+            self.weekday_services[day.value, services] = calendar[day.name.lower()].values == 1
+
+        # service changes, sorted by date
+        dates = pd.to_datetime(service_changes['date'], format='%Y%m%d').values.astype('datetime64[D]')
+        order = np.argsort(dates, kind='mergesort')
+        self.change_dates = dates[order]
+        self.change_services = self.service_idx.iids(service_changes['service_id'].values[order])
+        self.change_added = service_changes['exception_type'].values[order] == ServiceChange.ADDED.value
+
+        # map trip iid->service iid,
+        # and service iid->[trip iids]
+        self.trip_services = self.service_idx.iids(
+            trips.drop_duplicates('trip_id')['service_id'].values)
+        self.service_trips = np.argsort(self.trip_services, kind='mergesort')
+        self.service_trip_offsets = np.zeros(n_services+1, dtype=np.int64)
+        self.service_trip_offsets[1:] = np.cumsum(np.bincount(self.trip_services, minlength=n_services))
+
+        # compile the date x service mask for the feed's date range
+        bounds = np.concatenate([
+            pd.to_datetime(calendar['start_date'], format='%Y%m%d').values.astype('datetime64[D]'),
+            pd.to_datetime(calendar['end_date'], format='%Y%m%d').values.astype('datetime64[D]'),
+            self.change_dates])
+        if len(bounds):
+            self.dates = np.arange(bounds.min(), bounds.max() + np.timedelta64(1, 'D'))
+        else:
+            self.dates = np.array([], dtype='datetime64[D]')
+        self.date_services = self.service_mask(self.dates)
+
+    def service_mask(self, dates):
+        """returns a `(len(dates), n_services)` mask
+        of services operating on each of the given dates"""
+        dates, inverse = np.unique(np.asarray(dates, dtype='datetime64[D]'), return_inverse=True)
+        if not len(dates):
+            return self.weekday_services[:0]
+
+        # gives weekday as an int,
+        # where `monday = 0` (1970-01-01 was a thursday)
+        weekdays = (dates.astype(np.int64) + 3) % 7
+        mask = self.weekday_services[weekdays]
+
+        # apply any service changes for the dates
+        rows = np.minimum(np.searchsorted(dates, self.change_dates), len(dates)-1)
+        changed = dates[rows] == self.change_dates
+        mask[rows[changed], self.change_services[changed]] = self.change_added[changed]
+        return mask[inverse.ravel()]
+
+    def trip_mask(self, dates):
+        """returns a `(len(dates), n_trips)` mask
+        of trips (by iid) operating on each of the given dates"""
+        return self.service_mask(dates)[:, self.trip_services]
+
+    def trip_mask_for_dt(self, dt):
+        """returns a mask of trips (by iid)
+        operating for a given datetime"""
+        return self.trip_mask([dt.date()])[0]
 
-        # map service_id->[trip_ids]
-        self.services = {
-            name: group['trip_id'].values
-            for name, group in gtfs['trips'].groupby('service_id')}
+    def dates_for_trip(self, trip_id):
+        """returns the dates in the feed's
+        date range that a trip operates on"""
+        service = self.trip_services[self.trip_idx.idx[trip_id]]
+        return self.dates[self.date_services[:, service]]
 
     def services_for_dt(self, dt):
          """returns operating service ids
          for a given datetime"""
-         # gives weekday as an int,
-         # where `monday = 0`
-         weekday = Weekday(dt.weekday())
-
-         # get list of service ids as a copy
-         # so we can add/remove according to service changes
-         services = self.day_services[weekday][:]
-
-         # check if there are any service changes for the date
-         for service_id, change in self.service_changes_for_dt(dt).items():
-             if change is ServiceChange.ADDED:
-                 services.append(service_id)
-             else:
-                 try:
-                     services.remove(service_id)
-                 except ValueError:
-                     pass
-         return services
+         services = np.flatnonzero(self.service_mask([dt.date()])[0])
+         return [self.service_idx.id[s] for s in services.tolist()]
 
     def service_changes_for_dt(self, dt):
          """return a dict of `{service_id: ServiceChange}`
          describing service changes (additions or removals
          for a given datetime"""
-         try:
-             changes = self.service_changes.get_group(dt.date())
-             return {c.service_id: ServiceChange(c.exception_type) for i, c in changes.iterrows()}
-         except KeyError:
-             return {}
+         date = np.datetime64(dt.date(), 'D')
+         start, end = np.searchsorted(self.change_dates, [date, date + np.timedelta64(1, 'D')])
+         return {
+             self.service_idx.id[s]: ServiceChange.ADDED if added else ServiceChange.REMOVED
+             for s, added in zip(
+                 self.change_services[start:end].tolist(),
+                 self.change_added[start:end].tolist())}
 
     def trips_for_services(self, service_ids):
          """get trip ids that encompass a given list of service ids"""
-         trips = set()
-         for service_id in service_ids:
-             trip_ids = self.services.get(service_id, [])
-             trips = trips | set(trip_ids)
-         return trips
+         services = self.service_idx.iids(list(service_ids))
+         services = services[services >= 0]
+         trips = [self.service_trips[self.service_trip_offsets[s]:self.service_trip_offsets[s+1]]
+                  for s in services.tolist()]
+         if not trips:
+             return set()
+         return {self.trip_idx.id[t] for t in np.concatenate(trips).tolist()}
 
     def trips_for_day(self, dt):
         """returns trip ids operating for a day"""
-        return self.trips_for_services(self.services_for_dt(dt))
+        return {self.trip_idx.id[t] for t in np.flatnonzero(self.trip_mask_for_dt(dt)).tolist()}
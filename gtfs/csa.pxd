@@ -0,0 +1,29 @@
+# cython: legacy_implicit_noexcept=True
+# types and helpers shared with the other
+# routing engines (see `gtfs.raptor`)
+
+from libcpp.vector cimport vector
+
+ctypedef unsigned int Stop
+
+ctypedef enum ConnectionType:
+    # `access` connections seed the scan, i.e.
+    # walking from the origin to a start stop
+    empty, trip, foot, access
+
+ctypedef struct Leg:
+    Stop dep_stop
+    double dep_time
+    Stop arr_stop
+    double arr_time
+    ConnectionType type
+    int trip_id
+    unsigned int n_stops
+
+ctypedef struct Route:
+    vector[Leg] path
+    double time
+
+cdef Leg make_walk_leg(Stop dep_stop, double dep_time, Stop arr_stop, double arr_time, ConnectionType type) nogil
+cdef Route make_route() nogil
+cdef pack_legs(vector[Route]& routes, bint reverse)
@@ -1,18 +1,16 @@
 # distutils: language=c++
+# cython: boundscheck=False, wraparound=False, legacy_implicit_noexcept=True
 # TODO: Multicritera CSA (mcCSA)
 # CSA: <http://i11www.iti.kit.edu/extra/publications/dpsw-isftr-13.pdf>
 # Reference implementation: <https://github.com/dbsystel/practical-csa/tree/master/src/main/scala/algorithm>
 
+import numpy as np
 from libcpp cimport bool
 from libcpp.vector cimport vector
-from libcpp.map cimport map
 from numpy.math cimport INFINITY
-from cython.parallel import prange
-
-ctypedef unsigned int Stop
-
-ctypedef enum ConnectionType:
-    empty, trip, foot
+from cython.parallel import prange, threadid
+cimport openmp
+from .util import LEG_DTYPE
 
 ctypedef struct Connection:
     Stop dep_stop
@@ -21,153 +19,1025 @@ ctypedef struct Connection:
     double arr_time
     ConnectionType type
     int trip_id
+    int run
 
-ctypedef struct Leg:
-    Stop dep_stop
+# an entry in a stop's profile: leaving `stop` at `dep_time`
+# gets to the destination by `arr_time`, by boarding the
+# `enter` connection (after walking `walk` seconds, if this
+# is a footpath entry) and staying on until the `exit` connection
+ctypedef struct ProfileEntry:
+    Stop stop
     double dep_time
-    Stop arr_stop
     double arr_time
-    ConnectionType type
-    int trip_id
-    unsigned int n_stops
+    size_t enter
+    size_t exit
+    double walk
 
-ctypedef struct Footpath:
-    Stop dep_stop
-    Stop arr_stop
-    double time
+# a run's best arrival at the destination
+# if we stay on it, and where to get off
+ctypedef struct RunProfile:
+    double arr_time
+    size_t exit
+
+# reusable buffers for scans, so that queries
+# don't allocate. only the entries a query touches are
+# reset after it, so resetting doesn't cost `O(n_stops)`
+ctypedef struct Scratch:
+    # by stop: the leg that gets there the earliest (forward scans)
+    # or that leaves it the latest (backward scans)
+    vector[Leg] legs
+
+    # by stop: the leg that lets us board a vehicle there the earliest
+    # (forward scans) or get off one there the latest (backward scans).
+    # this may not be `legs`, since changing vehicles takes a transfer,
+    # but walking doesn't
+    vector[Leg] transfer_legs
+
+    # by stop: the leg that gets there the earliest on a vehicle,
+    # or from the origin (forward scans), or that leaves it the latest
+    # on a vehicle, or to the destination (backward scans).
+    # only these are walked on from, since footpaths aren't transitive
+    vector[Leg] vehicle_legs
+
+    # by stop, for forward scans: earliest arrival there,
+    # the earliest time we can board a vehicle there,
+    # and the earliest arrival there on a vehicle
+    vector[double] earliest_arrivals
+    vector[double] earliest_boardings
+    vector[double] vehicle_arrivals
+
+    # by stop, for backward scans: latest departure from there,
+    # the latest time a vehicle can drop us off there,
+    # and the latest departure from there on a vehicle
+    vector[double] latest_departures
+    vector[double] latest_alightings
+    vector[double] vehicle_departures
+
+    # by stop: time to walk between it and the destination
+    # (forward scans) or origin (backward scans)
+    vector[double] walks
+
+    # by run: whether we've reached it, and at which
+    # connection we boarded it (forward scans)
+    # or get off it (backward scans)
+    vector[bool] reached
+    vector[size_t] run_enters
+
+    vector[Stop] touched_stops
+    vector[unsigned int] touched_runs
+
+# route components, as returned by `finish_routes`.
+# stops and trips are iids
+cdef class WalkLeg:
+    cdef readonly double time
+
+    def __init__(self, double time):
+        self.time = time
+
+    def __repr__(self):
+        return 'WalkLeg(time={!r})'.format(self.time)
+
+    def __eq__(self, other):
+        return isinstance(other, WalkLeg) and self.time == other.time
+
+    def __hash__(self):
+        return hash(self.time)
+
+
+cdef class TransitLeg:
+    cdef readonly Stop dep_stop, arr_stop
+    cdef readonly double dep_time, arr_time
+    cdef readonly int trip_id
+
+    def __init__(self, Stop dep_stop, Stop arr_stop, double dep_time, double arr_time, int trip_id):
+        self.dep_stop = dep_stop
+        self.arr_stop = arr_stop
+        self.dep_time = dep_time
+        self.arr_time = arr_time
+        self.trip_id = trip_id
+
+    def __repr__(self):
+        return 'TransitLeg(dep_stop={!r}, arr_stop={!r}, dep_time={!r}, arr_time={!r}, trip_id={!r})'.format(
+            self.dep_stop, self.arr_stop, self.dep_time, self.arr_time, self.trip_id)
+
+    def __eq__(self, other):
+        return isinstance(other, TransitLeg) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def _key(self):
+        return self.dep_stop, self.arr_stop, self.dep_time, self.arr_time, self.trip_id
+
+
+cdef class TransferLeg:
+    cdef readonly Stop dep_stop, arr_stop
+    cdef readonly double time
+
+    def __init__(self, Stop dep_stop, Stop arr_stop, double time):
+        self.dep_stop = dep_stop
+        self.arr_stop = arr_stop
+        self.time = time
+
+    def __repr__(self):
+        return 'TransferLeg(dep_stop={!r}, arr_stop={!r}, time={!r})'.format(
+            self.dep_stop, self.arr_stop, self.time)
+
+    def __eq__(self, other):
+        return isinstance(other, TransferLeg) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def _key(self):
+        return self.dep_stop, self.arr_stop, self.time
+
+
+cdef class ConnectionTree:
+    """the result of a one-to-all query (see `CSA.tree`):
+    the earliest arrival at every stop, and the connection
+    that gets there, departing from a stop at `dep_time`"""
+    cdef:
+        vector[Leg] in_legs
+        vector[Leg] transfer_legs
+        vector[Leg] vehicle_legs
+        vector[double] earliest_arrivals
+        readonly double dep_time
+
+    @property
+    def arrival_times(self):
+        """earliest arrival times, by stop iid"""
+        return np.array(self.earliest_arrivals, dtype=np.float64)
+
+    def route(self, vector[unsigned int] ends, vector[double] end_walks, dep_time=None):
+        """best route to any of the `ends` stops, where getting
+        from each to the destination takes `end_walks` seconds.
+        returns `(arr_time, legs)`, with legs as in `CSA.route_batch`,
+        where `arr_time` is `inf` if there's no route.
+
+        if `dep_time` (no earlier than the tree's) is given, the route
+        leaves the start then instead. if the tree's best route would
+        have to leave earlier, the tree can't tell the best route
+        from `dep_time`, and `(nan, None)` is returned"""
+        cdef:
+            vector[Route] routes
+            double shift = 0
+            size_t i, j
+            Leg l
+        routes.push_back(best_route(
+            ends.data(), end_walks.data(), ends.size(), self.dep_time,
+            self.in_legs, self.transfer_legs, self.vehicle_legs, self.earliest_arrivals))
+        if dep_time is not None:
+            shift = dep_time - self.dep_time
+        if shift > 0 and routes[0].time < INFINITY:
+            # the first boarding must be reachable
+            # from `dep_time`; the path is backward
+            i = routes[0].path.size()
+            while i > 0 and routes[0].path[i-1].type != ConnectionType.trip:
+                i -= 1
+            if i > 0:
+                l = routes[0].path[i-1]
+                if self.transfer_legs[l.dep_stop].arr_time + shift > l.dep_time:
+                    return np.nan, None
+
+                # the walks to it leave at `dep_time`
+                for j in range(i, routes[0].path.size()):
+                    routes[0].path[j].dep_time += shift
+                    routes[0].path[j].arr_time += shift
+
+            # walking only, a later transit
+            # route could get there sooner
+            elif routes[0].path.size():
+                return np.nan, None
+
+            # already at an end stop
+            else:
+                routes[0].time += shift
+        legs, _ = pack_legs(routes, True)
+        return self.dep_time + routes[0].time, legs
 
-ctypedef struct Route:
-    vector[Leg] path
-    double time
 
 cdef class CSA:
     cdef:
         unsigned int n_stops
         double base_transfer_time
-        Connection no_connection
-        vector[Connection] connections
-        vector[vector[Footpath]] footpaths
 
-    def __init__(self, list connections, dict footpaths, double base_transfer_time, unsigned int n_stops):
-        # NOTE: this assumes that connections is sorted by dep time, ascending
+        # scan buffers, one per thread.
+        # NOTE this means a CSA can't be queried from
+        # multiple python threads at once; use `route_batch`
+        vector[Scratch] scratch
+
+        # the connection table and the hops/runs it refers to
+        # are kept as views into the (possibly memory-mapped) arrays,
+        # rather than copied, so that processes loading the same
+        # arrays share their pages
+        object _connections, _hops, _arr_order
+        const unsigned int[:] con_hops
+        const unsigned int[:] con_runs
+
+        # connection indices, sorted by arrival time
+        const unsigned int[:] arr_order
+        const int[:] hop_trips
+        const unsigned int[:] hop_dep_stops
+        const unsigned int[:] hop_arr_stops
+        const int[:] hop_dep_offsets
+        const int[:] hop_arr_offsets
+        const int[:] run_starts
+
+        # footpaths in CSR form, i.e. footpaths departing from stop `i`
+        # are at `footpath_offsets[i]:footpath_offsets[i+1]`
+        object _footpaths
+        const unsigned int[:] footpath_offsets
+        const unsigned int[:] footpath_arr_stops
+        const double[:] footpath_times
+
+        # and reversed, i.e. footpaths arriving at stop `i`
+        # are at `in_footpath_offsets[i]:in_footpath_offsets[i+1]`,
+        # for scanning backwards
+        const unsigned int[:] in_footpath_offsets
+        const unsigned int[:] in_footpath_dep_stops
+        const double[:] in_footpath_times
+
+    def __init__(self, connections, arr_order, hops, run_starts, footpaths, footpath_offsets, double base_transfer_time, unsigned int n_stops):
+        # NOTE: this assumes that connections is a structured array
+        # (see `gtfs.util.CONNECTION_DTYPE`) sorted by dep time, ascending,
+        # that `arr_order` sorts them by arrival time, ascending,
+        # and that footpaths (see `gtfs.util.FOOTPATH_DTYPE`) are sorted by dep stop
         self.n_stops = n_stops
-        self.connections.reserve(len(connections))
         self.base_transfer_time = base_transfer_time
-        for con in connections:
-            con['type'] = ConnectionType.trip
-            self.connections.push_back(con)
+        self._connections = connections
+        self.con_hops = connections['hop']
+        self.con_runs = connections['run']
+        self._arr_order = arr_order
+        self.arr_order = arr_order
+
+        self._hops = hops
+        self.hop_trips = hops['trip_id']
+        self.hop_dep_stops = hops['dep_stop']
+        self.hop_arr_stops = hops['arr_stop']
+        self.hop_dep_offsets = hops['dep_offset']
+        self.hop_arr_offsets = hops['arr_offset']
+        self.run_starts = run_starts
 
-        self.footpaths.reserve(len(footpaths))
-        self.footpaths.assign(len(footpaths), [])
-        for stop, fps in footpaths.items():
-            self.footpaths[stop] = fps
+        self._footpaths = footpaths
+        self.footpath_offsets = footpath_offsets
+        self.footpath_arr_stops = footpaths['arr_stop']
+        self.footpath_times = footpaths['time']
 
-        self.no_connection.type = ConnectionType.empty
+        order = np.argsort(footpaths['arr_stop'], kind='mergesort')
+        in_offsets = np.zeros(n_stops+1, dtype=np.uint32)
+        in_offsets[1:] = np.cumsum(np.bincount(footpaths['arr_stop'], minlength=n_stops))
+        self.in_footpath_offsets = in_offsets
+        self.in_footpath_dep_stops = np.ascontiguousarray(footpaths['dep_stop'][order])
+        self.in_footpath_times = np.ascontiguousarray(footpaths['time'][order])
+
+        self.reserve_scratch(openmp.omp_get_max_threads())
 
     @property
     def n_connections(self):
-        return self.connections.size()
+        return self.con_hops.shape[0]
+
+    cdef void reserve_scratch(self, size_t n):
+        # make sure there are scan buffers for `n` threads
+        cdef size_t i = self.scratch.size()
+        if i >= n: return
+        self.scratch.resize(n)
+        for i in range(i, n):
+            self.scratch[i].legs.resize(self.n_stops)
+            self.scratch[i].transfer_legs.resize(self.n_stops)
+            self.scratch[i].vehicle_legs.resize(self.n_stops)
+            self.scratch[i].earliest_arrivals.assign(self.n_stops, INFINITY)
+            self.scratch[i].earliest_boardings.assign(self.n_stops, INFINITY)
+            self.scratch[i].vehicle_arrivals.assign(self.n_stops, INFINITY)
+            self.scratch[i].latest_departures.assign(self.n_stops, -INFINITY)
+            self.scratch[i].latest_alightings.assign(self.n_stops, -INFINITY)
+            self.scratch[i].vehicle_departures.assign(self.n_stops, -INFINITY)
+            self.scratch[i].walks.assign(self.n_stops, INFINITY)
+            self.scratch[i].reached.assign(self.run_starts.shape[0], False)
+            self.scratch[i].run_enters.resize(self.run_starts.shape[0])
+
+    cdef inline double connection_dep_time(self, size_t i) nogil:
+        return self.run_starts[self.con_runs[i]] + self.hop_dep_offsets[self.con_hops[i]]
+
+    cdef size_t first_connection(self, double dep_time) nogil:
+        # connections are sorted by departure time, so binary
+        # search for the first departing at or after `dep_time`
+        cdef:
+            size_t lo = 0
+            size_t hi = self.con_hops.shape[0]
+            size_t mid
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.connection_dep_time(mid) < dep_time:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    cdef inline double connection_arr_time(self, size_t i) nogil:
+        return self.run_starts[self.con_runs[i]] + self.hop_arr_offsets[self.con_hops[i]]
+
+    cdef size_t n_arriving_by(self, double arr_time) nogil:
+        # binary search for the number of
+        # connections arriving at or before `arr_time`
+        cdef:
+            size_t lo = 0
+            size_t hi = self.arr_order.shape[0]
+            size_t mid
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.connection_arr_time(self.arr_order[mid]) <= arr_time:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    cdef inline Connection connection(self, size_t i) nogil:
+        # generate the i-th connection from its hop and run
+        cdef:
+            unsigned int hop = self.con_hops[i]
+            unsigned int run = self.con_runs[i]
+            double start = self.run_starts[run]
+        return make_connection(
+            self.hop_dep_stops[hop],
+            start + self.hop_dep_offsets[hop],
+            self.hop_arr_stops[hop],
+            start + self.hop_arr_offsets[hop],
+            ConnectionType.trip,
+            self.hop_trips[hop],
+            run)
 
-    cdef Route route(self, unsigned int start, unsigned int end, double dep_time, double walk_time) nogil:
+    cpdef Route route(self,
+                      vector[unsigned int] starts, vector[double] start_walks,
+                      vector[unsigned int] ends, vector[double] end_walks,
+                      double dep_time, const unsigned char[:] active_trips):
+        """best route from any of the `starts` stops to any of the `ends` stops,
+        where reaching each start/end stop from the actual origin/destination
+        takes `start_walks`/`end_walks` seconds.
+        `active_trips` is a mask over trip iids;
+        connections of inactive trips are skipped"""
+        with nogil:
+            return self._route(
+                &self.scratch[0],
+                starts.data(), start_walks.data(), starts.size(),
+                ends.data(), end_walks.data(), ends.size(),
+                dep_time, &active_trips[0])
+
+    def route_batch(self,
+                    const unsigned int[:] starts, const double[:] start_walks, const unsigned int[:] start_offsets,
+                    const unsigned int[:] ends, const double[:] end_walks, const unsigned int[:] end_offsets,
+                    const double[:] dep_times, const unsigned char[:] active_trips, bint parallel=True):
+        """run many queries at once, in parallel.
+        query `i`'s start stops are at `start_offsets[i]:start_offsets[i+1]`
+        (and likewise for its end stops), departing at `dep_times[i]`.
+        returns `(times, legs, leg_offsets)`, where query `i`'s
+        legs (see `gtfs.util.LEG_DTYPE`), in order from start to end,
+        are at `leg_offsets[i]:leg_offsets[i+1]`,
+        and its time is `inf` if no route was found"""
+        cdef:
+            Py_ssize_t i
+            Py_ssize_t n = dep_times.shape[0]
+            vector[Route] results
+        results.resize(n)
+        self.reserve_scratch(openmp.omp_get_max_threads())
+        if parallel:
+            for i in prange(n, nogil=True, schedule='dynamic'):
+                results[i] = self._route(
+                    &self.scratch[threadid()],
+                    &starts[0] + start_offsets[i], &start_walks[0] + start_offsets[i], start_offsets[i+1] - start_offsets[i],
+                    &ends[0] + end_offsets[i], &end_walks[0] + end_offsets[i], end_offsets[i+1] - end_offsets[i],
+                    dep_times[i], &active_trips[0])
+        else:
+            with nogil:
+                for i in range(n):
+                    results[i] = self._route(
+                        &self.scratch[0],
+                        &starts[0] + start_offsets[i], &start_walks[0] + start_offsets[i], start_offsets[i+1] - start_offsets[i],
+                        &ends[0] + end_offsets[i], &end_walks[0] + end_offsets[i], end_offsets[i+1] - end_offsets[i],
+                        dep_times[i], &active_trips[0])
+
+        times = np.empty(n)
+        cdef double[:] route_times = times
+        for i in range(n):
+            route_times[i] = results[i].time
+
+        # route paths are backward
+        legs, offsets = pack_legs(results, True)
+        return times, legs, offsets
+
+    cdef Route _route(self, Scratch* s,
+                      const unsigned int* starts, const double* start_walks, size_t n_starts,
+                      const unsigned int* ends, const double* end_walks, size_t n_ends,
+                      double dep_time, const unsigned char* active_trips) nogil:
+        cdef:
+            size_t i
+            Route route
+            double min_egress = INFINITY
+
+        for i in range(n_ends):
+            s.walks[ends[i]] = min(s.walks[ends[i]], end_walks[i])
+            min_egress = min(min_egress, end_walks[i])
+
+        self.scan(s, starts, start_walks, n_starts, dep_time, active_trips, min_egress)
+        route = best_route(
+            ends, end_walks, n_ends, dep_time,
+            s.legs, s.transfer_legs, s.vehicle_legs, s.earliest_arrivals)
+
+        for i in range(n_ends):
+            s.walks[ends[i]] = INFINITY
+        reset(s)
+        return route
+
+    def route_by_arrival_batch(self,
+                               const unsigned int[:] starts, const double[:] start_walks, const unsigned int[:] start_offsets,
+                               const unsigned int[:] ends, const double[:] end_walks, const unsigned int[:] end_offsets,
+                               const double[:] arr_times, const unsigned char[:] active_trips, bint parallel=True):
+        """like `route_batch`, but finds the routes that depart the latest
+        while still getting to the destination by `arr_times`,
+        each with a single backward scan (by arrival time).
+        returns `(dep_times, times, legs, leg_offsets)`, where `times`
+        are from departure to actual arrival, and `dep_times`
+        are `-inf` where no route was found"""
         cdef:
+            Py_ssize_t i
+            Py_ssize_t n = arr_times.shape[0]
+            vector[Route] results
+        results.resize(n)
+        dep_times = np.empty(n)
+        cdef double[:] route_dep_times = dep_times
+        self.reserve_scratch(openmp.omp_get_max_threads())
+        if parallel:
+            for i in prange(n, nogil=True, schedule='dynamic'):
+                results[i] = self._route_by_arrival(
+                    &self.scratch[threadid()],
+                    &starts[0] + start_offsets[i], &start_walks[0] + start_offsets[i], start_offsets[i+1] - start_offsets[i],
+                    &ends[0] + end_offsets[i], &end_walks[0] + end_offsets[i], end_offsets[i+1] - end_offsets[i],
+                    arr_times[i], &active_trips[0], &route_dep_times[i])
+        else:
+            with nogil:
+                for i in range(n):
+                    results[i] = self._route_by_arrival(
+                        &self.scratch[0],
+                        &starts[0] + start_offsets[i], &start_walks[0] + start_offsets[i], start_offsets[i+1] - start_offsets[i],
+                        &ends[0] + end_offsets[i], &end_walks[0] + end_offsets[i], end_offsets[i+1] - end_offsets[i],
+                        arr_times[i], &active_trips[0], &route_dep_times[i])
+
+        times = np.empty(n)
+        cdef double[:] route_times = times
+        for i in range(n):
+            route_times[i] = results[i].time
+        legs, offsets = pack_legs(results, False)
+        return dep_times, times, legs, offsets
+
+    cdef Route _route_by_arrival(self, Scratch* s,
+                                 const unsigned int* starts, const double* start_walks, size_t n_starts,
+                                 const unsigned int* ends, const double* end_walks, size_t n_ends,
+                                 double arr_time, const unsigned char* active_trips, double* dep_time) nogil:
+        # mirrors `scan`, with time reversed:
+        # scan connections by arrival time, descending,
+        # tracking the latest we can leave each stop
+        cdef:
+            size_t i, k
+            Connection c
+            Leg l
             Route route = make_route()
-            vector[Connection] in_connections
-            vector[Leg] path
+            double min_access = INFINITY
+            double best = -INFINITY
+            unsigned int best_start
+
+        for i in range(n_starts):
+            s.walks[starts[i]] = min(s.walks[starts[i]], start_walks[i])
+            min_access = min(min_access, start_walks[i])
+
+        # seed every candidate end stop with the time it takes to walk from it
+        for i in range(n_ends):
+            reach_back_by_vehicle(s, make_walk_leg(ends[i], arr_time - end_walks[i], ends[i], arr_time, ConnectionType.access))
+        for i in range(n_ends):
+            self.expand_footpaths_back(s, s.vehicle_legs[ends[i]])
+
+        # skip connections arriving after our arrival time
+        k = self.n_arriving_by(arr_time)
+        while k > 0:
+            k -= 1
+            i = self.arr_order[k]
+            c = self.connection(i)
+
+            # if even walking straight from the origin to this
+            # connection's arrival is no later than our best departure,
+            # no earlier arriving connection can improve on it, so we're done
+            if best > -INFINITY and c.arr_time - min_access <= best: break
+
+            # skip connections of trips that aren't running
+            if not active_trips[c.trip_id]: continue
 
-        in_connections = self._route(start, end, dep_time)
+            # we can take c if we're staying on its vehicle
+            # after it, or can get off it in time
+            if not s.reached[c.run]:
+                if c.arr_time > s.latest_alightings[c.arr_stop]: continue
+                s.reached[c.run] = True
+                s.run_enters[c.run] = i
+                s.touched_runs.push_back(c.run)
 
-        if in_connections.empty():
-            return route
+            # check if it improves the departure time from its stop by vehicle
+            # (see `scan`)
+            if c.dep_time > s.vehicle_departures[c.dep_stop]:
+                l = make_leg(c, self.connection(s.run_enters[c.run]), self.con_hops[s.run_enters[c.run]] - self.con_hops[i] + 1)
+                reach_back_by_vehicle(s, l, self.base_transfer_time)
+                self.expand_footpaths_back(s, l)
+                best = max(best, c.dep_time - s.walks[c.dep_stop])
 
-        # NOTE this route is backward
-        path = build_route(start, end, in_connections)
-        route.path = path
-        route.time = path[0].arr_time - dep_time + walk_time
+        # settle on the start stop with the latest departure, including access
+        best = -INFINITY
+        for i in range(n_starts):
+            if s.latest_departures[starts[i]] - start_walks[i] > best \
+                    and s.legs[starts[i]].type != ConnectionType.access:
+                best = s.latest_departures[starts[i]] - start_walks[i]
+                best_start = starts[i]
+
+        dep_time[0] = best
+        if best > -INFINITY:
+            # build out the route, following legs
+            # until we reach the (seed) egress leg
+            l = s.legs[best_start]
+            while l.type != ConnectionType.access:
+                route.path.push_back(l)
+                l = next_leg(l, s.transfer_legs, s.vehicle_legs)
+
+            # the time to the actual arrival,
+            # i.e. not waiting around for `arr_time`
+            route.time = route.path.back().arr_time + (l.arr_time - l.dep_time) - best
+
+        for i in range(n_starts):
+            s.walks[starts[i]] = INFINITY
+        reset(s)
         return route
 
-    cdef vector[Connection] _route(self, unsigned int start, unsigned int end, double dep_time) nogil:
+    def tree(self, unsigned int start, double dep_time, const unsigned char[:] active_trips):
+        """one-to-all query: earliest arrivals at every stop departing
+        from the `start` stop at `dep_time`, as a `ConnectionTree`,
+        from which routes to any stops can be extracted without another scan.
+        `active_trips` is as in `route`"""
+        cdef:
+            ConnectionTree tree = ConnectionTree.__new__(ConnectionTree)
+            Scratch* s = &self.scratch[0]
+            double walk = 0
+        tree.dep_time = dep_time
+
+        # no destination, so scan everything after dep_time
+        with nogil:
+            self.scan(s, &start, &walk, 1, dep_time, &active_trips[0], INFINITY)
+            tree.in_legs = s.legs
+            tree.transfer_legs = s.transfer_legs
+            tree.vehicle_legs = s.vehicle_legs
+            tree.earliest_arrivals = s.earliest_arrivals
+            reset(s)
+        return tree
+
+    cdef void scan(self, Scratch* s,
+                   const unsigned int* starts, const double* start_walks, size_t n_starts,
+                   double dep_time, const unsigned char* active_trips, double min_egress,
+                   double until=INFINITY) nogil:
+        # fill in the earliest arrival at each stop, and the leg that
+        # gets there, departing from the `starts` stops at `dep_time`.
+        # if `s.walks` has times to the destination, stops as soon as
+        # no later connection could get there sooner.
+        # connections departing at or after `until` aren't scanned
         cdef:
+            size_t i
+            size_t n = self.con_hops.shape[0]
             Connection c
-            vector[Connection] in_connections
-            vector[double] earliest_arrivals
-            double earliest = INFINITY
-
-        # initialize vectors
-        in_connections.assign(self.n_stops, self.no_connection)
-        earliest_arrivals.assign(self.n_stops, INFINITY)
-        earliest_arrivals[start] = dep_time
-
-        for c in self.connections:
-            # skip connections departing before our departure time
-            if c.dep_time < dep_time: continue
-
-            # check if c is reachable given current connections,
-            # and if so, check if it improves current arrival times
-            if is_reachable(c, start, earliest_arrivals[c.dep_stop], in_connections[c.dep_stop], self.base_transfer_time) \
-                and c.arr_time < earliest_arrivals[c.arr_stop]:
-                in_connections[c.arr_stop] = c
-                earliest_arrivals[c.arr_stop] = c.arr_time
-                expand_footpaths(c, self.footpaths[c.arr_stop], in_connections)
-                if c.arr_stop == end:
-                    earliest = min(earliest, c.arr_time)
-
-            # if this connection arrives after our best so far, we're done
-            elif c.arr_time > earliest:
-                break
+            Leg l
+            double best = INFINITY
+
+        # seed every candidate start stop with the time it takes to walk to it
+        for i in range(n_starts):
+            reach_by_vehicle(s, make_walk_leg(starts[i], dep_time, starts[i], dep_time + start_walks[i], ConnectionType.access))
+        for i in range(n_starts):
+            self.expand_footpaths(s, s.vehicle_legs[starts[i]])
+
+        # skip connections departing before our departure time
+        for i in range(self.first_connection(dep_time), n):
+            c = self.connection(i)
+
+            # if even walking straight from this connection's departure
+            # to the closest end stop is no better than our best so far,
+            # no later connection can improve on it either, so we're done
+            if best < INFINITY and c.dep_time + min_egress >= best: break
+            if c.dep_time >= until: break
+
+            # skip connections of trips that aren't running
+            if not active_trips[c.trip_id]: continue
 
-        if earliest_arrivals[end] == INFINITY:
-            in_connections.clear()
+            # we can take c if we're already on its vehicle,
+            # or can board it in time
+            if not s.reached[c.run]:
+                if c.dep_time < s.earliest_boardings[c.dep_stop]: continue
+                s.reached[c.run] = True
+                s.run_enters[c.run] = i
+                s.touched_runs.push_back(c.run)
 
-        return in_connections
+            # check if it improves the arrival time at its stop by vehicle,
+            # even if walking gets there sooner, since we can only walk on
+            # from a vehicle, and boarding after walking needs no transfer
+            if c.arr_time < s.vehicle_arrivals[c.arr_stop]:
+                l = make_leg(self.connection(s.run_enters[c.run]), c, self.con_hops[i] - self.con_hops[s.run_enters[c.run]] + 1)
+                reach_by_vehicle(s, l, self.base_transfer_time)
+                self.expand_footpaths(s, l)
+                best = min(best, c.arr_time + s.walks[c.arr_stop])
 
-    cpdef Route route_many(self, vector[unsigned int] starts, vector[unsigned int] ends, vector[double] dep_times, vector[double] walk_times):
+    def scan_many(self,
+                  const unsigned int[:] starts, const double[:] start_walks, const unsigned int[:] start_offsets,
+                  double dep_time, double max_time, const unsigned char[:] active_trips,
+                  float[:, :] times, signed char[:, :] trips, bint parallel=True):
+        """many one-to-all queries at once, in parallel. query `i` departs
+        from its start stops (given as for `route_batch`) at `dep_time`,
+        and fills in `times[i]` with the time it takes to get to each stop
+        (`inf` if it can't within `max_time`) and `trips[i]` with
+        the number of vehicles taken to get there (-1 if it can't)"""
         cdef:
-            int i
-            unsigned int n = starts.size()
-            vector[Route] routes
-            double best_time = INFINITY
-            Route best_route
+            Py_ssize_t i
+            Py_ssize_t n = start_offsets.shape[0] - 1
+        self.reserve_scratch(openmp.omp_get_max_threads())
+        if parallel:
+            for i in prange(n, nogil=True, schedule='dynamic'):
+                self._scan_into(
+                    &self.scratch[threadid()],
+                    &starts[0] + start_offsets[i], &start_walks[0] + start_offsets[i], start_offsets[i+1] - start_offsets[i],
+                    dep_time, max_time, &active_trips[0], &times[i, 0], &trips[i, 0])
+        else:
+            with nogil:
+                for i in range(n):
+                    self._scan_into(
+                        &self.scratch[0],
+                        &starts[0] + start_offsets[i], &start_walks[0] + start_offsets[i], start_offsets[i+1] - start_offsets[i],
+                        dep_time, max_time, &active_trips[0], &times[i, 0], &trips[i, 0])
+
+    cdef void _scan_into(self, Scratch* s,
+                         const unsigned int* starts, const double* start_walks, size_t n_starts,
+                         double dep_time, double max_time, const unsigned char* active_trips,
+                         float* times, signed char* trips) nogil:
+        cdef:
+            size_t i
+            Stop stop
+            signed char n
+            Leg l
+        self.scan(s, starts, start_walks, n_starts, dep_time, active_trips, INFINITY, dep_time + max_time)
+
+        for i in range(self.n_stops):
+            times[i] = INFINITY
+            trips[i] = -1
+
+        # count the trips to each reached stop by walking back
+        # its route (see `build_route`)
+        for i in range(s.touched_stops.size()):
+            stop = s.touched_stops[i]
+            n = 0
+            l = s.legs[stop]
+            while l.type != ConnectionType.access:
+                if l.type == ConnectionType.trip and n < 127:
+                    n += 1
+                l = previous_leg(l, s.transfer_legs, s.vehicle_legs)
+            trips[stop] = n
+
+        for i in range(s.touched_stops.size()):
+            stop = s.touched_stops[i]
+            if s.earliest_arrivals[stop] - dep_time <= max_time:
+                times[stop] = s.earliest_arrivals[stop] - dep_time
+            else:
+                trips[stop] = -1
+        reset(s)
+
+    def profile(self,
+                vector[unsigned int] starts, vector[double] start_walks,
+                vector[unsigned int] ends, vector[double] end_walks,
+                double min_dep_time, double max_dep_time, const unsigned char[:] active_trips):
+        """profile query: all Pareto-optimal (departure, arrival) journeys
+        from any of the `starts` stops to any of the `ends` stops
+        (see `route`) departing within `[min_dep_time, max_dep_time]`
+        (and the first one departing after it), found with a single backward scan.
+        returns `(dep_times, arr_times, legs, leg_offsets)`, sorted by departure time,
+        where journey `i`'s legs (see `gtfs.util.LEG_DTYPE`), in order
+        from start to end, are at `leg_offsets[i]:leg_offsets[i+1]`.
+        the earliest arrival for departing at time `t` is
+        that of the first journey departing at or after `t`.
+        NOTE unlike `route`, journeys that only walk aren't included"""
+        cdef vector[Route] journeys
+        cdef vector[double] dep_times
+        with nogil:
+            self._profile(
+                starts.data(), start_walks.data(), starts.size(),
+                ends.data(), end_walks.data(), ends.size(),
+                min_dep_time, max_dep_time, &active_trips[0],
+                journeys, dep_times)
+        arr_times = np.empty(journeys.size())
+        for i in range(journeys.size()):
+            arr_times[i] = journeys[i].time
+        legs, offsets = pack_legs(journeys, False)
+        return np.array(dep_times, dtype=np.float64), arr_times, legs, offsets
+
+    cdef void _profile(self,
+                       const unsigned int* starts, const double* start_walks, size_t n_starts,
+                       const unsigned int* ends, const double* end_walks, size_t n_ends,
+                       double min_dep_time, double max_dep_time, const unsigned char* active_trips,
+                       vector[Route]& journeys, vector[double]& dep_times) nogil:
+        cdef:
+            size_t i, j
+            Connection c
+            unsigned int stop
+            double arr_time, walk
+            ProfileEntry e
+            RunProfile run_profile
+            vector[RunProfile] runs
+            vector[double] dest_walks
+            vector[double] dest_foot_times
+            vector[unsigned int] dest_stops
+            vector[ProfileEntry] entries
+
+            # separate profiles for boarding at each stop,
+            # and for walking from each stop to board elsewhere,
+            # since boarding after arriving on another trip
+            # needs a transfer, but walking away doesn't
+            vector[vector[ProfileEntry]] board_profiles
+            vector[vector[ProfileEntry]] walk_profiles
+
+        run_profile.arr_time = INFINITY
+        runs.assign(self.run_starts.shape[0], run_profile)
+        board_profiles.resize(self.n_stops)
+        walk_profiles.resize(self.n_stops)
+
+        # time to get from each stop to the destination,
+        # either directly from an end stop or walking
+        # to one first (`dest_stops`, taking `dest_foot_times`)
+        dest_walks.assign(self.n_stops, INFINITY)
+        dest_foot_times.assign(self.n_stops, 0)
+        dest_stops.assign(self.n_stops, 0)
+        for i in range(n_ends):
+            if end_walks[i] < dest_walks[ends[i]]:
+                dest_walks[ends[i]] = end_walks[i]
+                dest_stops[ends[i]] = ends[i]
+        for i in range(n_ends):
+            for j in range(self.in_footpath_offsets[ends[i]], self.in_footpath_offsets[ends[i]+1]):
+                stop = self.in_footpath_dep_stops[j]
+                walk = self.in_footpath_times[j] + end_walks[i]
+                if walk < dest_walks[stop]:
+                    dest_walks[stop] = walk
+                    dest_foot_times[stop] = self.in_footpath_times[j]
+                    dest_stops[stop] = ends[i]
+
+        # scan connections by departure time, descending
+        i = self.con_hops.shape[0]
+        while i > 0:
+            i -= 1
+            c = self.connection(i)
+            if c.dep_time < min_dep_time: break
+            if not active_trips[c.trip_id]: continue
+
+            # best arrival if we take this connection, either:
+            # - getting off here and heading to the destination
+            # - staying on the vehicle
+            # - getting off here and transferring
+            run_profile = runs[c.run]
+            arr_time = c.arr_time + dest_walks[c.arr_stop]
+            if arr_time < run_profile.arr_time:
+                run_profile.arr_time = arr_time
+                run_profile.exit = i
+            arr_time = min(
+                earliest_entry(board_profiles[c.arr_stop], c.arr_time + self.base_transfer_time).arr_time,
+                earliest_entry(walk_profiles[c.arr_stop], c.arr_time).arr_time)
+            if arr_time < run_profile.arr_time:
+                run_profile.arr_time = arr_time
+                run_profile.exit = i
+            if run_profile.arr_time == INFINITY: continue
+            runs[c.run] = run_profile
+
+            # record that departing from this connection's stop
+            # (or walking to it in time) gets us there by then
+            e.arr_time = run_profile.arr_time
+            e.enter = i
+            e.exit = run_profile.exit
+            e.stop = c.dep_stop
+            e.dep_time = c.dep_time
+            e.walk = 0
+            insert_entry(board_profiles[c.dep_stop], e)
+            for j in range(self.in_footpath_offsets[c.dep_stop], self.in_footpath_offsets[c.dep_stop+1]):
+                e.stop = self.in_footpath_dep_stops[j]
+                e.walk = self.in_footpath_times[j]
+                e.dep_time = c.dep_time - e.walk
+                insert_entry(walk_profiles[e.stop], e)
+
+        # combine the start stops' profiles into the origin's profile,
+        # i.e. with departures from the origin
+        for i in range(n_starts):
+            for e in board_profiles[starts[i]]:
+                e.dep_time -= start_walks[i]
+                if e.dep_time >= min_dep_time:
+                    insert_entry(entries, e)
+            for e in walk_profiles[starts[i]]:
+                e.dep_time -= start_walks[i]
+                if e.dep_time >= min_dep_time:
+                    insert_entry(entries, e)
+
+        # keep the first journey departing after the window,
+        # since it's the best for departures at the end of the window
+        i = 0
+        while i < entries.size() and entries[i].dep_time > max_dep_time:
+            i += 1
+        if i > 1:
+            entries.erase(entries.begin(), entries.begin() + i - 1)
+
+        # extract journeys, by departure time, ascending
+        journeys.resize(entries.size())
+        dep_times.resize(entries.size())
+        for i in range(entries.size()):
+            e = entries[entries.size() - 1 - i]
+            dep_times[i] = e.dep_time
+            journeys[i].time = e.arr_time
+
+            # the departure from the start stop
+            e.dep_time = self.connection(e.enter).dep_time - e.walk
+            journeys[i].path = self.build_journey(e, board_profiles, walk_profiles, dest_walks, dest_foot_times, dest_stops)
+
+    cdef vector[Leg] build_journey(self, ProfileEntry e,
+                                   vector[vector[ProfileEntry]]& board_profiles,
+                                   vector[vector[ProfileEntry]]& walk_profiles,
+                                   vector[double]& dest_walks, vector[double]& dest_foot_times,
+                                   vector[unsigned int]& dest_stops) nogil:
+        # follow profile entries from `e` to the destination
+        cdef:
+            vector[Leg] path
+            Stop stop
+            Connection enter, exit
+            ProfileEntry board, walk
+        while True:
+            enter = self.connection(e.enter)
+            exit = self.connection(e.exit)
+
+            # walk to the boarding stop, if needed
+            if e.walk > 0:
+                path.push_back(make_walk_leg(e.stop, e.dep_time, enter.dep_stop, e.dep_time + e.walk, ConnectionType.foot))
+            path.push_back(make_leg(enter, exit, self.con_hops[e.exit] - self.con_hops[e.enter] + 1))
+            stop = exit.arr_stop
+
+            # see if we head to the destination from here,
+            # or transfer to another vehicle
+            board = earliest_entry(board_profiles[stop], exit.arr_time + self.base_transfer_time)
+            walk = earliest_entry(walk_profiles[stop], exit.arr_time)
+            if exit.arr_time + dest_walks[stop] <= min(board.arr_time, walk.arr_time):
+                if dest_stops[stop] != stop:
+                    path.push_back(make_walk_leg(
+                        stop, exit.arr_time, dest_stops[stop],
+                        exit.arr_time + dest_foot_times[stop], ConnectionType.foot))
+                break
+            e = board if board.arr_time <= walk.arr_time else walk
+
+            # walk entries leave as soon as we arrive
+            if e.walk > 0:
+                e.dep_time = exit.arr_time
+        return path
+
+    cdef void expand_footpaths_back(self, Scratch* s, const Leg& l) nogil:
+        # scan incoming footpaths to the leg's departure stop,
+        # and see if they let us leave their stops later
+        cdef unsigned int i
+        for i in range(self.in_footpath_offsets[l.dep_stop], self.in_footpath_offsets[l.dep_stop+1]):
+            reach_back(s, make_walk_leg(
+                self.in_footpath_dep_stops[i],
+                l.dep_time - self.in_footpath_times[i],
+                l.dep_stop,
+                l.dep_time,
+                ConnectionType.foot), 0)
+
+    cdef void expand_footpaths(self, Scratch* s, const Leg& l) nogil:
+        # scan outgoing footpaths from the leg's arrival stop,
+        # and see if they get to their stops faster
+        cdef unsigned int i
+        for i in range(self.footpath_offsets[l.arr_stop], self.footpath_offsets[l.arr_stop+1]):
+            reach(s, make_walk_leg(
+                l.arr_stop,
+                l.arr_time,
+                self.footpath_arr_stops[i],
+                l.arr_time + self.footpath_times[i],
+                ConnectionType.foot), 0)
+
+
+cdef inline void reach_back(Scratch* s, const Leg& l, double transfer_time) nogil:
+    # update the leg's departure stop if we can leave it latest,
+    # or get off a vehicle there latest.
+    # getting off a vehicle before boarding another takes `transfer_time`
+    if l.dep_time > s.latest_departures[l.dep_stop]:
+        if s.latest_departures[l.dep_stop] == -INFINITY:
+            s.touched_stops.push_back(l.dep_stop)
+        s.legs[l.dep_stop] = l
+        s.latest_departures[l.dep_stop] = l.dep_time
+    if l.dep_time - transfer_time > s.latest_alightings[l.dep_stop]:
+        s.transfer_legs[l.dep_stop] = l
+        s.latest_alightings[l.dep_stop] = l.dep_time - transfer_time
 
-        # NOTE these routes are expected to be backwards
-        routes.assign(n, make_route())
-        for i in prange(n, nogil=True):
-            routes[i] = self.route(starts[i], ends[i], dep_times[i], walk_times[i])
 
-        for i in range(routes.size()):
-            if routes[i].time < best_time:
-                best_time = routes[i].time
-                best_route = routes[i]
+cdef inline void reach_back_by_vehicle(Scratch* s, const Leg& l, double transfer_time=0) nogil:
+    # `reach_back` for a vehicle (or the destination's egress) leg,
+    # updating its departure stop if we can leave it latest this way
+    reach_back(s, l, transfer_time)
+    if l.dep_time > s.vehicle_departures[l.dep_stop]:
+        s.vehicle_legs[l.dep_stop] = l
+        s.vehicle_departures[l.dep_stop] = l.dep_time
 
-        return best_route
 
+cdef inline void reach(Scratch* s, const Leg& l, double transfer_time) nogil:
+    # update the leg's arrival stop if it gets there earliest,
+    # or lets us board a vehicle there earliest.
+    # boarding a vehicle after getting off another takes `transfer_time`
+    if l.arr_time < s.earliest_arrivals[l.arr_stop]:
+        if s.earliest_arrivals[l.arr_stop] == INFINITY:
+            s.touched_stops.push_back(l.arr_stop)
+        s.legs[l.arr_stop] = l
+        s.earliest_arrivals[l.arr_stop] = l.arr_time
+    if l.arr_time + transfer_time < s.earliest_boardings[l.arr_stop]:
+        s.transfer_legs[l.arr_stop] = l
+        s.earliest_boardings[l.arr_stop] = l.arr_time + transfer_time
 
-cdef vector[Leg] build_route(unsigned int start, unsigned int end, vector[Connection] in_connections) nogil:
-    # build out the route to return
-    # consisting of only start, end, and transfer connections
+
+cdef inline void reach_by_vehicle(Scratch* s, const Leg& l, double transfer_time=0) nogil:
+    # `reach` for a vehicle (or the origin's access) leg,
+    # updating its arrival stop if it gets there earliest this way
+    reach(s, l, transfer_time)
+    if l.arr_time < s.vehicle_arrivals[l.arr_stop]:
+        s.vehicle_legs[l.arr_stop] = l
+        s.vehicle_arrivals[l.arr_stop] = l.arr_time
+
+
+cdef void reset(Scratch* s) nogil:
+    # reset the entries a scan touched
+    cdef size_t i
+    for i in range(s.touched_stops.size()):
+        s.earliest_arrivals[s.touched_stops[i]] = INFINITY
+        s.earliest_boardings[s.touched_stops[i]] = INFINITY
+        s.vehicle_arrivals[s.touched_stops[i]] = INFINITY
+        s.latest_departures[s.touched_stops[i]] = -INFINITY
+        s.latest_alightings[s.touched_stops[i]] = -INFINITY
+        s.vehicle_departures[s.touched_stops[i]] = -INFINITY
+    for i in range(s.touched_runs.size()):
+        s.reached[s.touched_runs[i]] = False
+    s.touched_stops.clear()
+    s.touched_runs.clear()
+
+
+cdef Route best_route(const unsigned int* ends, const double* end_walks, size_t n_ends, double dep_time,
+                      vector[Leg]& in_legs, vector[Leg]& transfer_legs, vector[Leg]& vehicle_legs,
+                      vector[double]& earliest_arrivals) nogil:
+    # settle on the end stop with the best arrival, including egress
+    # (end stops may also have been reached by footpaths)
+    cdef:
+        size_t i
+        Route route = make_route()
+        double best = INFINITY
+        unsigned int best_end
+    for i in range(n_ends):
+        if earliest_arrivals[ends[i]] + end_walks[i] < best \
+                and in_legs[ends[i]].type != ConnectionType.access:
+            best = earliest_arrivals[ends[i]] + end_walks[i]
+            best_end = ends[i]
+
+    if best == INFINITY:
+        return route
+
+    # NOTE this route is backward
+    route.path = build_route(best_end, in_legs, transfer_legs, vehicle_legs)
+    route.time = best - dep_time
+    return route
+
+
+cdef vector[Leg] build_route(unsigned int end, vector[Leg]& in_legs,
+                             vector[Leg]& transfer_legs, vector[Leg]& vehicle_legs) nogil:
+    # build out the route to return, walking
+    # back from the end until we reach the access (seed) leg
     cdef:
         vector[Leg] route
-        Connection cur_c = in_connections[end]
-        Connection to_c = in_connections[end]
-        Leg leg
-        unsigned int n_stops = 0
-
-    while cur_c.dep_stop != start:
-        from_c = in_connections[cur_c.dep_stop]
-        n_stops += 1
-        if cur_c.type != from_c.type or cur_c.trip_id != from_c.trip_id:
-            leg = make_leg(from_c, to_c, n_stops)
-            route.push_back(leg)
-            n_stops = 0
-            to_c = from_c
-        cur_c = from_c
-
-    leg = make_leg(cur_c, to_c, n_stops)
-    route.push_back(leg)
+        Leg l = in_legs[end]
+    while l.type != ConnectionType.access:
+        route.push_back(l)
+        l = previous_leg(l, transfer_legs, vehicle_legs)
 
     # NOTE this route is backward
     return route
 
 
+cdef inline Leg previous_leg(const Leg& l, vector[Leg]& transfer_legs, vector[Leg]& vehicle_legs) nogil:
+    # the leg before `l` in a forward scan's route: what let us board
+    # its vehicle, or the vehicle (or access) we walked on from
+    if l.type == ConnectionType.trip:
+        return transfer_legs[l.dep_stop]
+    return vehicle_legs[l.dep_stop]
+
+
+cdef inline Leg next_leg(const Leg& l, vector[Leg]& transfer_legs, vector[Leg]& vehicle_legs) nogil:
+    # the leg after `l` in a backward scan's route: what we get off
+    # its vehicle for, or the vehicle (or egress) we walk on to
+    if l.type == ConnectionType.trip:
+        return transfer_legs[l.arr_stop]
+    return vehicle_legs[l.arr_stop]
+
+
 # https://github.com/cython/cython/issues/1642
 cdef Connection make_connection(
     Stop dep_stop,
@@ -175,7 +1045,8 @@ cdef Connection make_connection(
     Stop arr_stop,
     double arr_time,
     ConnectionType type,
-    int trip_id
+    int trip_id,
+    int run
 ) nogil:
     cdef Connection c
     c.dep_stop = dep_stop
@@ -184,6 +1055,7 @@ cdef Connection make_connection(
     c.arr_time = arr_time
     c.type = type
     c.trip_id = trip_id
+    c.run = run
     return c
 
 
@@ -201,54 +1073,148 @@ cdef Leg make_leg(Connection from_connection, Connection to_connection, unsigned
     return l
 
 
+cdef Leg make_walk_leg(Stop dep_stop, double dep_time, Stop arr_stop, double arr_time, ConnectionType type) nogil:
+    cdef Leg l
+    l.dep_stop = dep_stop
+    l.dep_time = dep_time
+    l.arr_stop = arr_stop
+    l.arr_time = arr_time
+    l.trip_id = -1
+    l.type = type
+    l.n_stops = 1
+    return l
+
+
+cdef ProfileEntry earliest_entry(vector[ProfileEntry]& profile, double dep_time) nogil:
+    # profiles are Pareto sets sorted by departure time, descending,
+    # so the earliest arrival departing at or after `dep_time`
+    # is the last entry departing at or after it
+    cdef:
+        size_t lo = 0
+        size_t hi = profile.size()
+        size_t mid
+        ProfileEntry e
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if profile[mid].dep_time >= dep_time:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo == 0:
+        e.arr_time = INFINITY
+        return e
+    return profile[lo-1]
+
+
+cdef void insert_entry(vector[ProfileEntry]& profile, ProfileEntry e) nogil:
+    # add an entry to a profile, unless it's dominated,
+    # i.e. there's an entry departing no earlier and arriving no later,
+    # and drop the entries it dominates
+    cdef size_t i = profile.size()
+    cdef size_t j
+
+    # entries are usually added in descending departure order,
+    # so this is usually at the end
+    while i > 0 and profile[i-1].dep_time < e.dep_time:
+        i -= 1
+    if i > 0 and profile[i-1].arr_time <= e.arr_time:
+        return
+    while i > 0 and profile[i-1].dep_time == e.dep_time:
+        i -= 1
+    j = i
+    while j < profile.size() and profile[j].arr_time >= e.arr_time:
+        j += 1
+    profile.erase(profile.begin() + i, profile.begin() + j)
+    profile.insert(profile.begin() + i, e)
+
+
+def finish_routes(legs, const unsigned int[:] leg_offsets, const double[:] times,
+                  const double[:] dep_times, const double[:] walks_to_end):
+    """turn packed routes (as returned by `CSA.route_batch`)
+    into lists of route components: trim each route's legs where
+    walking to the end is faster, and add the final walk.
+    `walks_to_end` are the walking times from each leg's arrival stop
+    to its route's end. returns a `(route, time)` for each route,
+    or `None` where there are no legs (i.e. no route was found)"""
+    cdef:
+        size_t i, j, first, end
+        double time, walk_time
+        const unsigned int[:] dep_stops = legs['dep_stop']
+        const double[:] leg_dep_times = legs['dep_time']
+        const unsigned int[:] arr_stops = legs['arr_stop']
+        const double[:] arr_times = legs['arr_time']
+        const unsigned char[:] types = legs['type']
+        const int[:] trip_ids = legs['trip_id']
+    results = []
+    for i in range(times.shape[0]):
+        first, end = leg_offsets[i], leg_offsets[i+1]
+        if first == end:
+            results.append(None)
+            continue
+
+        # drop the last leg while, from the previous leg's arrival,
+        # walking directly to the end is no slower
+        time = times[i]
+        while end - first > 1:
+            if walks_to_end[end-2] > time - (arr_times[end-2] - dep_times[i]):
+                break
+            end -= 1
+
+        # add on the last walk leg from last stop,
+        # and recalculate time
+        walk_time = walks_to_end[end-1]
+        time = arr_times[end-1] - leg_dep_times[first] + walk_time
+
+        route = []
+        for j in range(first, end):
+            if types[j] == ConnectionType.trip:
+                route.append(TransitLeg(
+                    dep_stops[j], arr_stops[j],
+                    leg_dep_times[j], arr_times[j], trip_ids[j]))
+            else:
+                route.append(TransferLeg(
+                    dep_stops[j], arr_stops[j],
+                    arr_times[j] - leg_dep_times[j]))
+        route.append(WalkLeg(walk_time))
+        results.append((route, time))
+    return results
+
+
+cdef pack_legs(vector[Route]& routes, bint reverse):
+    # pack the routes' legs into a flat `gtfs.util.LEG_DTYPE` array,
+    # where route `i`'s legs are at `offsets[i]:offsets[i+1]`
+    cdef:
+        size_t i, j, k
+        size_t n = routes.size()
+        Leg l
+    offsets = np.zeros(n+1, dtype=np.uint32)
+    cdef unsigned int[:] leg_offsets = offsets
+    for i in range(n):
+        leg_offsets[i+1] = leg_offsets[i] + routes[i].path.size()
+    legs = np.empty(leg_offsets[n], dtype=LEG_DTYPE)
+    cdef:
+        unsigned int[:] dep_stops = legs['dep_stop']
+        double[:] dep_times = legs['dep_time']
+        unsigned int[:] arr_stops = legs['arr_stop']
+        double[:] arr_times = legs['arr_time']
+        unsigned char[:] types = legs['type']
+        int[:] trip_ids = legs['trip_id']
+        unsigned int[:] n_stops = legs['n_stops']
+    for i in range(n):
+        for j in range(routes[i].path.size()):
+            k = leg_offsets[i+1] - 1 - j if reverse else leg_offsets[i] + j
+            l = routes[i].path[j]
+            dep_stops[k] = l.dep_stop
+            dep_times[k] = l.dep_time
+            arr_stops[k] = l.arr_stop
+            arr_times[k] = l.arr_time
+            types[k] = l.type
+            trip_ids[k] = l.trip_id
+            n_stops[k] = l.n_stops
+    return legs, offsets
+
+
 cdef Route make_route() nogil:
     cdef Route r
     r.time = INFINITY
     return r
-
-
-cdef void expand_footpaths(Connection c, vector[Footpath] footpaths, vector[Connection] in_connections) nogil:
-    # scan outgoing footpaths from the arrival stop
-    # note: path.dep_stop == con.arr_stop
-    cdef:
-        Footpath path
-        Connection best_con
-    for path in footpaths:
-        # find existing best connection coming into the footpath's arrival stop
-        # to see if this footpath gets there faster than it
-        best_con = in_connections[path.arr_stop]
-        if best_con.type == ConnectionType.empty or c.arr_time + path.time < best_con.arr_time:
-            in_connections[path.arr_stop] = make_connection(
-                path.dep_stop,
-                c.arr_time,
-                path.arr_stop,
-                c.arr_time + path.time,
-                ConnectionType.foot,
-                -1,
-            )
-
-
-cdef bool is_reachable(Connection c, unsigned int start, double earliest_arrival, Connection in_con, double base_transfer_time) nogil:
-    # connection c is reachable if:
-    # (it departs from our starting stop OR the best connection to c's
-    #   departing stop connects to this connection) AND
-    #   it departs at or after our earliest arrival to c's departure stop (that
-    #   is, we arrive to the stop before the connection departs)
-    return c.dep_time >= earliest_arrival and (c.dep_stop == start or connects(in_con, c, base_transfer_time))
-
-
-cdef bool connects(Connection in_con, Connection c, double base_transfer_time) nogil:
-    # if this is a trip connection, we can reach the trip if either:
-    # - c is on the same trip as the incoming connection
-    # - we can transfer to c in time
-    if in_con.type == ConnectionType.trip:
-        return (in_con.trip_id == c.trip_id \
-            or in_con.arr_time <= c.dep_time - base_transfer_time)
-
-    # if this a foot connection, we just have to check
-    # that we arrive before connection c departs
-    elif in_con.type == ConnectionType.foot:
-        return in_con.arr_time <= c.dep_time
-
-    # if we don't have an incoming connection to c, there's no connection
-    return False
@@ -1,14 +1,71 @@
+# cython: boundscheck=False, wraparound=False
+import numpy as np
+from cython.parallel import prange
 from libc.math cimport asin, sin, cos, sqrt, M_PI
 
-cdef double to_radians(double deg):
+cdef double to_radians(double deg) nogil:
     return deg * (M_PI/180)
 
-cpdef double haversine(double lat1, double lon1, double lat2, double lon2):
-    cdef double km
-    lon1, lat1, lon2, lat2 = [
-        to_radians(v) for v in
-        [lon1, lat1, lon2, lat2]]
-    km = 6367 * 2 * asin(sqrt(
+cdef inline double _haversine(double lat1, double lon1, double lat2, double lon2) nogil:
+    lat1, lon1, lat2, lon2 = to_radians(lat1), to_radians(lon1), to_radians(lat2), to_radians(lon2)
+    return 6367 * 2 * asin(sqrt(
         sin((lat2 - lat1)/2)**2 +
         cos(lat1) * cos(lat2) * sin((lon2 - lon1)/2)**2))
-    return km
+
+cpdef double haversine(double lat1, double lon1, double lat2, double lon2):
+    return _haversine(lat1, lon1, lat2, lon2)
+
+
+def haversine_many(const double[:] lat1, const double[:] lon1, const double[:] lat2, const double[:] lon2, bint parallel=True):
+    """elementwise haversine distances (km)
+    between two equal-length sets of coordinates"""
+    cdef:
+        Py_ssize_t i
+        Py_ssize_t n = lat1.shape[0]
+        double[:] out = np.empty(n)
+    if parallel:
+        for i in prange(n, nogil=True):
+            out[i] = _haversine(lat1[i], lon1[i], lat2[i], lon2[i])
+    else:
+        with nogil:
+            for i in range(n):
+                out[i] = _haversine(lat1[i], lon1[i], lat2[i], lon2[i])
+    return np.asarray(out)
+
+
+def haversine_pairwise(const double[:] lat1, const double[:] lon1, const double[:] lat2, const double[:] lon2, bint parallel=True):
+    """haversine distances (km) between every
+    pair of coordinates in two sets, as a `(n1, n2)` matrix"""
+    cdef:
+        Py_ssize_t i, j
+        Py_ssize_t n1 = lat1.shape[0]
+        Py_ssize_t n2 = lat2.shape[0]
+        double[:, :] out = np.empty((n1, n2))
+    if parallel:
+        for i in prange(n1, nogil=True):
+            for j in range(n2):
+                out[i, j] = _haversine(lat1[i], lon1[i], lat2[j], lon2[j])
+    else:
+        with nogil:
+            for i in range(n1):
+                for j in range(n2):
+                    out[i, j] = _haversine(lat1[i], lon1[i], lat2[j], lon2[j])
+    return np.asarray(out)
+
+
+def walking_times(const double[:] lat1, const double[:] lon1, const double[:] lat2, const double[:] lon2,
+                  double delta_base, double speed_kmh, bint parallel=True):
+    """elementwise walking times (seconds), see `gtfs.util.walking_time`"""
+    cdef:
+        Py_ssize_t i
+        Py_ssize_t n = lat1.shape[0]
+        double km_per_sec = speed_kmh/3600
+        double[:] out = np.empty(n)
+    if parallel:
+        for i in prange(n, nogil=True):
+            out[i] = delta_base + _haversine(lat1[i], lon1[i], lat2[i], lon2[i]) / km_per_sec
+    else:
+        with nogil:
+            for i in range(n):
+                out[i] = delta_base + _haversine(lat1[i], lon1[i], lat2[i], lon2[i]) / km_per_sec
+    return np.asarray(out)
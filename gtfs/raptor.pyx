@@ -0,0 +1,461 @@
+# distutils: language=c++
+# cython: boundscheck=False, wraparound=False, legacy_implicit_noexcept=True
+# RAPTOR: <https://www.microsoft.com/en-us/research/wp-content/uploads/2012/01/raptor_alenex.pdf>
+
+import numpy as np
+from libcpp.vector cimport vector
+from numpy.math cimport INFINITY
+from cython.parallel import prange, threadid
+cimport openmp
+from .csa cimport Stop, ConnectionType, Leg, Route, make_walk_leg, make_route, pack_legs
+
+cdef unsigned int NONE = <unsigned int>-1
+
+# reusable buffers for queries, as for `gtfs.csa`.
+# only the entries a query touches are reset after it
+ctypedef struct Scratch:
+    # by round and stop, i.e. at `round * n_stops + stop`:
+    # the earliest arrival there with that many trips,
+    # getting off a vehicle or on foot, and the legs that get there.
+    # round 0 is walking from the origin
+    vector[double] trip_arrivals
+    vector[double] walk_arrivals
+    vector[Leg] trip_legs
+    vector[Leg] walk_legs
+    vector[size_t] touched_labels
+
+    # by round and stop: the round whose label
+    # the trip leg that gets there boarded after
+    vector[unsigned int] trip_rounds
+
+    # by stop, over the rounds so far: the earliest arrival
+    # getting off a vehicle, and the earliest time we can board one,
+    # and the round whose label lets us board then
+    vector[double] best_arrivals
+    vector[double] best_boardings
+    vector[unsigned int] boarding_rounds
+    vector[Stop] touched_stops
+
+    # by stop: time to walk between it and the destination
+    vector[double] walks
+
+    # stops labelled in the current round, and
+    # those reached by vehicle (to walk on from)
+    vector[Stop] labelled
+    vector[Stop] alighted
+
+    # stops we can board at earlier than in previous rounds
+    vector[Stop] marked
+
+    # by pattern: the first marked stop along it, if any
+    vector[unsigned int] queue
+    vector[unsigned int] queued
+
+
+cdef class Raptor:
+    cdef:
+        unsigned int n_stops
+        double base_transfer_time
+
+        # query buffers, one per thread.
+        # NOTE this means a Raptor can't be queried from
+        # multiple python threads at once; use `route_batch`
+        vector[Scratch] scratch
+
+        # route patterns, in CSR form (see `Transit._compute_patterns`).
+        # as with `CSA`, these are views into the given arrays
+        object _pattern_stops, _pattern_runs
+        const unsigned int[:] pattern_stop_offsets
+        const unsigned int[:] pattern_stops
+        const int[:] pattern_arr_offsets
+        const int[:] pattern_dep_offsets
+        const unsigned int[:] pattern_run_offsets
+        const unsigned int[:] pattern_runs
+        const int[:] run_starts
+        int[:] run_trips
+
+        # the patterns through each stop, and the stop's
+        # index along each, i.e. stop `i`'s are at
+        # `stop_pattern_offsets[i]:stop_pattern_offsets[i+1]`
+        unsigned int[:] stop_pattern_offsets
+        unsigned int[:] stop_patterns
+        unsigned int[:] stop_pattern_idxs
+
+        # footpaths in CSR form, as for `CSA`
+        object _footpaths
+        const unsigned int[:] footpath_offsets
+        const unsigned int[:] footpath_arr_stops
+        const double[:] footpath_times
+
+    def __init__(self, pattern_stops, pattern_stop_offsets, pattern_runs, pattern_run_offsets,
+                 run_starts, trip_run_offsets, footpaths, footpath_offsets,
+                 double base_transfer_time, unsigned int n_stops):
+        # NOTE: this assumes each pattern's runs are sorted by start time,
+        # and that footpaths (see `gtfs.util.FOOTPATH_DTYPE`) are sorted by dep stop
+        self.n_stops = n_stops
+        self.base_transfer_time = base_transfer_time
+
+        self._pattern_stops = pattern_stops
+        self.pattern_stop_offsets = pattern_stop_offsets
+        self.pattern_stops = pattern_stops['stop']
+        self.pattern_arr_offsets = pattern_stops['arr_offset']
+        self.pattern_dep_offsets = pattern_stops['dep_offset']
+        self._pattern_runs = pattern_runs
+        self.pattern_run_offsets = pattern_run_offsets
+        self.pattern_runs = pattern_runs
+        self.run_starts = run_starts
+        self.run_trips = np.repeat(
+            np.arange(len(trip_run_offsets) - 1, dtype=np.int32),
+            np.diff(np.asarray(trip_run_offsets, dtype=np.int64)))
+
+        n_patterns = len(pattern_stop_offsets) - 1
+        stop_patterns = np.repeat(
+            np.arange(n_patterns, dtype=np.uint32),
+            np.diff(np.asarray(pattern_stop_offsets, dtype=np.int64)))
+        stop_pattern_idxs = np.arange(len(pattern_stops), dtype=np.uint32) \
+            - np.asarray(pattern_stop_offsets, dtype=np.uint32)[stop_patterns]
+        order = np.argsort(pattern_stops['stop'], kind='mergesort')
+        offsets = np.zeros(n_stops+1, dtype=np.uint32)
+        offsets[1:] = np.cumsum(np.bincount(pattern_stops['stop'], minlength=n_stops))
+        self.stop_pattern_offsets = offsets
+        self.stop_patterns = np.ascontiguousarray(stop_patterns[order])
+        self.stop_pattern_idxs = np.ascontiguousarray(stop_pattern_idxs[order])
+
+        self._footpaths = footpaths
+        self.footpath_offsets = footpath_offsets
+        self.footpath_arr_stops = footpaths['arr_stop']
+        self.footpath_times = footpaths['time']
+
+        self.reserve_scratch(openmp.omp_get_max_threads())
+
+    @property
+    def n_patterns(self):
+        return self.pattern_stop_offsets.shape[0] - 1
+
+    cdef void reserve_scratch(self, size_t n):
+        # make sure there are query buffers for `n` threads.
+        # the per-round labels are sized as queries need them
+        cdef size_t i = self.scratch.size()
+        if i >= n: return
+        self.scratch.resize(n)
+        for i in range(i, n):
+            self.scratch[i].best_arrivals.assign(self.n_stops, INFINITY)
+            self.scratch[i].best_boardings.assign(self.n_stops, INFINITY)
+            self.scratch[i].boarding_rounds.assign(self.n_stops, 0)
+            self.scratch[i].walks.assign(self.n_stops, INFINITY)
+            self.scratch[i].queue.assign(self.n_patterns, NONE)
+
+    cpdef Route route(self,
+                      vector[unsigned int] starts, vector[double] start_walks,
+                      vector[unsigned int] ends, vector[double] end_walks,
+                      double dep_time, const unsigned char[:] active_trips,
+                      unsigned int max_transfers):
+        """as `CSA.route`, but taking at most `max_transfers` transfers"""
+        with nogil:
+            return self._route(
+                &self.scratch[0],
+                starts.data(), start_walks.data(), starts.size(),
+                ends.data(), end_walks.data(), ends.size(),
+                dep_time, &active_trips[0], max_transfers)
+
+    def route_batch(self,
+                    const unsigned int[:] starts, const double[:] start_walks, const unsigned int[:] start_offsets,
+                    const unsigned int[:] ends, const double[:] end_walks, const unsigned int[:] end_offsets,
+                    const double[:] dep_times, const unsigned char[:] active_trips,
+                    unsigned int max_transfers, bint parallel=True):
+        """as `CSA.route_batch`, but taking
+        at most `max_transfers` transfers"""
+        cdef:
+            Py_ssize_t i
+            Py_ssize_t n = dep_times.shape[0]
+            vector[Route] results
+        results.resize(n)
+        self.reserve_scratch(openmp.omp_get_max_threads())
+        if parallel:
+            for i in prange(n, nogil=True, schedule='dynamic'):
+                results[i] = self._route(
+                    &self.scratch[threadid()],
+                    &starts[0] + start_offsets[i], &start_walks[0] + start_offsets[i], start_offsets[i+1] - start_offsets[i],
+                    &ends[0] + end_offsets[i], &end_walks[0] + end_offsets[i], end_offsets[i+1] - end_offsets[i],
+                    dep_times[i], &active_trips[0], max_transfers)
+        else:
+            with nogil:
+                for i in range(n):
+                    results[i] = self._route(
+                        &self.scratch[0],
+                        &starts[0] + start_offsets[i], &start_walks[0] + start_offsets[i], start_offsets[i+1] - start_offsets[i],
+                        &ends[0] + end_offsets[i], &end_walks[0] + end_offsets[i], end_offsets[i+1] - end_offsets[i],
+                        dep_times[i], &active_trips[0], max_transfers)
+
+        times = np.empty(n)
+        cdef double[:] route_times = times
+        for i in range(n):
+            route_times[i] = results[i].time
+
+        # route paths are backward
+        legs, offsets = pack_legs(results, True)
+        return times, legs, offsets
+
+    cdef Route _route(self, Scratch* s,
+                      const unsigned int* starts, const double* start_walks, size_t n_starts,
+                      const unsigned int* ends, const double* end_walks, size_t n_ends,
+                      double dep_time, const unsigned char* active_trips,
+                      unsigned int max_transfers) nogil:
+        cdef:
+            size_t i, j
+            unsigned int k
+            unsigned int n_rounds = max_transfers + 1
+            double best = INFINITY
+            Route route
+
+        # labels for each round, i.e. for up to `n_rounds` trips
+        if s.trip_arrivals.size() < (n_rounds + 1) * self.n_stops:
+            s.trip_arrivals.resize((n_rounds + 1) * self.n_stops, INFINITY)
+            s.walk_arrivals.resize((n_rounds + 1) * self.n_stops, INFINITY)
+            s.trip_legs.resize((n_rounds + 1) * self.n_stops)
+            s.walk_legs.resize((n_rounds + 1) * self.n_stops)
+            s.trip_rounds.resize((n_rounds + 1) * self.n_stops)
+
+        for i in range(n_ends):
+            s.walks[ends[i]] = min(s.walks[ends[i]], end_walks[i])
+
+        # round 0: walk to the start stops,
+        # and on from them along footpaths
+        for i in range(n_starts):
+            self.label_walk(s, 0, make_walk_leg(
+                starts[i], dep_time, starts[i],
+                dep_time + start_walks[i], ConnectionType.access), &best)
+        for i in range(n_starts):
+            self.expand_footpaths(s, 0, starts[i], dep_time + start_walks[i], &best)
+        self.mark(s, 0)
+
+        # round k: ride a k-th vehicle from the stops
+        # we could board earlier after round k-1
+        for k in range(1, n_rounds + 1):
+            if s.marked.empty(): break
+            self.queue_patterns(s)
+            for i in range(s.queued.size()):
+                self.scan_pattern(s, k, s.queued[i], active_trips, &best)
+            s.queued.clear()
+
+            # then walk on from where we got off
+            for i in range(s.alighted.size()):
+                j = k * self.n_stops + s.alighted[i]
+                self.expand_footpaths(s, k, s.alighted[i], s.trip_arrivals[j], &best)
+            s.alighted.clear()
+            self.mark(s, k)
+
+        route = self.best_route(s, ends, end_walks, n_ends, dep_time, n_rounds)
+
+        for i in range(n_ends):
+            s.walks[ends[i]] = INFINITY
+        s.marked.clear()
+        reset(s)
+        return route
+
+    cdef void queue_patterns(self, Scratch* s) nogil:
+        # queue the patterns through the marked stops,
+        # to be scanned from the first marked stop along each
+        cdef:
+            size_t i
+            unsigned int j, pattern, idx
+            Stop stop
+        for i in range(s.marked.size()):
+            stop = s.marked[i]
+            for j in range(self.stop_pattern_offsets[stop], self.stop_pattern_offsets[stop+1]):
+                pattern = self.stop_patterns[j]
+                idx = self.stop_pattern_idxs[j]
+                if s.queue[pattern] == NONE:
+                    s.queued.push_back(pattern)
+                    s.queue[pattern] = idx
+                elif idx < s.queue[pattern]:
+                    s.queue[pattern] = idx
+        s.marked.clear()
+
+    cdef void scan_pattern(self, Scratch* s, unsigned int k, unsigned int pattern,
+                           const unsigned char* active_trips, double* best) nogil:
+        # ride the pattern's earliest catchable run from each stop on,
+        # switching to an earlier run where we can board one
+        cdef:
+            unsigned int i, run
+            unsigned int first = self.pattern_stop_offsets[pattern]
+            unsigned int last = self.pattern_stop_offsets[pattern+1]
+            unsigned int current = NONE
+            unsigned int board_idx = 0
+            unsigned int board_round = 0
+            Stop stop
+            double start = 0
+            double arr_time
+            Leg l
+        for i in range(first + s.queue[pattern], last):
+            stop = self.pattern_stops[i]
+
+            if current != NONE:
+                start = self.run_starts[self.pattern_runs[current]]
+                arr_time = start + self.pattern_arr_offsets[i]
+                if arr_time < s.best_arrivals[stop] and arr_time < best[0]:
+                    l.dep_stop = self.pattern_stops[board_idx]
+                    l.dep_time = start + self.pattern_dep_offsets[board_idx]
+                    l.arr_stop = stop
+                    l.arr_time = arr_time
+                    l.type = ConnectionType.trip
+                    l.trip_id = self.run_trips[self.pattern_runs[current]]
+                    l.n_stops = i - board_idx
+                    self.label_trip(s, k, l, board_round, best)
+
+            # boarding after the previous rounds
+            if i + 1 < last and s.best_boardings[stop] < INFINITY and (current == NONE or
+                    s.best_boardings[stop] <= start + self.pattern_dep_offsets[i]):
+                run = self.earliest_run(
+                    pattern, s.best_boardings[stop] - self.pattern_dep_offsets[i], active_trips)
+                if run != NONE and (current == NONE or run < current):
+                    current = run
+                    board_idx = i
+                    board_round = s.boarding_rounds[stop]
+        s.queue[pattern] = NONE
+
+    cdef unsigned int earliest_run(self, unsigned int pattern, double start,
+                                   const unsigned char* active_trips) nogil:
+        # runs are sorted by start time, so binary search for the
+        # first starting at or after `start`, skipping inactive trips
+        cdef:
+            unsigned int lo = self.pattern_run_offsets[pattern]
+            unsigned int hi = self.pattern_run_offsets[pattern+1]
+            unsigned int end = hi
+            unsigned int mid
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.run_starts[self.pattern_runs[mid]] < start:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < end and not active_trips[self.run_trips[self.pattern_runs[lo]]]:
+            lo += 1
+        return lo if lo < end else NONE
+
+    cdef void expand_footpaths(self, Scratch* s, unsigned int k, Stop stop, double arr_time, double* best) nogil:
+        # walk from the stop along its footpaths
+        cdef unsigned int i
+        cdef Stop to
+        for i in range(self.footpath_offsets[stop], self.footpath_offsets[stop+1]):
+            to = self.footpath_arr_stops[i]
+            if arr_time + self.footpath_times[i] < s.best_boardings[to] \
+                    and arr_time + self.footpath_times[i] < best[0]:
+                self.label_walk(s, k, make_walk_leg(
+                    stop, arr_time, to,
+                    arr_time + self.footpath_times[i],
+                    ConnectionType.foot), best)
+
+    cdef void label_trip(self, Scratch* s, unsigned int k, const Leg& l,
+                         unsigned int board_round, double* best) nogil:
+        cdef size_t j = k * self.n_stops + l.arr_stop
+        if s.best_arrivals[l.arr_stop] == INFINITY and s.best_boardings[l.arr_stop] == INFINITY:
+            s.touched_stops.push_back(l.arr_stop)
+        s.best_arrivals[l.arr_stop] = l.arr_time
+        if s.trip_arrivals[j] == INFINITY:
+            s.touched_labels.push_back(j)
+            s.alighted.push_back(l.arr_stop)
+            if s.walk_arrivals[j] == INFINITY:
+                s.labelled.push_back(l.arr_stop)
+        s.trip_arrivals[j] = l.arr_time
+        s.trip_legs[j] = l
+        s.trip_rounds[j] = board_round
+        best[0] = min(best[0], l.arr_time + s.walks[l.arr_stop])
+
+    cdef void label_walk(self, Scratch* s, unsigned int k, const Leg& l, double* best) nogil:
+        cdef size_t j = k * self.n_stops + l.arr_stop
+        if l.arr_time >= s.walk_arrivals[j]: return
+        if s.walk_arrivals[j] == INFINITY:
+            s.touched_labels.push_back(j)
+            if s.trip_arrivals[j] == INFINITY:
+                s.labelled.push_back(l.arr_stop)
+        s.walk_arrivals[j] = l.arr_time
+        s.walk_legs[j] = l
+        if l.type != ConnectionType.access:
+            best[0] = min(best[0], l.arr_time + s.walks[l.arr_stop])
+
+    cdef void mark(self, Scratch* s, unsigned int k) nogil:
+        # mark the stops we can now board at earlier. boarding
+        # times are only updated after each round, so that
+        # round k only boards after the previous rounds
+        cdef:
+            size_t i, j
+            Stop stop
+            double boarding
+        for i in range(s.labelled.size()):
+            stop = s.labelled[i]
+            j = k * self.n_stops + stop
+            boarding = min(s.walk_arrivals[j], s.trip_arrivals[j] + self.base_transfer_time)
+            if boarding < s.best_boardings[stop]:
+                if s.best_arrivals[stop] == INFINITY and s.best_boardings[stop] == INFINITY:
+                    s.touched_stops.push_back(stop)
+                s.best_boardings[stop] = boarding
+                s.boarding_rounds[stop] = k
+                s.marked.push_back(stop)
+        s.labelled.clear()
+
+    cdef Route best_route(self, Scratch* s,
+                          const unsigned int* ends, const double* end_walks, size_t n_ends,
+                          double dep_time, unsigned int n_rounds) nogil:
+        # settle on the end stop and round with the best arrival,
+        # including egress, preferring fewer trips
+        cdef:
+            size_t i, j
+            unsigned int k = 0
+            unsigned int r
+            Route route = make_route()
+            double best = INFINITY
+            Leg l
+            Stop stop
+        for r in range(n_rounds + 1):
+            for i in range(n_ends):
+                j = r * self.n_stops + ends[i]
+                if s.trip_arrivals[j] + end_walks[i] < best:
+                    best = s.trip_arrivals[j] + end_walks[i]
+                    l = s.trip_legs[j]
+                    k = r
+                if s.walk_arrivals[j] + end_walks[i] < best \
+                        and s.walk_legs[j].type != ConnectionType.access:
+                    best = s.walk_arrivals[j] + end_walks[i]
+                    l = s.walk_legs[j]
+                    k = r
+
+        if best == INFINITY:
+            return route
+
+        # walk back from the end until we reach the access leg
+        while l.type != ConnectionType.access:
+            route.path.push_back(l)
+            stop = l.dep_stop
+            if l.type == ConnectionType.trip:
+                # we boarded after the round recorded with the leg,
+                # whose labels are final, getting there by whichever
+                # let us board earliest (see `mark`)
+                k = s.trip_rounds[k * self.n_stops + l.arr_stop]
+                j = k * self.n_stops + stop
+                if s.walk_arrivals[j] <= s.trip_arrivals[j] + self.base_transfer_time:
+                    l = s.walk_legs[j]
+                else:
+                    l = s.trip_legs[j]
+            else:
+                # we walked on from where we got off
+                # this round, or from the origin
+                j = k * self.n_stops + stop
+                l = s.trip_legs[j] if k > 0 else s.walk_legs[j]
+
+        # NOTE this route is backward
+        route.time = best - dep_time
+        return route
+
+
+cdef void reset(Scratch* s) nogil:
+    # reset the entries a query touched
+    cdef size_t i
+    for i in range(s.touched_labels.size()):
+        s.trip_arrivals[s.touched_labels[i]] = INFINITY
+        s.walk_arrivals[s.touched_labels[i]] = INFINITY
+    for i in range(s.touched_stops.size()):
+        s.best_arrivals[s.touched_stops[i]] = INFINITY
+        s.best_boardings[s.touched_stops[i]] = INFINITY
+    s.touched_labels.clear()
+    s.touched_stops.clear()
@@ -1,126 +1,395 @@
 import config
+import numpy as np
 from . import util
-from .csa import CSA
-from itertools import product
-from collections import namedtuple
+from .csa import WalkLeg, TransitLeg, TransferLeg, finish_routes
+from geohash import encode
+from collections import OrderedDict
 
 
-# route components
-WalkLeg = namedtuple('WalkLeg', ['time'])
-TransitLeg = namedtuple('TransitLeg', ['dep_stop', 'arr_stop', 'dep_time', 'arr_time', 'trip_id'])
-TransferLeg = namedtuple('TransferLeg', ['dep_stop', 'arr_stop', 'time'])
+class NoTransitRouteFound(Exception): pass
 
 
-class NoTransitRouteFound(Exception): pass
+class RouteProfile:
+    """Pareto-optimal routes between an origin and a destination
+    over a departure window (see `TransitRouter.profile`),
+    from which the route for any departure time in the window
+    can be looked up without another scan"""
+    def __init__(self, router, end_coord, dep_times, arr_times, legs, leg_offsets, walk_time):
+        self.router = router
+        self.end_coord = end_coord
+        self.dep_times = dep_times
+        self.arr_times = arr_times
+        self.legs = legs
+        self.leg_offsets = leg_offsets
+
+        # the time to walk directly to the end. the journeys
+        # don't include walking, so it's compared with them.
+        # if there are no journeys, walking is the best option at any time
+        self.walk_time = walk_time
+
+    def __len__(self):
+        if self.dep_times is None:
+            return 0
+        return len(self.dep_times)
+
+    def route(self, dep_time):
+        """the route with the earliest arrival, departing at `dep_time`"""
+        if self.dep_times is None:
+            return [WalkLeg(self.walk_time)], self.walk_time
+
+        # the first journey departing at or after dep_time
+        # has the earliest arrival, unless walking is faster
+        i = np.searchsorted(self.dep_times, dep_time)
+        if i == len(self.dep_times):
+            raise NoTransitRouteFound
+        legs = self.legs[self.leg_offsets[i]:self.leg_offsets[i+1]]
+        route, time = self.router._finish_route(legs, self.arr_times[i] - dep_time, self.end_coord, dep_time)
+
+        # the finished route's time is from its first departure
+        if legs[0]['dep_time'] + time - dep_time >= self.walk_time:
+            return [WalkLeg(self.walk_time)], self.walk_time
+        return route, time
 
 
 class TransitRouter:
-    def __init__(self, transit, dt):
+    def __init__(self, transit, dt=None, active_trips=None,
+                 engine=config.TRANSIT_ENGINE, max_transfers=config.TRANSIT_MAX_TRANSFERS,
+                 journey_cache_size=config.TRANSIT_JOURNEY_CACHE_SIZE,
+                 max_access_walk=config.TRANSIT_ACCESS_WALK_MAX):
+        """routes using the trips operating on `dt`,
+        or, e.g. for custom service scenarios, those
+        set in `active_trips`, a mask over trip iids.
+
+        `engine` is what `route`/`route_batch` use:
+        - `'csa'`: a scan over all connections from the departure time
+        - `'raptor'`: round-based, over route patterns; only
+          explores what's reachable, and takes at most `max_transfers` transfers.
+        the other queries always use the connection scan.
+
+        the candidate stops for a trip's start and end are those
+        within `max_access_walk` seconds' walk (see `Transit.candidate_stops`).
+
+        if `journey_cache_size` is set, `route`/`route_batch` keep the
+        journeys of up to that many trips (LRU), keyed by their start and
+        end zones (geohashes) and departure time bucket. trips with the same
+        key reuse the journey, re-timing the walks for their exact start and
+        end, as long as they can still walk to its first stop in time"""
+        if engine not in ('csa', 'raptor'):
+            raise ValueError('Unknown transit routing engine: {}'.format(engine))
         self.T = transit
-        self.valid_trips = self.T.calendar.trips_for_day(dt)
+        self.engine = engine
+        self.max_transfers = max_transfers
+        self.max_access_walk = max_access_walk
+        if active_trips is None:
+            active_trips = self.T.calendar.trip_mask_for_dt(dt)
+
+        # the connection scan is shared by all routers;
+        # rather than copying this day's connections, we just
+        # tell it to skip those of trips that aren't running
+        self.active_trips = np.ascontiguousarray(active_trips, dtype=np.uint8)
+        self.valid_trips = {self.T.trip_idx.id[t] for t in np.flatnonzero(self.active_trips).tolist()}
+        self.csa = self.T.csa
 
-        # reduce connections to only those for this day
-        connections = [c for c in self.T.connections if self.T.trip_idx.id[c['trip_id']] in self.valid_trips]
+        # LRU cache of one-to-all trees,
+        # keyed by `(start stop iid, departure bucket)`
+        self.trees = OrderedDict()
+        self.tree_hits = 0
+        self.tree_misses = 0
 
-        self.csa = CSA(connections, self.T.footpaths, config.BASE_TRANSFER_TIME, len(self.T.stops))
+        # LRU cache of journeys' legs, keyed by
+        # `(start geohash, end geohash, departure bucket)`
+        self.journey_cache_size = journey_cache_size
+        self.journeys = OrderedDict()
+        self.journey_hits = 0
+        self.journey_misses = 0
 
     def route(self, start_coord, end_coord, dep_time, closest_stops=2):
         """compute a trip-level route between
         a start and an end stop for a given datetime"""
-        # candidate start and end stops,
-        # returned as [(iid, time), ...]
+        result = self.route_batch([start_coord], [end_coord], [dep_time], closest_stops=closest_stops)[0]
+        if result is None:
+            raise NoTransitRouteFound
+        return result
+
+    def route_batch(self, start_coords, end_coords, dep_times, closest_stops=2):
+        """compute routes for many trips at once,
+        returning a `(route, time)` per trip, or `None`
+        where no route was found. the queries run
+        in parallel, without holding the GIL.
+        if the journey cache is enabled, trips between the same zones
+        at around the same time share a journey (see `__init__`)"""
+        start_coords = np.asarray(start_coords, dtype=np.float64).reshape(-1, 2)
+        end_coords = np.asarray(end_coords, dtype=np.float64).reshape(-1, 2)
+        dep_times = np.ascontiguousarray(dep_times, dtype=np.float64)
+        if not self.journey_cache_size:
+            results, _, _, _ = self._route_batch(start_coords, end_coords, dep_times, closest_stops)
+            return results
+
+        keys = [
+            self._journey_key(start, end, dep_time) for start, end, dep_time
+            in zip(start_coords.tolist(), end_coords.tolist(), dep_times.tolist())]
+        hits = self._usable_journeys(keys, start_coords, dep_times)
+        misses = np.setdiff1d(np.arange(len(keys)), hits)
+        self.journey_hits += len(hits)
+        self.journey_misses += len(misses)
+        results = [None] * len(keys)
+
+        # route the rest, caching their journeys
+        if len(misses):
+            routed, legs, leg_offsets, same_stops = self._route_batch(
+                start_coords[misses], end_coords[misses], dep_times[misses], closest_stops)
+            for j, i in enumerate(misses.tolist()):
+                results[i] = routed[j]
+                if not same_stops[j] and leg_offsets[j] < leg_offsets[j+1]:
+                    self._cache_journey(keys[i], legs[leg_offsets[j]:leg_offsets[j+1]].copy())
+
+        # re-time the cached journeys
+        # to each trip's exact destination
+        if len(hits):
+            journeys = [self.journeys[keys[i]] for i in hits.tolist()]
+            for i in hits.tolist():
+                self.journeys.move_to_end(keys[i])
+            legs = np.concatenate(journeys)
+            leg_offsets = np.zeros(len(journeys)+1, dtype=np.uint32)
+            leg_offsets[1:] = np.cumsum([len(journey) for journey in journeys])
+            last = legs[leg_offsets[1:] - 1]
+            times = last['arr_time'] - dep_times[hits] + util.walking_times(
+                self.T.stop_coords[last['arr_stop']], end_coords[hits],
+                config.FOOTPATH_DELTA_BASE, config.FOOTPATH_SPEED_KMH)
+            for i, result in zip(hits.tolist(), self._finish_routes(
+                    legs, leg_offsets, times, end_coords[hits], dep_times[hits])):
+                results[i] = result
+        return results
+
+    def _route_batch(self, start_coords, end_coords, dep_times, closest_stops):
+        """route trips with the routing engine, returning their results
+        (as for `route_batch`), the raw legs of their journeys
+        and their offsets, and which are walking directly"""
+        starts, ends, same_stops, direct_walk_times = self._candidate_stops(
+            start_coords, end_coords, closest_stops)
+
+        times, legs, leg_offsets = self._query_batch(starts, ends, dep_times)
+        results = self._finish_routes(legs, leg_offsets, times, end_coords, dep_times)
+        for i in np.flatnonzero(same_stops).tolist():
+            results[i] = [WalkLeg(direct_walk_times[i])], direct_walk_times[i]
+        return results, legs, leg_offsets, same_stops
+
+    def _query_batch(self, starts, ends, dep_times):
+        """find the best combination of start/end stops (see `_candidate_stops`)
+        for each trip, each in a single query seeded from all its start stops,
+        returning the raw times, legs and leg offsets from the routing engine"""
+        if self.engine == 'raptor':
+            return self.T.raptor.route_batch(
+                *starts, *ends, dep_times, self.active_trips, self.max_transfers)
+        return self.csa.route_batch(*starts, *ends, dep_times, self.active_trips)
+
+    def _journey_key(self, start_coord, end_coord, dep_time):
+        # zones as in `zone.geohash`
+        return (
+            encode(*start_coord, precision=config.GEOHASH_PRECISION),
+            encode(*end_coord, precision=config.GEOHASH_PRECISION),
+            int(dep_time // config.TRANSIT_JOURNEY_BUCKET))
+
+    def _usable_journeys(self, keys, start_coords, dep_times):
+        """indices of the trips with a cached journey
+        they can walk to its first stop in time for"""
+        cached = np.array([key in self.journeys for key in keys], dtype=bool)
+        idx = np.flatnonzero(cached)
+        if not len(idx):
+            return idx
+        first = np.concatenate([self.journeys[keys[i]][:1] for i in idx.tolist()])
+        walk_times = util.walking_times(
+            start_coords[idx], self.T.stop_coords[first['dep_stop']],
+            config.FOOTPATH_DELTA_BASE, config.FOOTPATH_SPEED_KMH)
+        return idx[dep_times[idx] + walk_times <= first['dep_time']]
+
+    def _cache_journey(self, key, legs):
+        self.journeys[key] = legs
+        self.journeys.move_to_end(key)
+        if len(self.journeys) > self.journey_cache_size:
+            self.journeys.popitem(last=False)
+
+    def route_by_arrival(self, start_coord, end_coord, arr_time, closest_stops=2):
+        """compute the route between a start and an end that
+        departs the latest while arriving by `arr_time`.
+        returns `(route, time, dep_time)`"""
+        result = self.route_by_arrival_batch([start_coord], [end_coord], [arr_time], closest_stops=closest_stops)[0]
+        if result is None:
+            raise NoTransitRouteFound
+        return result
+
+    def route_by_arrival_batch(self, start_coords, end_coords, arr_times, closest_stops=2):
+        """like `route_by_arrival`, but for many trips at once
+        (see `route_batch`), returning a `(route, time, dep_time)`
+        per trip, or `None` where no route was found"""
+        end_coords = np.asarray(end_coords, dtype=np.float64).reshape(-1, 2)
+        arr_times = np.ascontiguousarray(arr_times, dtype=np.float64)
+        starts, ends, same_stops, direct_walk_times = self._candidate_stops(
+            start_coords, end_coords, closest_stops)
+
+        # find the latest departure for each trip,
+        # each in a single scan (by arrival time)
+        dep_times, times, legs, leg_offsets = self.csa.route_by_arrival_batch(
+            *starts, *ends, arr_times, self.active_trips)
+
+        results = [
+            None if result is None else result + (dep_time,)
+            for result, dep_time in zip(
+                self._finish_routes(legs, leg_offsets, times, end_coords, dep_times),
+                dep_times.tolist())]
+        for i in np.flatnonzero(same_stops).tolist():
+            results[i] = (
+                [WalkLeg(direct_walk_times[i])], direct_walk_times[i],
+                arr_times[i] - direct_walk_times[i])
+        return results
+
+    def _candidate_stops(self, start_coords, end_coords, closest_stops):
+        """candidate start and end stops for each trip, in CSR form,
+        i.e. `(iids, walk times, offsets)` for each of starts and ends
+        (see `Transit.candidate_stops`), and whether
+        walking directly is the best option for each trip"""
+        start_coords = np.asarray(start_coords, dtype=np.float64).reshape(-1, 2)
+        end_coords = np.asarray(end_coords, dtype=np.float64).reshape(-1, 2)
+
         # NB here we assume people have no preference b/w transit mode,
         # i.e. they are equally likely to choose a bus stop or a subway stop.
-        # increasing the closest stops will increase likelihood of finding best
-        # route, but also significantly increases routing time
-        start_stops = {
-            self.T.stop_idx.idx[stop_id]: walk_time for stop_id, walk_time in self.T.closest_stops(start_coord, n=closest_stops)
-        }
-        end_stops = {
-            self.T.stop_idx.idx[stop_id]: walk_time for stop_id, walk_time in self.T.closest_stops(end_coord, n=closest_stops)
-        }
-        same_stops = set(start_stops.keys()) & set(end_stops.keys())
-
-        # if a same stop is in start and end stops,
+        # all stops within walking distance (and at least the `closest_stops` closest)
+        # are candidates, except those served by the same routes as a closer one.
+        # all candidates are considered in a single query,
+        # so more candidates only modestly increase routing time
+        starts = self.T.candidate_stops(start_coords, max_walk=self.max_access_walk, min_stops=closest_stops)
+        ends = self.T.candidate_stops(end_coords, max_walk=self.max_access_walk, min_stops=closest_stops)
+
+        # if a same stop is among the closest start and end stops,
         # walking is probably the best option
-        direct_walk_time = util.walking_time(
-            start_coord, end_coord,
-            config.FOOTPATH_DELTA_BASE, config.FOOTPATH_SPEED_KMH)
-        if same_stops:
-            return [WalkLeg(time=direct_walk_time)], direct_walk_time
-
-        # find best combination of start/end stops
-        starts = []
-        ends = []
-        dep_times = []
-        walk_times = []
-        for (s_stop, s_walk), (e_stop, e_walk) in product(start_stops.items(), end_stops.items()):
-            starts.append(s_stop)
-            ends.append(e_stop)
-            dep_times.append(dep_time)
-            walk_times.append(s_walk + e_walk)
-
-        route = self.csa.route_many(starts, ends, dep_times, walk_times)
-        if not route['path']:
+        direct_walk_times = util.walking_times(
+            start_coords, end_coords,
+            config.FOOTPATH_DELTA_BASE, config.FOOTPATH_SPEED_KMH).tolist()
+        start_keys, start_closest = self._candidate_keys(*starts, closest_stops)
+        end_keys, end_closest = self._candidate_keys(*ends, closest_stops)
+        shared = start_keys[start_closest & np.isin(start_keys, end_keys[end_closest])]
+        same_stops = np.bincount(shared // len(self.T.stop_xy), minlength=len(start_coords)) > 0
+
+        # otherwise a stop that's a candidate at both ends is kept at only
+        # one of them, as it'd be reached by walking to it before any journey
+        # into it, which then couldn't end there (see `csa.best_route`).
+        # it's kept as a start stop unless it's among the closest end stops,
+        # so the closest start and end stops are always candidates
+        drop_starts = np.isin(start_keys, end_keys[end_closest])
+        drop_ends = np.isin(end_keys, start_keys[~drop_starts])
+        starts = self._drop_candidates(*starts, drop_starts)
+        ends = self._drop_candidates(*ends, drop_ends)
+        return starts, ends, same_stops, direct_walk_times
+
+    def _candidate_keys(self, iids, times, offsets, n):
+        """candidate stops as `trip * n_stops + stop iid` keys,
+        and whether each is among its trip's `n` closest"""
+        trips = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets.astype(np.int64)))
+        closest = np.arange(len(iids)) - offsets[trips].astype(np.int64) < n
+        return trips * len(self.T.stop_xy) + iids, closest
+
+    def _drop_candidates(self, iids, times, offsets, drop):
+        """remove the `drop` (mask) candidate stops"""
+        trips = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets.astype(np.int64)))
+        offsets = np.zeros(len(offsets), dtype=np.uint32)
+        offsets[1:] = np.cumsum(np.bincount(trips[~drop], minlength=len(offsets) - 1))
+        return iids[~drop], times[~drop], offsets
+
+    def route_from_trees(self, start_coord, end_coord, dep_time, closest_stops=2):
+        """like `route`, but extracts the route from cached
+        one-to-all trees from each start stop, so that trips
+        leaving from the same stops at around the same time
+        share a single scan"""
+        (start_stops, start_walks, _), (end_stops, end_walks, _), same_stops, direct_walk_times = \
+            self._candidate_stops([start_coord], [end_coord], closest_stops)
+
+        # if a same stop is among the closest start and end stops,
+        # walking is probably the best option
+        if same_stops[0]:
+            return [WalkLeg(direct_walk_times[0])], direct_walk_times[0]
+
+        best, best_legs = self._query_trees(start_stops, start_walks, end_stops, end_walks, dep_time)
+        if best_legs is None:
             raise NoTransitRouteFound
+        return self._finish_route(best_legs, best - dep_time, end_coord, dep_time)
 
-        # Correct route order (start->end)
-        time = route['time']
-        route = route['path'][::-1]
-
-        # Compute some combination of the route and walking
-        while len(route) > 1:
-            # Get current leg and previous leg
-            leg = route.pop()
-            prev_leg = route[-1]
-
-            # Check if, from the previous leg's arrival time,
-            # walking directly to the end stop is faster
-            # and a "reasonable" distance
-            stop_id = self.T.stop_idx.id[prev_leg['arr_stop']]
-            stop = self.T.stops.loc[stop_id]
-            stop_coord = stop.stop_lat, stop.stop_lon
-            walk_time_to_end = util.walking_time(
-                stop_coord, end_coord,
-                config.FOOTPATH_DELTA_BASE, config.FOOTPATH_SPEED_KMH)
-            leg_time_to_end = time - (prev_leg['arr_time'] - dep_time)
-            if walk_time_to_end > leg_time_to_end:
-                # Add the removed leg back on
-                route.append(leg)
-                break
-
-        # Add on the last walk leg from last stop
-        stop_id = self.T.stop_idx.id[route[-1]['arr_stop']]
-        stop = self.T.stops.loc[stop_id]
-        stop_coord = stop.stop_lat, stop.stop_lon
-        walk_time = util.walking_time(
-            stop_coord, end_coord,
+    def _query_trees(self, start_stops, start_walks, end_stops, end_walks, dep_time):
+        """find the start stop with the best arrival for a trip
+        (see `_candidate_stops`) from the cached trees, returning the
+        raw arrival time and legs, as `_query_batch` does for a batch"""
+        end_stops, end_walks = end_stops.tolist(), end_walks.tolist()
+        best, best_legs = np.inf, None
+        for stop, walk_time in zip(start_stops.tolist(), start_walks.tolist()):
+            arr_time, legs = self.tree(stop, dep_time + walk_time).route(
+                end_stops, end_walks, dep_time + walk_time)
+
+            # the cached tree's best route leaves too early
+            if legs is None:
+                arr_time, legs = self.csa.tree(stop, dep_time + walk_time, self.active_trips).route(
+                    end_stops, end_walks)
+            if arr_time < best:
+                best, best_legs = arr_time, legs
+        return best, best_legs
+
+    def tree(self, stop, dep_time):
+        """the cached one-to-all tree from a stop (iid)
+        for the departure time's bucket, computing it if needed.
+        trees are computed for the start of the bucket, so their
+        routes may leave before a departure time within it
+        (see `ConnectionTree.route`)"""
+        bucket = int(dep_time // config.TRANSIT_TREE_BUCKET)
+        key = (stop, bucket)
+        try:
+            tree = self.trees[key]
+            self.trees.move_to_end(key)
+            self.tree_hits += 1
+        except KeyError:
+            tree = self.csa.tree(stop, bucket * config.TRANSIT_TREE_BUCKET, self.active_trips)
+            self.trees[key] = tree
+            self.tree_misses += 1
+            if len(self.trees) > config.TRANSIT_TREE_CACHE_SIZE:
+                self.trees.popitem(last=False)
+        return tree
+
+    def profile(self, start_coord, end_coord, dep_window, closest_stops=2):
+        """compute routes between a start and an end
+        for every departure time in `dep_window`, `(earliest, latest)`,
+        with a single (backward) scan. returns a `RouteProfile`"""
+        (start_stops, start_walks, _), (end_stops, end_walks, _), same_stops, direct_walk_times = \
+            self._candidate_stops([start_coord], [end_coord], closest_stops)
+
+        # if a same stop is among the closest start and end stops,
+        # walking is probably the best option
+        if same_stops[0]:
+            return RouteProfile(self, end_coord, None, None, None, None, walk_time=direct_walk_times[0])
+
+        dep_times, arr_times, legs, leg_offsets = self.csa.profile(
+            start_stops.tolist(), start_walks.tolist(),
+            end_stops.tolist(), end_walks.tolist(),
+            dep_window[0], dep_window[1], self.active_trips)
+        return RouteProfile(self, end_coord, dep_times, arr_times, legs, leg_offsets, direct_walk_times[0])
+
+    def _finish_route(self, legs, time, end_coord, dep_time):
+        """trim a route's legs (see `gtfs.util.LEG_DTYPE`)
+        where walking to the end is faster, and add the final walk"""
+        return self._finish_routes(
+            legs, np.array([0, len(legs)], dtype=np.uint32),
+            np.array([time], dtype=np.float64),
+            np.array([end_coord], dtype=np.float64),
+            np.array([dep_time], dtype=np.float64))[0]
+
+    def _finish_routes(self, legs, leg_offsets, times, end_coords, dep_times):
+        """`_finish_route` for packed routes, as returned by batch queries"""
+        # walking times from each leg's arrival stop to its route's end
+        routes = np.repeat(np.arange(len(times)), np.diff(leg_offsets.astype(np.int64)))
+        walk_times_to_end = util.walking_times(
+            self.T.stop_coords[legs['arr_stop']], end_coords[routes],
             config.FOOTPATH_DELTA_BASE, config.FOOTPATH_SPEED_KMH)
-        walk_leg = WalkLeg(time=walk_time)
-
-        # Recalculate time
-        time = (route[-1]['arr_time'] - route[0]['dep_time']) + walk_time
-
-        # Compare direct walking time
-        # TODO may need to constrain this
-        # if direct_walk_time < time:
-        #     return [WalkLeg(time=direct_walk_time)], direct_walk_time
-
-        route = [
-            TransitLeg(
-                dep_stop=l['dep_stop'],
-                arr_stop=l['arr_stop'],
-                dep_time=l['dep_time'],
-                arr_time=l['arr_time'],
-                trip_id=l['trip_id']) if l['type'] == 1
-            else TransferLeg(
-                dep_stop=l['dep_stop'],
-                arr_stop=l['arr_stop'],
-                time=l['time'])
-            for l in route]
-        route.append(walk_leg)
 
-        return route, time
+        # TODO may need to compare with the direct walking time
+        return finish_routes(
+            legs, leg_offsets, np.asarray(times, dtype=np.float64),
+            np.asarray(dep_times, dtype=np.float64), walk_times_to_end)
 
     def route_stops(self, start_idx, end_idx, dep_time):
-        return self.csa.route(start_idx, end_idx, dep_time)
+        return self.csa.route([start_idx], [0.], [end_idx], [0.], dep_time, self.active_trips)
@@ -0,0 +1,132 @@
+"""
+zone-to-zone public transit skims, i.e. matrices of
+travel times and transfer counts between zones (e.g. `zone.ZoneGrid`
+cells or geohashes, by their centroids), for location choice.
+
+skims are stored as `.npy` files in a directory and memory-mapped,
+so they can be larger than memory and shared between processes:
+
+- `times.npy`: `(n_zones, n_zones)` door-to-door travel times (seconds),
+  `inf` where there's no route within the max travel time
+- `transfers.npy`: `(n_zones, n_zones)` transfer counts, -1 where there's no route
+- `stop_times.npy`, `stop_trips.npy`: `(n_zones, n_stops)` the one-to-all scans
+  from each origin zone, i.e. the travel time to and trips taken to each stop,
+  so that destinations can be (re)computed without scanning again
+- `centroids.npy`: the zone centroids the skims were computed for
+"""
+
+import os
+import json
+import config
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class Skim:
+    def __init__(self, router, path, centroids=None, dep_time=None, max_time=config.TRANSIT_SKIM_MAX_TIME):
+        """skims for the trips operating for `router`, departing at `dep_time`.
+        if `centroids` (lat, lons) are given, the skims are computed and
+        saved to `path`; otherwise the skims already there are loaded"""
+        self.router = router
+        self.path = path
+        if centroids is None:
+            self._open('r+')
+        else:
+            self.dep_time = dep_time
+            self.max_time = max_time
+            self._create(np.asarray(centroids, dtype=np.float64).reshape(-1, 2))
+            self._compute(np.arange(self.n_zones), np.arange(self.n_zones))
+
+    @property
+    def n_zones(self):
+        return len(self.centroids)
+
+    def _file(self, name):
+        return os.path.join(self.path, '{}.npy'.format(name))
+
+    def _create(self, centroids):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'dep_time': self.dep_time, 'max_time': self.max_time}, f)
+        n, n_stops = len(centroids), len(self.router.T.stop_xy)
+        self.centroids = np.lib.format.open_memmap(self._file('centroids'), mode='w+', dtype=np.float64, shape=(n, 2))
+        self.centroids[:] = centroids
+        self.times = np.lib.format.open_memmap(self._file('times'), mode='w+', dtype=np.float32, shape=(n, n))
+        self.transfers = np.lib.format.open_memmap(self._file('transfers'), mode='w+', dtype=np.int8, shape=(n, n))
+        self.stop_times = np.lib.format.open_memmap(self._file('stop_times'), mode='w+', dtype=np.float32, shape=(n, n_stops))
+        self.stop_trips = np.lib.format.open_memmap(self._file('stop_trips'), mode='w+', dtype=np.int8, shape=(n, n_stops))
+
+    def _open(self, mode):
+        with open(os.path.join(self.path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.dep_time = meta['dep_time']
+        self.max_time = meta['max_time']
+        for name in ['centroids', 'times', 'transfers', 'stop_times', 'stop_trips']:
+            setattr(self, name, np.load(self._file(name), mmap_mode=mode))
+
+    def update(self, centroids):
+        """recompute the skims for the zones whose centroids
+        changed, reusing the scans from the other zones"""
+        centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 2)
+        if len(centroids) != self.n_zones:
+            raise ValueError('Expected {} zone centroids, got {}'.format(self.n_zones, len(centroids)))
+        changed = np.flatnonzero((centroids != self.centroids).any(axis=1))
+        if not len(changed):
+            return changed
+        logger.info('Updating skims for {} zones...'.format(len(changed)))
+        self.centroids[changed] = centroids[changed]
+        self._compute(changed, changed)
+        return changed
+
+    def _compute(self, origins, dests):
+        """scan from the `origins` zones, then compute the skims
+        for their rows and for the `dests` zones' columns"""
+        logger.info('Scanning from {} zones...'.format(len(origins)))
+        self._scan(origins)
+        self._evaluate(origins, np.arange(self.n_zones))
+        self._evaluate(np.setdiff1d(np.arange(self.n_zones), origins), dests)
+        for arr in [self.centroids, self.times, self.transfers, self.stop_times, self.stop_trips]:
+            arr.flush()
+
+    def _scan(self, origins, chunk_size=256):
+        # one-to-all scans from each origin zone's candidate stops,
+        # a chunk of origins at a time (each chunk in parallel)
+        T = self.router.T
+        n_stops = len(T.stop_xy)
+        for i in range(0, len(origins), chunk_size):
+            chunk = origins[i:i+chunk_size]
+            starts = T.candidate_stops(self.centroids[chunk], max_walk=self.router.max_access_walk)
+            times = np.empty((len(chunk), n_stops), dtype=np.float32)
+            trips = np.empty((len(chunk), n_stops), dtype=np.int8)
+            self.router.csa.scan_many(
+                *starts, self.dep_time, self.max_time,
+                self.router.active_trips, times, trips)
+            self.stop_times[chunk] = times
+            self.stop_trips[chunk] = trips
+
+    def _evaluate(self, origins, dests, chunk_size=256):
+        # the best arrival over each destination zone's candidate
+        # end stops (including egress), from the stored scans
+        if not len(origins) or not len(dests):
+            return
+        iids, walks, offsets = self.router.T.candidate_stops(
+            self.centroids[dests], max_walk=self.router.max_access_walk)
+        starts = offsets[:-1].astype(np.int64)
+        counts = np.diff(offsets.astype(np.int64))
+        for i in range(0, len(origins), chunk_size):
+            chunk = origins[i:i+chunk_size]
+            times = self.stop_times[chunk][:, iids] + walks.astype(np.float32)
+            best = np.minimum.reduceat(times, starts, axis=1)
+
+            # of the tied best end stops, the fewest trips
+            trips = np.where(
+                times == np.repeat(best, counts, axis=1),
+                self.stop_trips[chunk][:, iids], np.iinfo(np.int8).max)
+            trips = np.minimum.reduceat(trips, starts, axis=1)
+
+            reachable = best <= self.max_time
+            self.times[np.ix_(chunk, dests)] = np.where(reachable, best, np.inf)
+            self.transfers[np.ix_(chunk, dests)] = np.where(reachable, np.maximum(trips - 1, 0), -1)
@@ -6,25 +6,158 @@ reference:
 - this repo has some functionality, but no py3 support yet: <https://github.com/google/transitfeed>
 """
 
+import os
+import pyproj
 import zipfile
+import numpy as np
 import pandas as pd
-from io import StringIO
+from pandas.api.types import union_categoricals
 from datetime import timedelta
-from .haversine import haversine
+from .haversine import haversine, haversine_many, walking_times as _walking_times
 
+# a trip's consecutive stop pair,
+# with times relative to the trip's start
+HOP_DTYPE = np.dtype([
+    ('trip_id', np.int32),
+    ('dep_stop', np.uint32),
+    ('arr_stop', np.uint32),
+    ('dep_offset', np.int32),
+    ('arr_offset', np.int32)
+])
 
-def load_gtfs(path):
+# connection table layout, sorted by departure time.
+# each connection is a hop (index into hops)
+# traveled by a vehicle run (index into run starts)
+CONNECTION_DTYPE = np.dtype([
+    ('hop', np.uint32),
+    ('run', np.uint32)
+])
+
+# a stop along a route pattern,
+# with times relative to the start of each run
+PATTERN_STOP_DTYPE = np.dtype([
+    ('stop', np.uint32),
+    ('arr_offset', np.int32),
+    ('dep_offset', np.int32)
+])
+
+FOOTPATH_DTYPE = np.dtype([
+    ('dep_stop', np.uint32),
+    ('arr_stop', np.uint32),
+    ('time', np.float64)
+])
+
+# a route leg as returned by batch CSA queries,
+# where `type` is the CSA connection type (1=trip, 2=foot)
+LEG_DTYPE = np.dtype([
+    ('dep_stop', np.uint32),
+    ('dep_time', np.float64),
+    ('arr_stop', np.uint32),
+    ('arr_time', np.float64),
+    ('type', np.uint8),
+    ('trip_id', np.int32),
+    ('n_stops', np.uint32)
+])
+
+
+# the tables and columns `Transit`/`Calendar` use,
+# with compact dtypes to parse them as
+SCHEMA = {
+    'stops': {
+        'stop_id': str,
+        'stop_lat': np.float64,
+        'stop_lon': np.float64,
+    },
+    'routes': {
+        'route_id': str,
+        'route_type': np.int8,
+    },
+    'trips': {
+        'route_id': str,
+        'service_id': str,
+        'trip_id': str,
+    },
+    'stop_times': {
+        'trip_id': 'category',
+        'stop_id': 'category',
+        'arrival_time': str,
+        'departure_time': str,
+        'stop_sequence': np.int32,
+    },
+    'frequencies': {
+        'trip_id': str,
+        'start_time': str,
+        'end_time': str,
+        'headway_secs': np.int32,
+    },
+    'calendar': dict({
+        'service_id': str,
+        'start_date': str,
+        'end_date': str,
+    }, **{day: np.int8 for day in [
+        'monday', 'tuesday', 'wednesday', 'thursday',
+        'friday', 'saturday', 'sunday']}),
+    'calendar_dates': {
+        'service_id': str,
+        'date': str,
+        'exception_type': np.int8,
+    },
+}
+
+# `HH:MM:SS` columns to parse into integer seconds
+# while loading, as `{column: seconds_column}`
+TIME_COLUMNS = {
+    'stop_times': {'arrival_time': 'arr_sec', 'departure_time': 'dep_sec'},
+    'frequencies': {'start_time': 'start_sec', 'end_time': 'end_sec'},
+}
+
+
+def load_gtfs(path, schema=SCHEMA, chunksize=None):
     """load a GTFS zip and return
-    as a dictionary with dataframes"""
+    as a dictionary with dataframes.
+    only the tables and columns in `schema` are loaded;
+    each file is streamed from the zip rather than read into memory.
+    if `chunksize` is set, tables are parsed `chunksize` rows at a time,
+    so only the compact (parsed) form of the full table is held in memory"""
     zip = zipfile.ZipFile(path, mode='r')
     data = {}
     for f in zip.namelist():
-        k = f.replace('.txt', '')
-        contents = zip.read(f).decode('utf8')
-        data[k] = pd.read_csv(StringIO(contents), dtype={'stop_id': str})
+        k = os.path.basename(f).replace('.txt', '')
+        if k not in schema:
+            continue
+        dtypes = schema[k]
+        with zip.open(f) as stream:
+            reader = pd.read_csv(
+                stream, encoding='utf8',
+                usecols=lambda col: col in dtypes, dtype=dtypes,
+                chunksize=chunksize)
+            if chunksize is None:
+                df = _parse_times(k, reader)
+            else:
+                df = _concat_chunks([_parse_times(k, chunk) for chunk in reader])
+        data[k] = df
     return data
 
 
+def _parse_times(table, df):
+    for col, secs_col in TIME_COLUMNS.get(table, {}).items():
+        if col in df:
+            df[secs_col] = gtfs_times_to_secs(df[col]).astype(np.int32)
+            del df[col]
+    return df
+
+
+def _concat_chunks(chunks):
+    """concatenate parsed chunks,
+    merging the categories of categorical columns"""
+    df = pd.concat(chunks, ignore_index=True)
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].values, pd.Categorical):
+            df[col] = union_categoricals(
+                [chunk[col] for chunk in chunks], sort_categories=True)
+    return df
+
+
 def walking_time(coord_a, coord_b, delta_base, speed_kmh):
     """Calculate footpath time-delta in seconds between two stops,
     based on their lon/lat distance (using Haversine Formula) and walking-speed constant.
@@ -37,11 +170,50 @@ def walking_time(coord_a, coord_b, delta_base, speed_kmh):
     return delta_base + km / (speed_kmh/3600)
 
 
+def walking_times(coords_a, coords_b, delta_base, speed_kmh):
+    """vectorized `walking_time` between two arrays of lat, lons
+    (elementwise). either may be a single coordinate,
+    which is broadcast against the other"""
+    return _walking_times(*_coord_columns(coords_a, coords_b), delta_base, speed_kmh)
+
+
+def haversines(coords_a, coords_b):
+    """vectorized haversine distances (km) between two arrays
+    of lat, lons (elementwise), broadcast like `walking_times`"""
+    return haversine_many(*_coord_columns(coords_a, coords_b))
+
+
+def _coord_columns(coords_a, coords_b):
+    a = np.atleast_2d(np.asarray(coords_a, dtype=np.float64))
+    b = np.atleast_2d(np.asarray(coords_b, dtype=np.float64))
+    a, b = np.broadcast_arrays(a, b)
+    return a[:, 0], a[:, 1], b[:, 0], b[:, 1]
+
+
+def walking_distance(time, delta_base, speed_kmh):
+    """inverse of `walking_time`, i.e. the distance
+    in meters that can be walked in `time` seconds"""
+    return max(time - delta_base, 0) * speed_kmh/3.6
+
+
+def utm_proj(lat, lon):
+    """UTM projection for the zone containing the given coordinate"""
+    zone = int((lon + 180)//6) + 1
+    return pyproj.Proj(proj='utm', zone=zone, south=lat < 0, ellps='WGS84')
+
+
 def gtfs_time_to_secs(time):
     h, m, s = time.split(':')
     return int(s) + (int(m) * 60) + (int(h) * 60 * 60)
 
 
+def gtfs_times_to_secs(times):
+    """vectorized `gtfs_time_to_secs`
+    for a series of `HH:MM:SS` strings"""
+    parts = times.str.split(':', expand=True).astype(np.int64).values
+    return parts[:, 0] * 60 * 60 + parts[:, 1] * 60 + parts[:, 2]
+
+
 def time_to_secs(time):
     return (time.hour * 60 + time.minute) * 60 + time.second
 
@@ -58,3 +230,12 @@ class IntIndex:
         for i, id in enumerate(ids):
             self.id[i] = id  # to ids
             self.idx[id] = i # to iids
+        self.index = pd.Index(ids)
+
+    def iids(self, ids):
+        """vectorized id->iid lookup;
+        unknown ids map to -1"""
+        if isinstance(ids, pd.Categorical):
+            # only look up each category once
+            return self.index.get_indexer(ids.categories)[ids.codes]
+        return self.index.get_indexer(ids)
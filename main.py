@@ -140,14 +140,10 @@ def run(place, gtfs_path, sim_output_path, sim_date, sim_scale, debug):
             # assume people try to arrive at work by 7-9am
             target_arrival_time = random.randint(7*60*60, 9*60*60)
 
-            # rough estimate of travel time
-            avg_speed = 80 #km/h
-            dist = util.haversine(start[0], start[1], end[0], end[1]) # km
-            expected_travel_time = dist/avg_speed
-            dep_time = target_arrival_time - expected_travel_time
-
-            # travel plan
-            stops = [Stop(start=start, end=end, dep_time=dep_time, type=Stop.Type.Commute)]
+            # travel plan;
+            # departure time is adjusted below
+            # once we've estimated travel times
+            stops = [Stop(start=start, end=end, dep_time=target_arrival_time, type=Stop.Type.Commute)]
 
             n_working_family = len(houses[house_id])
             decile = deciles.get(id)
@@ -168,7 +164,41 @@ def run(place, gtfs_path, sim_output_path, sim_date, sim_scale, debug):
 
         if debug:
             agents = agents[:100]
-        sim.run(agents)
+
+        # public transit agents leave as late as they can
+        # while still arriving by their target arrival time
+        # (all planned at once, each in a single scan)
+        public = [a for a in agents if a.public]
+        results = transit_router.route_by_arrival_batch(
+            [a.stops[0].start for a in public],
+            [a.stops[0].end for a in public],
+            [a.stops[0].dep_time for a in public])
+        planned = {}
+        estimated = [a for a in agents if not a.public]
+        for agent, result in zip(public, results):
+            if result is None:
+                # no route gets them there in time, so their
+                # departure is estimated as for cars, below,
+                # and routing is left to the sim
+                estimated.append(agent)
+                continue
+            route, travel_time, dep_time = result
+            agent.stops[0].dep_time = dep_time
+            planned[agent.id] = route, travel_time
+
+        # rough estimate of travel time by car,
+        # computed for all these agents at once
+        if estimated:
+            avg_speed = 80 #km/h
+            dists = util.haversines(
+                [a.stops[0].start for a in estimated],
+                [a.stops[0].end for a in estimated]) # km
+            for agent, dist in zip(estimated, dists.tolist()):
+                expected_travel_time = dist/avg_speed * 60 * 60 # seconds
+                agent.stops[0].dep_time -= expected_travel_time
+
+        sim.run(agents, planned)
+        logger.info('Road route cache: {}'.format(roads.router.route_cache_stats()))
 
         logger.info('Saving simulation results...')
         s = time()
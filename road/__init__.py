@@ -31,6 +31,9 @@ import osmnx as ox
 import numpy as np
 from tqdm import tqdm
 from .router import Router
+from .graph import RoadGraph
+from .state import EdgeState
+from .cch import CCH, dissection_order
 from shapely import geometry
 from .quadtree import QuadTree
 from collections import defaultdict
@@ -218,9 +221,7 @@ class Roads():
                 id = '_'.join(str(p) for p in id)
             d.update({
                 'id': id,
-                'occupancy': 0,
-                'capacity': capacity,
-                'accident': False
+                'capacity': capacity
             })
 
         # impute missing speeds
@@ -240,6 +241,9 @@ class Roads():
         for e in to_remove:
             self.network.remove_edge(*e)
 
+        logger.info('Compiling network...')
+        self._compile_network()
+
         # setup quadtree
         logger.info('Preparing quadtree index...')
         self.idx = self._make_qt_index()
@@ -248,6 +252,66 @@ class Roads():
         self._infer_transit_stops()
 
 
+    def _compile_network(self):
+        """compile the network into arrays for routing,
+        indexing nodes and edges by their order in the network.
+        edge idxs are the same as in `self.edges`"""
+        self.node_ids = list(self.network.nodes)
+        self.node_idx = {n: i for i, n in enumerate(self.node_ids)}
+        self.node_xs = np.array([d['x'] for d in self.network.nodes.values()], dtype=np.float64)
+        self.node_ys = np.array([d['y'] for d in self.network.nodes.values()], dtype=np.float64)
+
+        # edge attributes, and occupancy and accidents,
+        # live in `self.state` rather than the edges' data
+        n_edges = len(self.network.edges)
+        self.edge_frm = np.empty(n_edges, dtype=np.uint32)
+        self.edge_to = np.empty(n_edges, dtype=np.uint32)
+        self.edge_nos = np.empty(n_edges, dtype=np.uint32)
+        self.edge_ids = []
+        state = {f: np.empty(n_edges) for f in ['length', 'maxspeed', 'capacity', 'lanes']}
+        for i, ((u, v, edge_no), d) in enumerate(self.network.edges.items()):
+            d['idx'] = i
+            self.edge_frm[i] = self.node_idx[u]
+            self.edge_to[i] = self.node_idx[v]
+            self.edge_nos[i] = edge_no
+            self.edge_ids.append(d['id'])
+            for f, arr in state.items():
+                arr[i] = d[f]
+        self.state = EdgeState(**state)
+        self.graph = RoadGraph(self.edge_frm, self.edge_to, len(self.node_ids))
+        self._landmarks = False
+        self._ch = None
+
+    def select_landmarks(self):
+        """select the graph's landmarks for A* lower bounds, from
+        free-flow travel times (i.e. `Router.edge_travel_time` without
+        congestion), which congestion only ever makes longer.
+        only A* routing needs them, so they're selected once, when
+        an A* router is set up"""
+        if self._landmarks:
+            return
+        logger.info('Selecting landmarks...')
+        free_flow = self.state.length/(self.state.maxspeed*1000/3600)/config.SPEED_FACTOR
+        self.graph.select_landmarks(free_flow, config.ROAD_LANDMARKS)
+        self._landmarks = True
+
+    @property
+    def ch(self):
+        """the network's customizable contraction hierarchy.
+        this only depends on the network's structure, not its edge
+        weights, so it's built once (on first use, i.e. a cch router's
+        first query) and re-customized"""
+        if self._ch is None:
+            logger.info('Contracting network...')
+            order = dissection_order(self.node_xs, self.node_ys, self.edge_frm, self.edge_to)
+            self._ch = CCH(self.edge_frm, self.edge_to, order)
+        return self._ch
+
+    def update_edge(self, idx):
+        """call after changing the `occupancy` or `accident` state
+        of the edge(s) at `idx`, so routing sees the change"""
+        self.router.update_weights(idx)
+
     def _make_qt_index(self):
         """create the quadtree index"""
         # in lat, lon
@@ -318,8 +382,11 @@ class Roads():
             return sorted(matches, key=lambda i: self.edges[i][-1]['geometry'].distance(pt))
 
 
-    def route(self, start, end):
-        return self.router.route(start, end)
+    def route(self, start, end, dep_time=None):
+        return self.router.route(start, end, dep_time)
+
+    def route_batch(self, starts, ends, dep_times):
+        return self.router.route_batch(starts, ends, dep_times)
 
     def route_bus(self, start_stop, end_stop):
         start_edge = self.stops[start_stop]
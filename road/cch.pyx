@@ -0,0 +1,349 @@
+# distutils: language=c++
+# cython: boundscheck=False, wraparound=False, legacy_implicit_noexcept=True
+# customizable contraction hierarchies: <https://arxiv.org/abs/1402.0402>
+
+import numpy as np
+from libcpp.vector cimport vector
+from libcpp.algorithm cimport sort, unique, reverse
+from numpy.math cimport INFINITY
+
+cdef unsigned int NONE = <unsigned int>-1
+
+
+def dissection_order(xs, ys, edge_frm, edge_to, unsigned int leaf_size=32):
+    """a metric-independent contraction order for the nodes (node idxs, lowest
+    rank first), by recursively splitting the network in half along its longer
+    axis, and ranking the nodes separating the halves above both halves"""
+    n = len(xs)
+    xs, ys = np.asarray(xs), np.asarray(ys)
+
+    # undirected edges, without loops
+    pairs = np.stack([
+        np.minimum(edge_frm, edge_to),
+        np.maximum(edge_frm, edge_to)], axis=1).astype(np.int64)
+    pairs = np.unique(pairs[pairs[:, 0] != pairs[:, 1]], axis=0)
+
+    side = np.zeros(n, dtype=bool)
+    separated = np.zeros(n, dtype=bool)
+    order = []
+
+    def dissect(nodes, us, vs):
+        if len(nodes) <= leaf_size:
+            order.append(nodes)
+            return
+        c = xs[nodes] if np.ptp(xs[nodes]) >= np.ptp(ys[nodes]) else ys[nodes]
+        left = c <= np.median(c)
+        if left.all():
+            order.append(nodes)
+            return
+
+        # separate the halves with the smaller of their boundaries
+        side[nodes] = left
+        cross = side[us] != side[vs]
+        bounds = np.concatenate([us[cross], vs[cross]])
+        lefts = np.unique(bounds[side[bounds]])
+        rights = np.unique(bounds[~side[bounds]])
+        sep = lefts if len(lefts) <= len(rights) else rights
+        separated[sep] = True
+
+        keep = ~(separated[us] | separated[vs])
+        left_edges = keep & side[us]
+        right_edges = keep & ~side[us]
+        left_nodes = nodes[left & ~separated[nodes]]
+        right_nodes = nodes[~left & ~separated[nodes]]
+        dissect(left_nodes, us[left_edges], vs[left_edges])
+        dissect(right_nodes, us[right_edges], vs[right_edges])
+        order.append(sep)
+
+    dissect(np.arange(n), pairs[:, 0], pairs[:, 1])
+    return np.concatenate(order).astype(np.uint32)
+
+
+cdef class CCH:
+    cdef:
+        readonly unsigned int n_nodes
+
+        # contraction rank by node idx, and node idx by rank
+        unsigned int[:] ranks
+        unsigned int[:] order
+
+        # everything below is by rank.
+        # the elimination tree, i.e. each node's
+        # lowest ranked upward neighbor
+        unsigned int[:] parents
+
+        # the (undirected) arcs to higher ranked nodes in
+        # CSR form, i.e. node `i`'s are at `up_offsets[i]:up_offsets[i+1]`,
+        # sorted by the node they go to
+        unsigned int[:] up_offsets
+        unsigned int[:] up_tails
+        unsigned int[:] up_heads
+
+        # by edge idx: the arc an input edge is on,
+        # and whether it goes up (from lower to higher rank)
+        unsigned int[:] edge_arcs
+        unsigned char[:] edge_up
+
+        # the customized metric, by arc and direction:
+        # the least weight, and either the node
+        # it goes via or the input edge it is
+        double[:] up_weights
+        double[:] down_weights
+        unsigned int[:] up_vias
+        unsigned int[:] down_vias
+        unsigned int[:] up_edges
+        unsigned int[:] down_edges
+
+        # query buffers, by rank: forward and backward
+        # weights so far, and the arcs reaching them.
+        # NOTE this means a CCH can't be queried
+        # from multiple python threads at once
+        vector[double] fwd
+        vector[double] bwd
+        vector[unsigned int] fwd_arcs
+        vector[unsigned int] bwd_arcs
+
+    def __init__(self, edge_frm, edge_to, order):
+        """the hierarchy for a road network as `edge_frm` and `edge_to`
+        arrays of node idxs (as for `RoadGraph`), contracting the
+        nodes in the given `order` (see `dissection_order`).
+        `customize` it with edge weights before routing"""
+        self.n_nodes = len(order)
+        self.order = np.asarray(order, dtype=np.uint32)
+        ranks = np.empty(self.n_nodes, dtype=np.uint32)
+        ranks[self.order] = np.arange(self.n_nodes, dtype=np.uint32)
+        self.ranks = ranks
+
+        frm = ranks[np.asarray(edge_frm, dtype=np.int64)]
+        to = ranks[np.asarray(edge_to, dtype=np.int64)]
+        lows, highs = np.minimum(frm, to), np.maximum(frm, to)
+        self.contract(lows, highs)
+
+        # input edges onto arcs; loops have none
+        cdef:
+            size_t e
+            unsigned int[:] lows_view = lows
+            unsigned int[:] highs_view = highs
+        self.edge_arcs = np.full(len(frm), NONE, dtype=np.uint32)
+        self.edge_up = (frm < to).astype(np.uint8)
+        for e in range(len(frm)):
+            if lows_view[e] != highs_view[e]:
+                self.edge_arcs[e] = self.find_arc(lows_view[e], highs_view[e])
+
+        n_arcs = len(self.up_heads)
+        self.up_weights = np.full(n_arcs, np.inf)
+        self.down_weights = np.full(n_arcs, np.inf)
+        self.up_vias = np.full(n_arcs, NONE, dtype=np.uint32)
+        self.down_vias = np.full(n_arcs, NONE, dtype=np.uint32)
+        self.up_edges = np.full(n_arcs, NONE, dtype=np.uint32)
+        self.down_edges = np.full(n_arcs, NONE, dtype=np.uint32)
+
+        self.fwd.assign(self.n_nodes, INFINITY)
+        self.bwd.assign(self.n_nodes, INFINITY)
+        self.fwd_arcs.assign(self.n_nodes, NONE)
+        self.bwd_arcs.assign(self.n_nodes, NONE)
+
+    @property
+    def n_arcs(self):
+        return self.up_heads.shape[0]
+
+    cdef void contract(self, const unsigned int[:] lows, const unsigned int[:] highs):
+        # contracting a node links its upward neighbors to each other.
+        # it's enough to link them to the lowest of them (its parent),
+        # whose contraction then links them on up the tree
+        cdef:
+            size_t i, j
+            unsigned int x, p
+            vector[vector[unsigned int]] nbrs
+        nbrs.resize(self.n_nodes)
+        parents = np.full(self.n_nodes, NONE, dtype=np.uint32)
+        cdef unsigned int[:] parents_view = parents
+        with nogil:
+            for i in range(lows.shape[0]):
+                if lows[i] != highs[i]:
+                    nbrs[lows[i]].push_back(highs[i])
+            for x in range(self.n_nodes):
+                sort(nbrs[x].begin(), nbrs[x].end())
+                nbrs[x].erase(unique(nbrs[x].begin(), nbrs[x].end()), nbrs[x].end())
+                if nbrs[x].empty(): continue
+                p = nbrs[x][0]
+                parents_view[x] = p
+                for j in range(1, nbrs[x].size()):
+                    nbrs[p].push_back(nbrs[x][j])
+
+        offsets = np.zeros(self.n_nodes+1, dtype=np.uint32)
+        cdef unsigned int[:] offsets_view = offsets
+        for x in range(self.n_nodes):
+            offsets_view[x+1] = offsets_view[x] + nbrs[x].size()
+        heads = np.empty(offsets_view[self.n_nodes], dtype=np.uint32)
+        cdef unsigned int[:] heads_view = heads
+        for x in range(self.n_nodes):
+            for j in range(nbrs[x].size()):
+                heads_view[offsets_view[x] + j] = nbrs[x][j]
+        self.parents = parents
+        self.up_offsets = offsets
+        self.up_heads = heads
+        self.up_tails = np.repeat(
+            np.arange(self.n_nodes, dtype=np.uint32),
+            np.diff(offsets.astype(np.int64)))
+
+    cdef unsigned int find_arc(self, unsigned int low, unsigned int high) nogil:
+        # binary search the low node's arcs for the one to the high node
+        cdef:
+            unsigned int lo = self.up_offsets[low]
+            unsigned int hi = self.up_offsets[low+1]
+            unsigned int mid
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.up_heads[mid] < high:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.up_offsets[low+1] and self.up_heads[lo] == high:
+            return lo
+        return NONE
+
+    def customize(self, const double[:] weights):
+        """set the arc weights from the input edge `weights`,
+        then shorten arcs through the triangles below them,
+        from the lowest ranked nodes up"""
+        cdef:
+            size_t e
+            unsigned int x, i, j, arc
+            double w
+        with nogil:
+            for arc in range(self.up_heads.shape[0]):
+                self.up_weights[arc] = INFINITY
+                self.down_weights[arc] = INFINITY
+                self.up_vias[arc] = NONE
+                self.down_vias[arc] = NONE
+                self.up_edges[arc] = NONE
+                self.down_edges[arc] = NONE
+
+            # parallel edges leave the least weight on their arc
+            for e in range(self.edge_arcs.shape[0]):
+                arc = self.edge_arcs[e]
+                if arc == NONE: continue
+                if self.edge_up[e]:
+                    if weights[e] < self.up_weights[arc]:
+                        self.up_weights[arc] = weights[e]
+                        self.up_edges[arc] = e
+                elif weights[e] < self.down_weights[arc]:
+                    self.down_weights[arc] = weights[e]
+                    self.down_edges[arc] = e
+
+            # for each pair of arcs up from `x`, to nodes
+            # `u` (at `i`) and `v` (at `j`) with u below v,
+            # there's an arc between u and v. as arcs are sorted,
+            # u's arcs to each v are found in one pass over them
+            for x in range(self.n_nodes):
+                for i in range(self.up_offsets[x], self.up_offsets[x+1]):
+                    arc = self.up_offsets[self.up_heads[i]]
+                    for j in range(i+1, self.up_offsets[x+1]):
+                        while self.up_heads[arc] != self.up_heads[j]:
+                            arc += 1
+
+                        # u -> x -> v
+                        w = self.down_weights[i] + self.up_weights[j]
+                        if w < self.up_weights[arc]:
+                            self.up_weights[arc] = w
+                            self.up_vias[arc] = x
+
+                        # v -> x -> u
+                        w = self.down_weights[j] + self.up_weights[i]
+                        if w < self.down_weights[arc]:
+                            self.down_weights[arc] = w
+                            self.down_vias[arc] = x
+
+    def route(self, unsigned int source, unsigned int target):
+        """the least-weight path from node `source` to node `target`
+        under the customized weights, as the edge idxs along it,
+        or None if there's no path"""
+        cdef:
+            vector[unsigned int] path
+            bint found
+        if source >= self.n_nodes or target >= self.n_nodes:
+            raise IndexError('Node {} or {} not in graph'.format(source, target))
+        with nogil:
+            found = self._route(self.ranks[source], self.ranks[target], path)
+        if not found:
+            return None
+        return np.array(path, dtype=np.uint32)
+
+    cdef bint _route(self, unsigned int s, unsigned int t, vector[unsigned int]& path) nogil:
+        # search up the elimination tree from both ends;
+        # every arc up from a node goes to one of its ancestors
+        cdef:
+            unsigned int x, i
+            unsigned int meet = NONE
+            double best = INFINITY
+            size_t n_arcs
+
+        self.fwd[s] = 0
+        x = s
+        while x != NONE:
+            if self.fwd[x] < INFINITY:
+                for i in range(self.up_offsets[x], self.up_offsets[x+1]):
+                    if self.fwd[x] + self.up_weights[i] < self.fwd[self.up_heads[i]]:
+                        self.fwd[self.up_heads[i]] = self.fwd[x] + self.up_weights[i]
+                        self.fwd_arcs[self.up_heads[i]] = i
+            x = self.parents[x]
+
+        self.bwd[t] = 0
+        x = t
+        while x != NONE:
+            if self.bwd[x] < INFINITY:
+                for i in range(self.up_offsets[x], self.up_offsets[x+1]):
+                    if self.bwd[x] + self.down_weights[i] < self.bwd[self.up_heads[i]]:
+                        self.bwd[self.up_heads[i]] = self.bwd[x] + self.down_weights[i]
+                        self.bwd_arcs[self.up_heads[i]] = i
+            if self.fwd[x] + self.bwd[x] < best:
+                best = self.fwd[x] + self.bwd[x]
+                meet = x
+            x = self.parents[x]
+
+        if meet != NONE:
+            # arcs up from the source to where the searches meet...
+            x = meet
+            while x != s:
+                path.push_back(self.fwd_arcs[x])
+                x = self.up_tails[self.fwd_arcs[x]]
+            reverse(path.begin(), path.end())
+            n_arcs = path.size()
+            for i in range(n_arcs):
+                self.unpack(path[i], True, path)
+
+            # ...then down from there to the target
+            x = meet
+            while x != t:
+                self.unpack(self.bwd_arcs[x], False, path)
+                x = self.up_tails[self.bwd_arcs[x]]
+            path.erase(path.begin(), path.begin() + n_arcs)
+
+        self.reset(s)
+        self.reset(t)
+        return meet != NONE
+
+    cdef void reset(self, unsigned int x) nogil:
+        # clear the labels up the tree from `x`
+        while x != NONE:
+            self.fwd[x] = INFINITY
+            self.bwd[x] = INFINITY
+            self.fwd_arcs[x] = NONE
+            self.bwd_arcs[x] = NONE
+            x = self.parents[x]
+
+    cdef void unpack(self, unsigned int arc, bint up, vector[unsigned int]& path) nogil:
+        # the input edges along an arc, going up or down it
+        cdef:
+            unsigned int low = self.up_tails[arc]
+            unsigned int high = self.up_heads[arc]
+            unsigned int via = self.up_vias[arc] if up else self.down_vias[arc]
+        if via == NONE:
+            path.push_back(self.up_edges[arc] if up else self.down_edges[arc])
+        elif up:
+            self.unpack(self.find_arc(via, low), False, path)
+            self.unpack(self.find_arc(via, high), True, path)
+        else:
+            self.unpack(self.find_arc(via, high), False, path)
+            self.unpack(self.find_arc(via, low), True, path)
@@ -0,0 +1,260 @@
+# distutils: language=c++
+# cython: boundscheck=False, wraparound=False, legacy_implicit_noexcept=True
+# ALT (A*, landmarks, triangle inequality): <https://www.microsoft.com/en-us/research/publication/computing-the-shortest-path-a-search-meets-graph-theory/>
+
+import numpy as np
+from libcpp.pair cimport pair
+from libcpp.algorithm cimport reverse
+from libcpp.vector cimport vector
+from libcpp.queue cimport priority_queue
+from numpy.math cimport INFINITY
+
+cdef unsigned int NONE = <unsigned int>-1
+
+# queue entries are (-priority, (-insertion no., node)),
+# so the max-heap pops the lowest priority first,
+# breaking ties first-in first-out
+ctypedef pair[long long, unsigned int] Entry
+ctypedef pair[double, Entry] Queued
+
+# (-weight, node) for one-to-all searches
+ctypedef pair[double, unsigned int] Reached
+
+# how many landmarks a query uses, i.e. those
+# giving the best lower bounds from its source
+cdef unsigned int ACTIVE_LANDMARKS = 4
+
+
+cdef class RoadGraph:
+    cdef:
+        readonly unsigned int n_nodes
+
+        # out-edges in CSR form, i.e. node `i`'s are at
+        # `offsets[i]:offsets[i+1]`, with the node each goes to
+        # and its edge idx (for looking up its weight)
+        unsigned int[:] offsets
+        unsigned int[:] heads
+        unsigned int[:] edges
+
+        # in-edges in CSR form, likewise
+        unsigned int[:] in_offsets
+        unsigned int[:] in_tails
+        unsigned int[:] in_edges
+
+        # the node each edge comes from, by edge idx
+        unsigned int[:] tails
+
+        # landmark nodes, and by node and landmark:
+        # the least weight from the landmark to the node,
+        # and from the node to the landmark
+        readonly object landmarks
+        double[:, :] landmark_from
+        double[:, :] landmark_to
+
+        # nodes settled by the last query
+        readonly size_t n_settled
+
+        # query buffers, by node: cost to reach it so far,
+        # the edge reaching it, and whether it's settled.
+        # only the entries a query touches are reset after it.
+        # NOTE this means a RoadGraph can't be queried
+        # from multiple python threads at once
+        vector[double] dist
+        vector[unsigned int] parents
+        vector[char] settled
+        vector[unsigned int] touched
+
+    def __init__(self, edge_frm, edge_to, unsigned int n_nodes):
+        """a road network of `n_nodes` nodes, as `edge_frm` and
+        `edge_to` arrays of node idxs, indexed by edge idx"""
+        self.n_nodes = n_nodes
+        edge_frm = np.asarray(edge_frm, dtype=np.uint32)
+        edge_to = np.asarray(edge_to, dtype=np.uint32)
+        self.tails = edge_frm
+        self.offsets, self.heads, self.edges = csr(edge_frm, edge_to, n_nodes)
+        self.in_offsets, self.in_tails, self.in_edges = csr(edge_to, edge_frm, n_nodes)
+        self.landmarks = np.empty(0, dtype=np.uint32)
+        self.landmark_from = np.empty((n_nodes, 0))
+        self.landmark_to = np.empty((n_nodes, 0))
+
+        self.dist.assign(self.n_nodes, INFINITY)
+        self.parents.assign(self.n_nodes, NONE)
+        self.settled.assign(self.n_nodes, 0)
+
+    def select_landmarks(self, const double[:] weights, unsigned int n_landmarks):
+        """pick `n_landmarks` landmarks spread over the network, each the
+        node farthest from those picked so far, and precompute the weights
+        to and from them. these give `route` lower bounds for any weights
+        at least these `weights`, e.g. free-flow travel times"""
+        landmarks = []
+        landmark_from = np.empty((n_landmarks, self.n_nodes))
+        landmark_to = np.empty((n_landmarks, self.n_nodes))
+
+        # start from the node farthest from an arbitrary one
+        closest = self.distances(0, weights)
+        for i in range(n_landmarks):
+            closest[~np.isfinite(closest)] = -1
+            landmark = int(np.argmax(closest))
+            if i and closest[landmark] <= 0: break
+            landmarks.append(landmark)
+            landmark_from[i] = self.distances(landmark, weights)
+            landmark_to[i] = self.distances(landmark, weights, reverse=True)
+            closest = landmark_from[:i+1].min(axis=0) if i else landmark_from[0].copy()
+        n = len(landmarks)
+        self.landmarks = np.array(landmarks, dtype=np.uint32)
+        self.landmark_from = np.ascontiguousarray(landmark_from[:n].T)
+        self.landmark_to = np.ascontiguousarray(landmark_to[:n].T)
+
+    def distances(self, unsigned int source, const double[:] weights, bint reverse=False):
+        """the least weight from node `source` to every node,
+        or to `source` from every node if `reverse`"""
+        dist = np.full(self.n_nodes, np.inf)
+        cdef:
+            double[:] d = dist
+            vector[char] settled
+            priority_queue[Reached] queue
+            unsigned int[:] offsets = self.in_offsets if reverse else self.offsets
+            unsigned int[:] nodes = self.in_tails if reverse else self.heads
+            unsigned int[:] edges = self.in_edges if reverse else self.edges
+            unsigned int i, u, v
+            double cost
+        with nogil:
+            settled.assign(self.n_nodes, 0)
+            d[source] = 0
+            queue.push(Reached(0, source))
+            while not queue.empty():
+                u = queue.top().second
+                queue.pop()
+                if settled[u]: continue
+                settled[u] = 1
+                for i in range(offsets[u], offsets[u+1]):
+                    v = nodes[i]
+                    cost = d[u] + weights[edges[i]]
+                    if cost < d[v]:
+                        d[v] = cost
+                        queue.push(Reached(-cost, v))
+        return dist
+
+    def route(self, unsigned int source, unsigned int target, const double[:] weights):
+        """the least-weight path from node `source` to node `target`
+        under the edge `weights`, as the edge idxs along it, or None if
+        there's no path. with landmarks (see `select_landmarks`) this is
+        an A* search, otherwise Dijkstra's"""
+        cdef:
+            vector[unsigned int] path
+            bint found
+        if source >= self.n_nodes or target >= self.n_nodes:
+            raise IndexError('Node {} or {} not in graph'.format(source, target))
+        with nogil:
+            found = self._route(source, target, &weights[0], path)
+        if not found:
+            return None
+        return np.array(path, dtype=np.uint32)
+
+    cdef bint _route(self, unsigned int source, unsigned int target,
+                     const double* weights, vector[unsigned int]& path) nogil:
+        cdef:
+            priority_queue[Queued] queue
+            long long n_queued = 0
+            unsigned int i, u, v, e
+            double cost, h
+            bint found = False
+            vector[unsigned int] active
+
+        self.active_landmarks(source, target, active)
+        self.n_settled = 0
+        self.label(source, 0, NONE)
+        queue.push(Queued(0, Entry(0, source)))
+        while not queue.empty():
+            u = queue.top().second.second
+            queue.pop()
+            if self.settled[u]: continue
+            if u == target:
+                found = True
+                break
+            self.settled[u] = 1
+            self.n_settled += 1
+
+            for i in range(self.offsets[u], self.offsets[u+1]):
+                v = self.heads[i]
+                if self.settled[v]: continue
+                e = self.edges[i]
+                cost = self.dist[u] + weights[e]
+
+                # a costlier path to `v` may still be queued,
+                # it's skipped when popped as `v` will be settled
+                if cost < self.dist[v]:
+                    h = self.heuristic(v, target, active)
+                    if h == INFINITY: continue
+                    self.label(v, cost, e)
+                    n_queued += 1
+                    queue.push(Queued(-(cost + h), Entry(-n_queued, v)))
+
+        # edges are walked back from the target
+        if found:
+            v = target
+            while self.parents[v] != NONE:
+                path.push_back(self.parents[v])
+                v = self.tails[self.parents[v]]
+            reverse(path.begin(), path.end())
+
+        for i in range(self.touched.size()):
+            v = self.touched[i]
+            self.dist[v] = INFINITY
+            self.parents[v] = NONE
+            self.settled[v] = 0
+        self.touched.clear()
+        return found
+
+    cdef inline void label(self, unsigned int v, double cost, unsigned int e) nogil:
+        if self.dist[v] == INFINITY:
+            self.touched.push_back(v)
+        self.dist[v] = cost
+        self.parents[v] = e
+
+    cdef void active_landmarks(self, unsigned int source, unsigned int target,
+                               vector[unsigned int]& active) nogil:
+        # the landmarks with the best bounds from the source,
+        # by insertion into a list sorted best first
+        cdef:
+            unsigned int l, i
+            vector[double] bounds
+            vector[unsigned int] one
+        one.push_back(0)
+        for l in range(self.landmark_from.shape[1]):
+            one[0] = l
+            i = bounds.size()
+            bounds.push_back(self.heuristic(source, target, one))
+            active.push_back(l)
+            while i > 0 and bounds[i] > bounds[i-1]:
+                bounds[i], bounds[i-1] = bounds[i-1], bounds[i]
+                active[i], active[i-1] = active[i-1], active[i]
+                i -= 1
+        if active.size() > ACTIVE_LANDMARKS:
+            active.resize(ACTIVE_LANDMARKS)
+
+    cdef double heuristic(self, unsigned int v, unsigned int target,
+                          vector[unsigned int]& active) nogil:
+        # lower bound on the weight from `v` to the target,
+        # by the triangle inequality through each landmark `l`:
+        # d(l, t) <= d(l, v) + d(v, t) and d(v, l) <= d(v, t) + d(t, l).
+        # infinite if `v` can't reach the target
+        cdef:
+            unsigned int i, l
+            double h = 0
+        for i in range(active.size()):
+            l = active[i]
+            if self.landmark_from[v, l] < INFINITY:
+                h = max(h, self.landmark_from[target, l] - self.landmark_from[v, l])
+            if self.landmark_to[target, l] < INFINITY:
+                h = max(h, self.landmark_to[v, l] - self.landmark_to[target, l])
+        return h
+
+
+def csr(frm, to, unsigned int n_nodes):
+    """edges from `frm` to `to` nodes in CSR form, i.e. offsets
+    by `frm` node, the `to` nodes, and the edge idxs"""
+    order = np.argsort(frm, kind='stable').astype(np.uint32)
+    offsets = np.zeros(n_nodes+1, dtype=np.uint32)
+    offsets[1:] = np.cumsum(np.bincount(frm, minlength=n_nodes))
+    return offsets, to[order], order
@@ -1,13 +1,13 @@
-import math
+import os
 import config
-import networkx as nx
-from itertools import count
-from heapq import heappush, heappop
-from collections import namedtuple
+import numpy as np
+import multiprocessing as mp
+from collections import namedtuple, OrderedDict
 
 # `p` tells us the proportion of the edge we actually travel,
 # e.g. if we start earlier or later along the road
-Leg = namedtuple('Leg', ['frm', 'to', 'edge_no', 'p'])
+# `idx` is the edge's idx (see `Roads._compile_network`)
+Leg = namedtuple('Leg', ['frm', 'to', 'edge_no', 'p', 'idx'])
 
 
 class NoRoadRouteFound(Exception): pass
@@ -16,11 +16,42 @@ class NoRoadRouteFound(Exception): pass
 class Router():
     """road network router"""
 
-    def __init__(self, roads):
+    def __init__(self, roads, engine=config.ROAD_ENGINE, route_cache_size=config.ROAD_ROUTE_CACHE_SIZE):
+        """if `route_cache_size` is set, routes given a departure time
+        keep their paths (LRU), keyed by their start and end edges and
+        departure time bucket (`config.ROAD_ROUTE_BUCKET`). a cached path
+        is dropped once any edge along it crosses its capacity threshold"""
         self.roads = roads
         self.network = roads.network
 
-    def route(self, start, end):
+        # edge weights (travel times) for routing,
+        # by edge idx (see `Roads._compile_network`),
+        # and how many times each has changed, i.e. the
+        # edge has crossed its capacity threshold
+        self.weights = self.travel_times()
+        self.edge_versions = np.zeros(len(self.weights), dtype=np.uint32)
+
+        # 'astar' searches the live weights on each query;
+        # 'cch' queries the contraction hierarchy, which only
+        # sees the weights as of its last `customize`.
+        # the hierarchy is built and customized on the first query
+        if engine not in ('astar', 'cch'):
+            raise ValueError('Unknown road routing engine: {}'.format(engine))
+        self.engine = engine
+        self.customized = False
+        if engine == 'astar':
+            roads.select_landmarks()
+
+        # LRU cache of paths, as their edge idxs,
+        # those edges' versions, and when they were routed
+        self.route_cache_size = route_cache_size
+        self.routes = OrderedDict()
+        self.route_hits = 0
+        self.route_misses = 0
+        self.route_invalidations = 0
+        self.route_staleness = 0.
+
+    def route(self, start, end, dep_time=None):
         """compute a road route
         between a start and end coordinate"""
         # find the closest edges to the start
@@ -29,138 +60,209 @@ class Router():
         # and the node that the edge comes from (for the end)
         edge_s = self.roads.find_closest_edge(start)
         edge_e = self.roads.find_closest_edge(end)
-        return self.route_edges(edge_s, edge_e)
+        return self.route_edges(edge_s, edge_e, dep_time)
 
-    def route_edges(self, edge_s, edge_e):
+    def route_edges(self, edge_s, edge_e, dep_time=None):
         """compute a road route between two edges
-        that include 0.-1. positions along the edges"""
-        path = astar(self.network, edge_s.to, edge_e.frm, weight=self.edge_weight, heuristic=self.heuristic)
-
-        # adjust start node
-        path[0] = (edge_s.to, None)
+        that include 0.-1. positions along the edges.
+        if the route cache is enabled and a `dep_time` is given,
+        routes between the same edges at around the same time
+        share a path (see `__init__`)"""
+        key = None
+        path = None
+        if self.route_cache_size and dep_time is not None:
+            key = (edge_s.id, edge_e.id, int(dep_time//config.ROAD_ROUTE_BUCKET))
+            path = self._cached_path(key, dep_time)
+
+        if path is None:
+            source = self.roads.node_idx[edge_s.to]
+            target = self.roads.node_idx[edge_e.frm]
+            if self.engine == 'cch':
+                self._prepare_ch()
+                path = self.roads.ch.route(source, target)
+            else:
+                path = self.roads.graph.route(source, target, self.weights)
+            if path is None:
+                raise NoRoadRouteFound
+            if key is not None:
+                self._cache_path(key, path, dep_time)
 
         # TODO we aren't checking how far `start` and `end`
         # are from `s_pt` and `e_pt`. these should probably be walk actions?
-        route = [Leg(frm=edge_s.frm, to=edge_s.to, edge_no=edge_s.no, p=(1-edge_s.p))]
-        for (u, _), (v, e_no) in zip(path, path[1:]):
-            route.append(Leg(frm=u, to=v, edge_no=e_no, p=1.))
-        route.append(Leg(frm=path[-1][0], to=edge_e.to, edge_no=edge_e.no, p=edge_e.p))
+        node_ids = self.roads.node_ids
+        route = [Leg(frm=edge_s.frm, to=edge_s.to, edge_no=edge_s.no, p=(1-edge_s.p), idx=edge_s.id)]
+        for idx, frm, to, edge_no in zip(path.tolist(), self.roads.edge_frm[path], self.roads.edge_to[path], self.roads.edge_nos[path]):
+            route.append(Leg(frm=node_ids[frm], to=node_ids[to], edge_no=int(edge_no), p=1., idx=idx))
+        route.append(Leg(frm=edge_e.frm, to=edge_e.to, edge_no=edge_e.no, p=edge_e.p, idx=edge_e.id))
         return route
 
-    def heuristic(self, u, v):
-        u = self.network.nodes[u]
-        v = self.network.nodes[v]
-        return math.sqrt((u['x']-v['x'])**2 + (u['y'] - v['y'])**2)
-
-    def edge_weight(self, edges):
-        """determines the attractiveness/speed of a
-        network edge; the lower the better"""
-        # there may be multiple edges;
-        # default to the shortest
-        edges = [(idx, self.edge_travel_time(data)) for idx, data in edges.items()]
-        return min(edges, key=lambda e: e[1])
-
-    def edge_travel_time(self, edge):
-        """travel time for a traveler entering an edge"""
-        # occupancy, including this new vehicle
-        occupancy = edge['occupancy'] + self.roads.vehicle_size
+    def route_batch(self, starts, ends, dep_times, processes=config.ROAD_PLANNING_PROCESSES, chunk_size=256):
+        """compute road routes (as for `route`) for many trips, across a
+        pool of `processes` processes (all cores if None), in order.
+        trips with no route get None.
+
+        workers are forked, so they share the network, compiled graph
+        and edge state copy-on-write rather than having them pickled;
+        only the trips and their routes are sent between processes.
+        routing is deterministic, so this gives the same routes as
+        routing the trips one by one"""
+        global _router
+        trips = list(zip(starts, ends, dep_times))
+        chunks = [trips[i:i+chunk_size] for i in range(0, len(trips), chunk_size)]
+        if processes is None:
+            processes = os.cpu_count()
+        if processes <= 1 or len(chunks) <= 1 or 'fork' not in mp.get_all_start_methods():
+            return _route_trips(self, trips)
+
+        # make sure the hierarchy is built before forking
+        if self.engine == 'cch':
+            self._prepare_ch()
+
+        _router = self
+        try:
+            with mp.get_context('fork').Pool(processes) as pool:
+                results = pool.map(_route_chunk, chunks)
+        finally:
+            _router = None
+
+        # keep the paths the workers cached,
+        # and drop those they found invalid
+        routes = []
+        for chunk_routes, cached, invalid, (hits, misses, invalidations, staleness) in results:
+            routes.extend(chunk_routes)
+            for key in invalid:
+                self.routes.pop(key, None)
+            for key, entry in cached:
+                self.routes[key] = entry
+                self.routes.move_to_end(key)
+            while len(self.routes) > self.route_cache_size:
+                self.routes.popitem(last=False)
+            self.route_hits += hits
+            self.route_misses += misses
+            self.route_invalidations += invalidations
+            self.route_staleness += staleness
+        return routes
+
+    def _cached_path(self, key, dep_time):
+        """the cached path for the key, if
+        none of its edges have changed since"""
+        try:
+            path, versions, routed_at = self.routes[key]
+        except KeyError:
+            self.route_misses += 1
+            return None
+        if (self.edge_versions[path] != versions).any():
+            del self.routes[key]
+            self.route_invalidations += 1
+            self.route_misses += 1
+            return None
+        self.routes.move_to_end(key)
+        self.route_hits += 1
+        self.route_staleness += abs(dep_time - routed_at)
+        return path
+
+    def _cache_path(self, key, path, dep_time):
+        self.routes[key] = (path, self.edge_versions[path], dep_time)
+        self.routes.move_to_end(key)
+        if len(self.routes) > self.route_cache_size:
+            self.routes.popitem(last=False)
+
+    def route_cache_stats(self):
+        """hit rate of the route cache, how many cached paths were
+        dropped for congestion changes, and the mean time (seconds)
+        between when hits' paths were routed and their departures"""
+        n = self.route_hits + self.route_misses
+        return {
+            'hits': self.route_hits,
+            'misses': self.route_misses,
+            'invalidations': self.route_invalidations,
+            'hit_rate': self.route_hits/n if n else 0.,
+            'mean_staleness': self.route_staleness/self.route_hits if self.route_hits else 0.
+        }
+
+    def customize(self):
+        """refresh the contraction hierarchy's
+        weights from the current edge weights.
+        does nothing until the first query has
+        built and customized the hierarchy"""
+        if self.engine == 'cch' and self.customized:
+            self.roads.ch.customize(self.weights)
+
+    def _prepare_ch(self):
+        if not self.customized:
+            self.roads.ch.customize(self.weights)
+            self.customized = True
+
+    def update_weights(self, idxs=slice(None)):
+        """recompute the weights of the edges at `idxs` (all by
+        default), e.g. after their occupancy changes"""
+        weights = self.travel_times(idxs)
+        self.edge_versions[idxs] += weights != self.weights[idxs]
+        self.weights[idxs] = weights
+
+    def edge_travel_time(self, idx):
+        """travel time for a traveler entering the edge at `idx`"""
+        return float(self.travel_times(idx))
+
+    def travel_times(self, idxs=slice(None)):
+        """travel times for a traveler entering
+        the edges at `idxs` (all by default)"""
+        state = self.roads.state
 
-        capacity = edge['capacity']
+        # occupancy, including this new vehicle
+        occupancy = state.occupancy[idxs] + self.roads.vehicle_size
 
         # Halve capacity if there's an accident on the road
-        if edge['accident']: capacity /= 2
+        capacity = np.where(state.accident[idxs], state.capacity[idxs]/2, state.capacity[idxs])
 
         # assuming each vehicle takes its own lane
         # if possible
-        # occupancy_per_lane = self.roads.vehicle_size + (occupancy-self.roads.vehicle_size)//edge['lanes']
+        # occupancy_per_lane = self.roads.vehicle_size + (occupancy-self.roads.vehicle_size)//state.lanes[idxs]
 
         # Congestion is complex so this is only a simple heuristic.
         # It varies depending on headway, speed of cars in front, and other factors
-        # congestion_multiplier = 1 + math.sqrt(occupancy_per_lane**2/edge['capacity'])
-        if occupancy > capacity:
-            congestion_multiplier = 0.1
-        else:
-            congestion_multiplier = 1.
+        # congestion_multiplier = 1 + np.sqrt(occupancy_per_lane**2/state.capacity[idxs])
+        congestion_multiplier = np.where(occupancy > capacity, 0.1, 1.)
 
         # assuming people always drive at maxspeed
         # maxspeed in km/h
-        meters_per_hour = edge['maxspeed'] * 1000
+        meters_per_hour = state.maxspeed[idxs] * 1000
         meters_per_second = meters_per_hour/(3600)
         speed = meters_per_second * congestion_multiplier
 
         # time should be in seconds
-        time = (edge['length']/speed)
+        time = (state.length[idxs]/speed)
 
         return time/config.SPEED_FACTOR
 
 
-
-def astar(G, source, target, heuristic=None, weight='weight'):
-    if source not in G or target not in G:
-        msg = 'Either source {} or target {} is not in G'
-        raise nx.NodeNotFound(msg.format(source, target))
-
-    if heuristic is None:
-        # The default heuristic is h=0 - same as Dijkstra's algorithm
-        def heuristic(u, v):
-            return 0
-
-    push = heappush
-    pop = heappop
-
-    # The queue stores priority, node, cost to reach, parent, and selected edge.
-    # Uses Python heapq to keep in priority order.
-    # Add a counter to the queue to prevent the underlying heap from
-    # attempting to compare the nodes themselves. The hash breaks ties in the
-    # priority and is guaranteed unique for all nodes in the graph.
-    c = count()
-    queue = [(0, next(c), source, 0, None, None)]
-
-    # Maps enqueued nodes to distance of discovered paths and the
-    # computed heuristics to target. We avoid computing the heuristics
-    # more than once and inserting the node into the queue too many times.
-    enqueued = {}
-    # Maps explored nodes to parent closest to the source.
-    explored = {}
-    ancestors = {}
-
-    while queue:
-        # Pop the smallest item from queue.
-        _, __, curnode, dist, parent, edge = pop(queue)
-
-        if curnode == target:
-            path = [(curnode, edge)]
-            node = parent
-            while node is not None:
-                # node = explored[node]
-                prev_node, edge = ancestors[node]
-                path.append((node, edge))
-                node = prev_node
-            path.reverse()
-            return path
-
-        if curnode in explored:
-            continue
-
-        explored[curnode] = parent
-        ancestors[curnode] = (parent, edge)
-
-        for neighbor, edges in G[curnode].items():
-            if neighbor in explored:
-                continue
-            edge, cost = weight(edges)
-            ncost = dist + cost
-            if neighbor in enqueued:
-                qcost, h = enqueued[neighbor]
-                # if qcost < ncost, a longer path to neighbor remains
-                # enqueued. Removing it would need to filter the whole
-                # queue, it's better just to leave it there and ignore
-                # it when we visit the node a second time.
-                if qcost <= ncost:
-                    continue
-            else:
-                h = heuristic(neighbor, target)
-            enqueued[neighbor] = ncost, h
-            push(queue, (ncost + h, next(c), neighbor, ncost, curnode, edge))
-
-    raise NoRoadRouteFound
+# the router forked `Router.route_batch` workers route with
+_router = None
+
+def _route_chunk(trips):
+    """route a chunk of trips in a worker, returning the routes,
+    the paths newly cached for them, the keys of cached paths
+    dropped as invalid, and the changes to the cache's stats"""
+    router = _router
+    cached = dict(router.routes)
+    stats = _cache_counts(router)
+    routes = _route_trips(router, trips)
+    new = [(key, entry) for key, entry in router.routes.items() if cached.get(key) is not entry]
+    invalid = [
+        key for key, (path, versions, _) in cached.items()
+        if router.routes.get(key) is not cached[key]
+        and (router.edge_versions[path] != versions).any()]
+    return routes, new, invalid, [n - m for n, m in zip(_cache_counts(router), stats)]
+
+def _cache_counts(router):
+    return (router.route_hits, router.route_misses,
+            router.route_invalidations, router.route_staleness)
+
+def _route_trips(router, trips):
+    routes = []
+    for start, end, dep_time in trips:
+        try:
+            routes.append(router.route(start, end, dep_time))
+        except NoRoadRouteFound:
+            routes.append(None)
+    return routes
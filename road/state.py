@@ -0,0 +1,34 @@
+import numpy as np
+
+
+class EdgeState():
+    """the road network's edge attributes and live state,
+    as arrays indexed by edge idx (see `Roads._compile_network`),
+    shared by the router and the simulation"""
+
+    fields = ['length', 'maxspeed', 'capacity', 'lanes', 'occupancy', 'accident']
+
+    def __init__(self, length, maxspeed, capacity, lanes, occupancy=None, accident=None):
+        # length in meters, maxspeed in km/h, capacity in veh/h
+        self.length = np.asarray(length, dtype=np.float64)
+        self.maxspeed = np.asarray(maxspeed, dtype=np.float64)
+        self.capacity = np.asarray(capacity, dtype=np.float64)
+        self.lanes = np.asarray(lanes, dtype=np.uint32)
+        if occupancy is None:
+            occupancy = np.zeros(len(self.length), dtype=np.float64)
+        if accident is None:
+            accident = np.zeros(len(self.length), dtype=bool)
+        self.occupancy = occupancy
+        self.accident = accident
+
+    def __len__(self):
+        return len(self.length)
+
+    def copy(self):
+        """snapshot the state"""
+        return EdgeState(*[getattr(self, f).copy() for f in self.fields])
+
+    def restore(self, snapshot):
+        """restore the state from a snapshot, in place"""
+        for f in self.fields:
+            np.copyto(getattr(self, f), getattr(snapshot, f))
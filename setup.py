@@ -11,13 +11,29 @@ ext_modules = [
         extra_compile_args=['-fopenmp'],
         extra_link_args=['-fopenmp'],
     ),
+    Extension(
+        'gtfs.raptor',
+        ['gtfs/raptor.pyx'],
+        extra_compile_args=['-fopenmp'],
+        extra_link_args=['-fopenmp'],
+    ),
     Extension(
         'gtfs.haversine',
-        ['gtfs/haversine.pyx']
+        ['gtfs/haversine.pyx'],
+        extra_compile_args=['-fopenmp'],
+        extra_link_args=['-fopenmp'],
     ),
     Extension(
         'road.quadtree',
         ['road/quadtree.pyx']
+    ),
+    Extension(
+        'road.graph',
+        ['road/graph.pyx']
+    ),
+    Extension(
+        'road.cch',
+        ['road/cch.pyx']
     )
 ]
 
@@ -19,6 +19,10 @@ Passenger = recordclass('Passenger', ['id', 'route'])
 Stop = recordclass('Stop', ['start', 'end', 'dep_time', 'type'])
 Agent = recordclass('Agent', ['id', 'stops', 'public'])
 
+# for agents whose next trip wasn't planned in advance,
+# as opposed to planned but with no route found (`None`)
+UNPLANNED = object()
+
 
 class VehicleType(enum.Enum):
     Public = 0
@@ -80,11 +84,23 @@ class TransitSim(Sim):
             }
         }
 
-    def run(self, agents):
+    def run(self, agents, planned=None):
         self.queue_public_transit()
-        self.queue_agents(agents)
+        self.queue_agents(agents, planned)
+        if len(self.events):
+            self.queue(self.events.next_time(), self.customize_roads)
         super().run()
 
+    def customize_roads(self, time):
+        """refresh the road routers' weights from current
+        traffic, every `config.ROAD_CUSTOMIZE_INTERVAL` minutes
+        while there are other events to process"""
+        self.roads.router.customize()
+        self.transit_roads.router.customize()
+        if not len(self.events):
+            return []
+        return [(config.ROAD_CUSTOMIZE_INTERVAL*60, self.customize_roads)]
+
     def on_agent_arrive(self, agent, stop, time):
         # record data
         self.data['agent_trips'].append((agent.id, stop.start, stop.end, stop.type, float(stop.dep_time), float(time)))
@@ -95,7 +111,10 @@ class TransitSim(Sim):
         # schedule next stop
         return [self.route_agent(agent)]
 
-    def route_agent(self, agent):
+    def route_agent(self, agent, planned=UNPLANNED):
+        """route the agent's next stop. `planned` is an already
+        computed public transit `(route, time)` or road route, if any,
+        or `None` if no route was found for it"""
         if not agent.stops:
             return
 
@@ -104,7 +123,11 @@ class TransitSim(Sim):
         on_arrive = partial(self.on_agent_arrive, agent, stop)
         if agent.public:
             try:
-                route, time = self.router.route(stop.start, stop.end, stop.dep_time)
+                if planned is UNPLANNED:
+                    planned = self.router.route(stop.start, stop.end, stop.dep_time)
+                elif planned is None:
+                    raise NoTransitRouteFound
+                route, time = planned
                 pas = Passenger(id=agent.id, route=route)
                 return stop.dep_time, partial(self.passenger_next, pas, on_arrive)
             except NoTransitRouteFound:
@@ -115,7 +138,11 @@ class TransitSim(Sim):
                 return
         else:
             try:
-                route = self.roads.route(stop.start, stop.end)
+                if planned is UNPLANNED:
+                    planned = self.roads.route(stop.start, stop.end, stop.dep_time)
+                elif planned is None:
+                    raise NoRoadRouteFound
+                route = planned
             except NoRoadRouteFound:
                 # TODO just skipping for now
                 # likely because something is wrong with the road network
@@ -126,13 +153,36 @@ class TransitSim(Sim):
             self.vehicles[veh.id] = veh
             return stop.dep_time, partial(self.road_next, veh, on_arrive)
 
-    def queue_agents(self, agents):
+    def queue_agents(self, agents, planned=None):
         """queue agents trip,
-        which may be via car or public transit"""
+        which may be via car or public transit.
+        `planned` optionally maps agent ids to already
+        computed public transit `(route, time)`s for their first trips"""
         logger.info('Preparing agents...')
+
+        # plan the remaining public transit agents' first trips
+        # all at once, so they are routed in parallel
+        planned = dict(planned or {})
+        public = [agent for agent in agents
+                  if agent.public and agent.stops and agent.id not in planned]
+        routes = self.router.route_batch(
+            [agent.stops[0].start for agent in public],
+            [agent.stops[0].end for agent in public],
+            [agent.stops[0].dep_time for agent in public])
+        planned.update({agent.id: route for agent, route in zip(public, routes)})
+
+        # and the car agents' first trips, across processes
+        private = [agent for agent in agents
+                   if not agent.public and agent.stops and agent.id not in planned]
+        routes = self.roads.route_batch(
+            [agent.stops[0].start for agent in private],
+            [agent.stops[0].end for agent in private],
+            [agent.stops[0].dep_time for agent in private])
+        planned.update({agent.id: route for agent, route in zip(private, routes)})
+
         for agent in tqdm(agents):
             self.data['agent_trip_types'][agent.id] = agent.public
-            ev = self.route_agent(agent)
+            ev = self.route_agent(agent, planned.get(agent.id, UNPLANNED))
             if ev is not None:
                 self.queue(*ev)
 
@@ -336,6 +386,12 @@ class TransitSim(Sim):
             self.stops[dep_stop][trip_id].append((arr_stop, action))
             return []
 
+    def road_network(self, vehicle_type):
+        """the road network vehicles of this type travel on"""
+        if vehicle_type is VehicleType.Public:
+            return self.transit_roads
+        return self.roads
+
     def road_travel(self, path, vehicle_type):
         """travel along road route"""
         # last node in path
@@ -344,44 +400,41 @@ class TransitSim(Sim):
             return
 
         leg = path[0]
-        if vehicle_type is VehicleType.Public:
-            edge = self.transit_roads.network[leg.frm][leg.to][leg.edge_no]
-        else:
-            edge = self.roads.network[leg.frm][leg.to][leg.edge_no]
+        roads = self.road_network(vehicle_type)
 
         # where leg.p is the proportion of the edge we travel
-        time = self.roads.router.edge_travel_time(edge) * leg.p
+        time = roads.router.edge_travel_time(leg.idx) * leg.p
 
-        return leg, edge, time
+        return leg, leg.idx, time
 
     def road_next(self, vehicle, on_arrive, time):
         """compute next event in road trip"""
         events = []
-        edge = vehicle.current
-        if edge is not None:
+        roads = self.road_network(vehicle.type)
+        occupancy = roads.state.occupancy
+        idx = vehicle.current
+        if idx is not None:
             # leave previous edge
-            edge['occupancy'] -= self.roads.vehicle_size
-            if edge['occupancy'] < 0:
+            occupancy[idx] -= self.roads.vehicle_size
+            if occupancy[idx] < 0:
                 raise Exception('occupancy should be positive')
+            roads.update_edge(idx)
             vehicle.route.pop(0)
-            self.data['road_capacities'][edge['id']].append((float(edge['occupancy']), float(time)))
+            self.data['road_capacities'][roads.edge_ids[idx]].append((float(occupancy[idx]), float(time)))
 
         # compute next leg
         leg = self.road_travel(vehicle.route, vehicle.type)
 
         # random accidents
         if random.random() < config.BASE_ACCIDENT_PROB:
-            # sort edges by occupancy
-            edges = [(e[:3], e[-1]['occupancy'])
-                     for e in self.roads.network.edges(keys=True, data=True)
-                     if e[-1]['occupancy'] > 0]
-            if len(edges) > 0:
-                edges, probs = zip(*edges)
-                edge_idxs = range(len(edges))
+            # edges weighted by occupancy
+            occupied = np.flatnonzero(self.roads.state.occupancy > 0)
+            if len(occupied) > 0:
+                probs = self.roads.state.occupancy[occupied]
                 probs = probs/np.sum(probs)
-                edge_idx = np.random.choice(edge_idxs, 1, p=probs)[0]
-                edge = edges[edge_idx]
-                self.roads.network.edges[edge]['accident'] = True
+                edge = np.random.choice(occupied, 1, p=probs)[0]
+                self.roads.state.accident[edge] = True
+                self.roads.update_edge(edge)
                 logger.debug('Accident occurred at edge: {}'.format(edge))
 
                 # Accident cleared up event
@@ -394,15 +447,16 @@ class TransitSim(Sim):
 
         # TODO replanning can occur here too,
         # e.g. if travel_time exceeds expected travel time
-        leg, edge, travel_time = leg
+        leg, idx, travel_time = leg
 
         # enter edge
-        edge['occupancy'] += self.roads.vehicle_size
-        if edge['occupancy'] <= 0:
+        occupancy[idx] += self.roads.vehicle_size
+        if occupancy[idx] <= 0:
             raise Exception('adding occupant shouldnt make it 0')
-        self.data['road_capacities'][edge['id']].append((float(edge['occupancy']), float(time)))
+        roads.update_edge(idx)
+        self.data['road_capacities'][roads.edge_ids[idx]].append((float(occupancy[idx]), float(time)))
 
-        vehicle.current = edge
+        vehicle.current = idx
 
         # cast to avoid errors with serializing numpy types
         if self.save_history and time >= self.history_window[0] and time <= self.history_window[1]:
@@ -417,7 +471,8 @@ class TransitSim(Sim):
 
     def clear_accident(self, edge, time):
         logger.debug('Accident cleared at edge: {}'.format(edge))
-        self.roads.network.edges[edge]['accident'] = False
+        self.roads.state.accident[edge] = False
+        self.roads.update_edge(edge)
         return []
 
     def export(self):
@@ -427,10 +482,7 @@ class TransitSim(Sim):
         trips = []
         for veh_id, trip in tqdm(self.history.items()):
             veh_type = self.vehicles[veh_id].type
-            if veh_type is VehicleType.Public:
-                road_network = self.transit_roads
-            else:
-                road_network = self.roads
+            road_network = self.road_network(veh_type)
             trips.append({
                 'vendor': veh_type.value,
                 'segments': road_network.segments(trip, step=0.5)
@@ -33,5 +33,12 @@ class EventQueue():
         del self.actions[key]
         return event
 
+    def next_time(self):
+        """time of the next event, if any"""
+        try:
+            return self.heap[0][0]
+        except IndexError:
+            return None
+
     def __len__(self):
         return len(self.heap)